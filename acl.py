@@ -0,0 +1,79 @@
+import logging
+from typing import Union
+from aiogram.filters import BaseFilter
+from aiogram.types import CallbackQuery, Message
+from config import config
+from database import get_managers, save_manager, delete_manager
+
+logger = logging.getLogger(__name__)
+
+ROLES = ("manager", "admin")
+
+class ManagerRegistry:
+    """Кэш прав менеджеров в памяти: проверки без обращения к базе.
+
+    add/remove перечитывают права сразу только в своем процессе; остальные процессы
+    подхватывают изменения периодической перезагрузкой (ACL_RELOAD_SECONDS).
+    """
+
+    def __init__(self):
+        # Главный админ из конфигурации - менеджер всегда, даже до загрузки таблицы
+        self._managers = frozenset({config.ADMIN_ID})
+        self._admins = frozenset({config.ADMIN_ID})
+
+    async def load(self):
+        """Загружает менеджеров из базы и подменяет наборы целиком"""
+        managers = await get_managers()
+        if managers is None:
+            logger.warning("⚠️ Список менеджеров не загружен, используются прежние права")
+            return
+
+        loaded_managers = frozenset({config.ADMIN_ID, *(manager.tg_id for manager in managers)})
+        loaded_admins = frozenset({config.ADMIN_ID, *(manager.tg_id for manager in managers if manager.role == "admin")})
+        # Перечитывается по таймеру, поэтому пишем в лог только изменения
+        if (loaded_managers, loaded_admins) != (self._managers, self._admins):
+            self._managers, self._admins = loaded_managers, loaded_admins
+            logger.info(f"🔐 Загружено менеджеров: {len(self._managers)} (админов: {len(self._admins)})")
+
+    def is_manager(self, tg_id: int) -> bool:
+        return tg_id in self._managers
+
+    def is_admin(self, tg_id: int) -> bool:
+        return tg_id in self._admins
+
+    @property
+    def manager_ids(self) -> frozenset:
+        return self._managers
+
+    async def add(self, tg_id: int, role: str = "manager", name: str = None) -> bool:
+        """Добавляет менеджера и обновляет кэш"""
+        if role not in ROLES:
+            return False
+        if not await save_manager(tg_id, role, name):
+            return False
+        await self.load()
+        return True
+
+    async def remove(self, tg_id: int) -> bool:
+        """Удаляет менеджера и обновляет кэш"""
+        if tg_id == config.ADMIN_ID:
+            return False
+        if not await delete_manager(tg_id):
+            return False
+        await self.load()
+        return True
+
+manager_registry = ManagerRegistry()
+
+class IsManager(BaseFilter):
+    """Фильтр aiogram: пропускает только менеджеров (или админов при role='admin')"""
+
+    def __init__(self, role: str = "manager"):
+        self.role = role
+
+    async def __call__(self, event: Union[Message, CallbackQuery]) -> bool:
+        if not event.from_user:
+            return False
+        if self.role == "admin":
+            return manager_registry.is_admin(event.from_user.id)
+        return manager_registry.is_manager(event.from_user.id)
@@ -0,0 +1,255 @@
+import asyncio
+import io
+import logging
+from datetime import datetime, timedelta
+from typing import Tuple
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from config import config
+from database import engine, FunnelEvent
+
+logger = logging.getLogger(__name__)
+
+FUNNEL_LABELS = {
+    FunnelEvent.START: "🚀 /start",
+    FunnelEvent.QUIZ_STARTED: "🧪 Начали квиз",
+    FunnelEvent.QUIZ_Q1: "1️⃣ Вопрос 1",
+    FunnelEvent.QUIZ_Q2: "2️⃣ Вопрос 2",
+    FunnelEvent.QUIZ_Q3: "3️⃣ Вопрос 3",
+    FunnelEvent.OFFER: "🎁 Предложение",
+    FunnelEvent.ORDER_CREATED: "📝 Заказ создан",
+    FunnelEvent.PAYMENT: "💰 Оплата",
+    FunnelEvent.CONTACTS: "📞 Контакты",
+    FunnelEvent.TIMEZONE: "🕐 Часовой пояс",
+}
+
+EVENTS_QUERY = text("SELECT user_id, event, created_at FROM events WHERE created_at >= :since")
+USERS_QUERY = text("""
+    SELECT id AS user_id, source, scenario
+    FROM users
+    WHERE id IN (SELECT DISTINCT user_id FROM events WHERE created_at >= :since)
+""")
+
+async def load_funnel_slice(days: int) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Загружает события за окно и атрибуцию их пользователей в компактные DataFrame"""
+    since = datetime.utcnow() - timedelta(days=days)
+
+    def read(sync_conn):
+        events = pd.read_sql(EVENTS_QUERY, sync_conn, params={"since": since})
+        users = pd.read_sql(USERS_QUERY, sync_conn, params={"since": since})
+        return events, users
+
+    async with engine.connect() as conn:
+        events, users = await conn.run_sync(read)
+
+    events = events.astype({"user_id": np.int32, "event": np.int8})
+    users = users.fillna({"source": "direct", "scenario": "default"}).astype(
+        {"user_id": np.int32, "source": "category", "scenario": "category"}
+    )
+    return events, users
+
+def compute_funnel(events: pd.DataFrame) -> pd.DataFrame:
+    """Пошаговая воронка: сколько пользователей дошло до каждого шага"""
+    steps = [int(step) for step in FunnelEvent]
+    if events.empty:
+        reached_counts = pd.Series(0, index=steps)
+    else:
+        reached = pd.crosstab(events["user_id"], events["event"]).gt(0)
+        reached_counts = reached.reindex(columns=steps, fill_value=False).sum()
+
+    funnel = pd.DataFrame({
+        "step": [FUNNEL_LABELS[FunnelEvent(step)] for step in steps],
+        "users": reached_counts.to_numpy(),
+    }, index=steps)
+    reached_users = funnel["users"].astype(float)
+    previous = reached_users.shift(1)
+    start = reached_users.iloc[0]
+    funnel["from_previous_pct"] = (reached_users / previous.where(previous > 0) * 100).round(1)
+    funnel["from_start_pct"] = (reached_users / start * 100).round(1) if start else np.nan
+    return funnel
+
+def compute_cohorts(events: pd.DataFrame, users: pd.DataFrame) -> pd.DataFrame:
+    """Дневные когорты по источнику и сценарию: пришли, прошли квиз, оплатили"""
+    if events.empty:
+        return pd.DataFrame(columns=["cohort", "source", "scenario", "users", "quiz", "paid", "conversion_pct"])
+
+    per_user = events.assign(
+        quiz=events["event"].eq(FunnelEvent.QUIZ_Q3),
+        paid=events["event"].eq(FunnelEvent.PAYMENT),
+    ).groupby("user_id").agg(cohort=("created_at", "min"), quiz=("quiz", "any"), paid=("paid", "any"))
+    per_user["cohort"] = per_user["cohort"].dt.floor("D")
+    per_user = per_user.join(users.set_index("user_id"), how="left")
+
+    cohorts = per_user.groupby(["cohort", "source", "scenario"], observed=True).agg(
+        users=("paid", "size"), quiz=("quiz", "sum"), paid=("paid", "sum")
+    ).reset_index()
+    cohorts["conversion_pct"] = (cohorts["paid"] / cohorts["users"] * 100).round(1)
+    return cohorts.sort_values(["cohort", "users"], ascending=[False, False])
+
+def render_text(funnel: pd.DataFrame, cohorts: pd.DataFrame, days: int) -> str:
+    """Текстовая сводка для Telegram"""
+    report = f"📈 *Воронка за {days} дн.*\n\n"
+    for row in funnel.itertuples():
+        report += f"{row.step}: *{row.users}*"
+        if pd.notna(row.from_previous_pct):
+            report += f" ({row.from_previous_pct}% от пред., {row.from_start_pct}% от старта)"
+        report += "\n"
+
+    if not cohorts.empty:
+        by_source = cohorts.groupby("source", observed=True)[["users", "paid"]].sum()
+        by_source = by_source[by_source["users"] > 0].sort_values("users", ascending=False).head(10)
+        report += "\n*Источники (топ-10):*\n"
+        for source, row in by_source.iterrows():
+            report += f"• `{source}`: {row['users']} → {row['paid']} оплат ({row['paid'] / row['users'] * 100:.1f}%)\n"
+
+    return report
+
+def render_xlsx(funnel: pd.DataFrame, cohorts: pd.DataFrame) -> bytes:
+    """XLSX-отчет: воронка и когорты на отдельных листах"""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        funnel.to_excel(writer, sheet_name="Воронка", index=False)
+        cohorts.assign(cohort=cohorts["cohort"].dt.date if not cohorts.empty else cohorts["cohort"]).to_excel(
+            writer, sheet_name="Когорты", index=False
+        )
+    return buffer.getvalue()
+
+async def build_funnel_report(days: int = 30, as_xlsx: bool = False):
+    """Строит отчет по воронке; расчеты выполняются вне event loop"""
+    events, users = await load_funnel_slice(days)
+    logger.info(f"📈 Загружено {len(events)} событий воронки за {days} дн.")
+
+    def compute():
+        funnel = compute_funnel(events)
+        cohorts = compute_cohorts(events, users)
+        if as_xlsx:
+            return render_xlsx(funnel, cohorts)
+        return render_text(funnel, cohorts, days)
+
+    return await asyncio.to_thread(compute)
+
+# ========== КВИЗ И КОНВЕРСИЯ ==========
+
+# Варианты ответов квиза; код ответа = позиция в списке + 1, 0 - нет ответа
+QUIZ_OPTIONS = {
+    "energy_level": ["😫 Постоянно", "😐 Часто", "😊 Иногда", "🎉 Редко"],
+    "sleep_quality": ["😴 Отлично", "🛌 Нормально", "⏰ Плохо", "💤 Бессонница"],
+    "activity_level": ["💪 Регулярно", "🚶 Иногда", "🧘 Редко", "🚫 Никогда"],
+}
+QUIZ_QUESTIONS = list(QUIZ_OPTIONS)
+QUIZ_CODES = [len(options) + 1 for options in QUIZ_OPTIONS.values()]
+
+def _sql_array(values) -> str:
+    escaped = ", ".join("'" + value.replace("'", "''") + "'" for value in values)
+    return f"ARRAY[{escaped}]::text[]"
+
+# Одна строка на пользователя: коды последних ответов и факт оплаты.
+# Кодирование ответов делает сама база, наружу уходит только CSV из чисел.
+QUIZ_CONVERSION_COPY = f"""
+    COPY (
+        WITH latest AS (
+            SELECT DISTINCT ON (user_id, question_id) user_id, question_id, answer
+            FROM quiz_answers
+            ORDER BY user_id, question_id, id DESC
+        )
+        SELECT
+            {", ".join(
+                f"COALESCE(MAX(array_position({_sql_array(options)}, l.answer)) "
+                f"FILTER (WHERE l.question_id = '{question}'), 0)"
+                for question, options in QUIZ_OPTIONS.items()
+            )},
+            CASE WHEN EXISTS (
+                SELECT 1 FROM orders o WHERE o.user_id = l.user_id AND o.payment_status = 'paid'
+            ) THEN 1 ELSE 0 END
+        FROM latest l
+        GROUP BY l.user_id
+    ) TO STDOUT WITH (FORMAT csv)
+"""
+
+class QuizConversionAccumulator:
+    """Счетчики пользователей и оплат по каждой комбинации кодов ответов"""
+
+    def __init__(self):
+        self.cells = int(np.prod(QUIZ_CODES))
+        self.users = np.zeros(self.cells, dtype=np.int64)
+        self.paid = np.zeros(self.cells, dtype=np.int64)
+        self.rows = 0
+
+    def add_csv(self, data: bytes):
+        """Добавляет пакет строк CSV: все вычисления - над массивами NumPy"""
+        if not data:
+            return
+        chunk = pd.read_csv(io.BytesIO(data), header=None, dtype=np.int8,
+                            names=QUIZ_QUESTIONS + ["paid"]).to_numpy()
+        combo = np.ravel_multi_index(tuple(chunk[:, i] for i in range(len(QUIZ_QUESTIONS))), QUIZ_CODES)
+        self.users += np.bincount(combo, minlength=self.cells)
+        self.paid += np.bincount(combo, weights=chunk[:, -1], minlength=self.cells).astype(np.int64)
+        self.rows += len(chunk)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Таблица комбинаций ответов с конверсией в оплату"""
+        index = pd.MultiIndex.from_product(
+            [["—"] + options for options in QUIZ_OPTIONS.values()], names=QUIZ_QUESTIONS
+        )
+        frame = pd.DataFrame({"users": self.users, "paid": self.paid}, index=index)
+        frame = frame[frame["users"] > 0]
+        frame["conversion_pct"] = (frame["paid"] / frame["users"] * 100).round(1)
+        return frame.sort_values(["conversion_pct", "users"], ascending=False)
+
+async def load_quiz_conversion(chunk_bytes: int = None) -> QuizConversionAccumulator:
+    """Потоково читает закодированные ответы через COPY и накапливает счетчики пакетами"""
+    chunk_bytes = chunk_bytes or config.ANALYTICS_CHUNK_BYTES
+    accumulator = QuizConversionAccumulator()
+    pending = bytearray()
+
+    async def consume(data: bytes):
+        pending.extend(data)
+        if len(pending) >= chunk_bytes:
+            # Режем по последнему переводу строки, хвост ждет следующего пакета
+            cut = pending.rfind(b"\n") + 1
+            complete = bytes(pending[:cut])
+            del pending[:cut]
+            await asyncio.to_thread(accumulator.add_csv, complete)
+
+    async with engine.connect() as conn:
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_from_query(QUIZ_CONVERSION_COPY, output=consume)
+
+    await asyncio.to_thread(accumulator.add_csv, bytes(pending))
+    return accumulator
+
+def render_quiz_conversion(frame: pd.DataFrame, total_users: int, min_users: int = 10) -> str:
+    """Текстовая сводка: конверсия по каждому ответу и лучшие комбинации"""
+    report = f"🧪 *Ответы квиза и оплаты* (пользователей: {total_users})\n"
+    for question in QUIZ_QUESTIONS:
+        by_answer = frame.groupby(level=question)[["users", "paid"]].sum()
+        by_answer = by_answer[by_answer["users"] > 0]
+        report += f"\n*{question.replace('_', ' ').title()}:*\n"
+        for answer, users, paid in zip(by_answer.index, by_answer["users"], by_answer["paid"]):
+            report += f"• {answer}: {users} → {paid} ({paid / users * 100:.1f}%)\n"
+
+    top = frame[frame["users"] >= min_users].head(5)
+    if not top.empty:
+        report += f"\n*Лучшие комбинации (от {min_users} польз.):*\n"
+        for answers, users, conversion in zip(top.index, top["users"], top["conversion_pct"]):
+            report += f"• {' / '.join(answers)}: {conversion}% из {users}\n"
+    return report
+
+async def build_quiz_conversion_report():
+    """Строит отчет по ответам квиза: текст и XLSX с полной таблицей комбинаций"""
+    accumulator = await load_quiz_conversion()
+    logger.info(f"🧪 Обработано {accumulator.rows} пользователей с ответами квиза")
+
+    def compute():
+        frame = accumulator.to_frame()
+        buffer = io.BytesIO()
+        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+            frame.reset_index().to_excel(writer, sheet_name="Комбинации", index=False)
+            for question in QUIZ_QUESTIONS:
+                by_answer = frame.groupby(level=question)[["users", "paid"]].sum()
+                by_answer["conversion_pct"] = (by_answer["paid"] / by_answer["users"].where(by_answer["users"] > 0) * 100).round(1)
+                by_answer.reset_index().to_excel(writer, sheet_name=question[:31], index=False)
+        return render_quiz_conversion(frame, accumulator.rows), buffer.getvalue()
+
+    return await asyncio.to_thread(compute)
@@ -0,0 +1,121 @@
+"""Масштабирование launcher.py по числу процессов на офлайн-нагрузке.
+
+Обновления раскладываются по воркерам тем же шардированием, что и в боевом
+приемнике; воркер выполняет CPU-часть обработки (сборка ORM-объектов,
+форматирование карточки в Markdown, клавиатура и ее сериализация) без сети
+и базы. Попутно проверяется, что обновления одного пользователя приходят по порядку.
+
+    python -m benchmarks.bench_workers [макс. число воркеров]
+"""
+import multiprocessing
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from launcher import WorkerPool, update_owner_id
+
+UPDATES = 20000
+USERS = 5000
+# Повторов обработки на одно обновление: приближает стоимость к реальному обработчику
+WORK_REPEAT = 3
+
+
+def make_update(update_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+            "text": "👤 Профиль",
+        },
+    }
+
+
+def bench_worker(ready: multiprocessing.Queue, index: int, worker_queue: multiprocessing.Queue):
+    """Воркер бенчмарка: та же очередь и шардирование, обработка без ввода-вывода"""
+    from aiogram import Bot
+    from database import Order, User
+    from managers import ManagerBot
+
+    manager_bot = ManagerBot(Bot(token="123456:offline-benchmark-token"))
+    last_seen = {}
+    processed = out_of_order = 0
+    ready.put(("ready", index, 0, 0))
+
+    while True:
+        update = worker_queue.get()
+        if update is None:
+            break
+        user_id, (kind, payload) = update
+        if last_seen.get(user_id, -1) > payload["update_id"]:
+            out_of_order += 1
+        last_seen[user_id] = payload["update_id"]
+
+        for _ in range(WORK_REPEAT):
+            sender = payload["message"]["from"]
+            user = User(id=user_id, tg_id=user_id, first_name=sender["first_name"], username=None,
+                        phone="+79990000000", status="paid", source="ref_1", created_at=datetime.now())
+            orders = [Order(id=user_id * 10 + i, user_id=user_id, amount=2990.0, payment_status="paid",
+                            created_at=datetime.now()) for i in range(3)]
+            quiz = [("energy_level", "😐 Часто"), ("sleep_quality", "⏰ Плохо"), ("activity_level", "🚶 Иногда")]
+            manager_bot._format_user_card(user, orders, quiz)
+            manager_bot._create_manager_keyboard(user_id).model_dump_json()
+        processed += 1
+
+    ready.put(("done", index, processed, out_of_order))
+
+
+def run(workers: int) -> dict:
+    ready = multiprocessing.get_context("spawn").Queue()
+    pool = WorkerPool(workers, partial(bench_worker, ready))
+    pool.start()
+    for _ in range(workers):
+        ready.get()
+
+    rng = random.Random(42)
+    started = time.perf_counter()
+    for update_id in range(UPDATES):
+        payload = make_update(update_id, rng.randrange(1, USERS) * 7919)
+        pool.route(update_owner_id(payload), ("update", payload))
+    pool.stop(timeout=600)
+    elapsed = time.perf_counter() - started
+
+    per_worker = []
+    out_of_order = 0
+    for _ in range(workers):
+        _, index, processed, violations = ready.get()
+        per_worker.append(processed)
+        out_of_order += violations
+    return {
+        "workers": workers,
+        "elapsed": elapsed,
+        "throughput": UPDATES / elapsed,
+        "per_worker": sorted(per_worker),
+        "out_of_order": out_of_order,
+    }
+
+
+def main():
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count() or 1
+    counts = sorted({1, *(n for n in (2, 4, 8, 16) if n < max_workers), max_workers})
+    baseline = None
+    print(f"{UPDATES} обновлений от {USERS} пользователей, ядер: {os.cpu_count()}")
+    for workers in counts:
+        result = run(workers)
+        baseline = baseline or result["throughput"]
+        print(f"воркеров {workers:>2}: {result['throughput']:8.0f} обн/с за {result['elapsed']:.2f} с, "
+              f"ускорение x{result['throughput'] / baseline:.2f}, "
+              f"нагрузка {result['per_worker'][0]}..{result['per_worker'][-1]}, "
+              f"нарушений порядка {result['out_of_order']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,9 +12,124 @@ class Config:
     # Database
     DATABASE_URL = os.getenv("DATABASE_URL").replace("postgresql://", "postgresql+asyncpg://")
     
+    # Connection pool
+    DB_ECHO = os.getenv("DB_ECHO", "true").lower() == "true"
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+    DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+    DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 256))
+    DB_WARMUP = os.getenv("DB_WARMUP", "true").lower() == "true"
+    
+    # Manager access: every process reloads the ACL, so /manager add|remove reaches all workers
+    ACL_RELOAD_SECONDS = float(os.getenv("ACL_RELOAD_SECONDS", 30))
+    
+    # Manager cards
+    CARD_CACHE_SIZE = int(os.getenv("CARD_CACHE_SIZE", 5000))
+    CARD_CACHE_TTL = float(os.getenv("CARD_CACHE_TTL", 60))
+    
+    # Client order status screen
+    LAST_ORDER_CACHE_SIZE = int(os.getenv("LAST_ORDER_CACHE_SIZE", 10000))
+    LAST_ORDER_CACHE_TTL = float(os.getenv("LAST_ORDER_CACHE_TTL", 60))
+    # Users whose data versions (and tg_id -> id) are kept in memory; older ones are evicted LRU
+    USER_VERSIONS_SIZE = int(os.getenv("USER_VERSIONS_SIZE", 50000))
+    QUEUE_PAGE_SIZE = int(os.getenv("QUEUE_PAGE_SIZE", 10))
+    STATUS_STATS_CACHE_TTL = float(os.getenv("STATUS_STATS_CACHE_TTL", 30))
+    
+    # Manager notification digest
+    DIGEST_WINDOW_SECONDS = float(os.getenv("DIGEST_WINDOW_SECONDS", 15))
+    DIGEST_MAX_EVENTS = int(os.getenv("DIGEST_MAX_EVENTS", 20))
+    URGENT_EVENT_TYPES = set(filter(None, os.getenv("URGENT_EVENT_TYPES", "payment_claimed").split(",")))
+    
+    # Status history
+    STATUS_HISTORY_BATCH_SIZE = int(os.getenv("STATUS_HISTORY_BATCH_SIZE", 100))
+    STATUS_HISTORY_FLUSH_INTERVAL = float(os.getenv("STATUS_HISTORY_FLUSH_INTERVAL", 5))
+    
+    # Funnel event log
+    EVENT_LOG_BATCH_SIZE = int(os.getenv("EVENT_LOG_BATCH_SIZE", 500))
+    EVENT_LOG_FLUSH_INTERVAL = float(os.getenv("EVENT_LOG_FLUSH_INTERVAL", 5))
+    
+    # Source attribution rollups
+    ROLLUP_BATCH_SIZE = int(os.getenv("ROLLUP_BATCH_SIZE", 200))
+    ROLLUP_FLUSH_INTERVAL = float(os.getenv("ROLLUP_FLUSH_INTERVAL", 10))
+    
+    # Duplicate users cleanup
+    DEDUP_BATCH_SIZE = int(os.getenv("DEDUP_BATCH_SIZE", 1000))
+    
+    # Partitions and archival of cold data (0 months = archival disabled)
+    PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 3))
+    ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", 0))
+    ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 5000))
+    ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+    
+    # FSM sessions
+    FSM_TTL_MINUTES = int(os.getenv("FSM_TTL_MINUTES", 24 * 60))
+    FSM_NUDGE_AFTER_MINUTES = int(os.getenv("FSM_NUDGE_AFTER_MINUTES", 60))
+    FSM_SWEEP_INTERVAL_SECONDS = int(os.getenv("FSM_SWEEP_INTERVAL_SECONDS", 60))
+    
+    # Graceful shutdown
+    SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", 15))
+    SHUTDOWN_TIMEOUT_SECONDS = float(os.getenv("SHUTDOWN_TIMEOUT_SECONDS", 30))
+    
+    # Retries and circuit breakers
+    RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 0.2))
+    RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 3))
+    DB_RETRY_ATTEMPTS = int(os.getenv("DB_RETRY_ATTEMPTS", 3))
+    DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", 5))
+    DB_BREAKER_RESET_SECONDS = float(os.getenv("DB_BREAKER_RESET_SECONDS", 10))
+    BOT_RETRY_ATTEMPTS = int(os.getenv("BOT_RETRY_ATTEMPTS", 3))
+    BOT_RETRY_SENDS = os.getenv("BOT_RETRY_SENDS", "false").lower() == "true"
+    BOT_BREAKER_FAILURES = int(os.getenv("BOT_BREAKER_FAILURES", 5))
+    BOT_BREAKER_RESET_SECONDS = float(os.getenv("BOT_BREAKER_RESET_SECONDS", 10))
+    
+    # Multi-process mode (launcher.py)
+    # Every worker and the receiver has its own DB pool: up to
+    # (WORKERS + 1) * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections, keep it below max_connections
+    WORKERS = int(os.getenv("WORKERS", 2))
+    WORKER_RESTART_DELAY = float(os.getenv("WORKER_RESTART_DELAY", 2))
+    
+    # Client reports
+    REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", 2))
+    REPORT_QUEUE_SIZE = int(os.getenv("REPORT_QUEUE_SIZE", 20))
+    
+    # Profiling
+    PROFILE_SAMPLE_INTERVAL_MS = int(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", 5))
+    PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", 300))
+    
+    # Analytics
+    ANALYTICS_CHUNK_BYTES = int(os.getenv("ANALYTICS_CHUNK_BYTES", 4 * 1024 * 1024))
+    
+    # Outgoing messages (Telegram: ~30 msg/s per bot)
+    SEND_RATE_PER_SECOND = float(os.getenv("SEND_RATE_PER_SECOND", 25))
+    SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", 10))
+    
     # Payments
     YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID", "")
     YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY", "")
+    YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3")
+    YOOKASSA_RETURN_URL = os.getenv("YOOKASSA_RETURN_URL", "https://t.me/")
+    YOOKASSA_WEBHOOK_PATH = os.getenv("YOOKASSA_WEBHOOK_PATH", "/yookassa/webhook")
+    YOOKASSA_VERIFY_WEBHOOKS = os.getenv("YOOKASSA_VERIFY_WEBHOOKS", "true").lower() == "true"
+    YOOKASSA_POOL_SIZE = int(os.getenv("YOOKASSA_POOL_SIZE", 20))
+    YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", 10))
+    
+    # Payment reconciliation
+    RECONCILE_INTERVAL_MINUTES = int(os.getenv("RECONCILE_INTERVAL_MINUTES", 15))
+    RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", 500))
+    RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", 10))
+    RECONCILE_MIN_AGE_MINUTES = int(os.getenv("RECONCILE_MIN_AGE_MINUTES", 5))
+    
+    # HTTP server for webhooks
+    WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+    WEB_PORT = int(os.getenv("WEB_PORT", 8080))
+    
+    # Health checks (/healthz, /readyz)
+    HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", 10))
+    HEALTH_PROBE_TIMEOUT = float(os.getenv("HEALTH_PROBE_TIMEOUT", 2))
+    HEALTH_BOT_ME_TTL = float(os.getenv("HEALTH_BOT_ME_TTL", 600))
+    REDIS_REQUIRED = os.getenv("REDIS_REQUIRED", "false").lower() == "true"
+    WORKER_WEB_PORT_BASE = int(os.getenv("WORKER_WEB_PORT_BASE", 8090))
     
     # Redis for scheduler
     REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
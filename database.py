@@ -1,9 +1,24 @@
+import asyncio
+import csv
+import functools
+import gzip
 import logging
+import re
+import time
+from collections import OrderedDict, defaultdict
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, Integer, String, BigInteger, DateTime, Text, Float, Boolean, text
-from datetime import datetime
+from sqlalchemy import Column, Integer, SmallInteger, String, BigInteger, DateTime, Text, Float, Boolean, JSON, Index, text, bindparam, insert, select, tuple_, func, update
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from datetime import datetime, timedelta
+from enum import IntEnum
+from pathlib import Path
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
 from config import config
+from resilience import OPEN, CircuitOpenError, backoff_delays, db_breaker
+from pipeline import can_transition, allowed_sources
 
 logger = logging.getLogger(__name__)
 
@@ -21,29 +36,432 @@ class User(Base):
     source = Column(String(100), nullable=True)
     scenario = Column(String(50), default='default')
     status = Column(String(50), default='lead')
+    status_updated_at = Column(DateTime, default=datetime.utcnow)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # Очереди менеджеров: клиенты в статусе, отсортированные по времени ожидания
+        Index("ix_users_status_updated", "status", "status_updated_at", "id"),
+    )
+
 class QuizAnswer(Base):
+    """Ответы квиза; таблица секционирована по месяцам created_at"""
     __tablename__ = "quiz_answers"
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, index=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer)
     question_id = Column(String(100))
     answer = Column(Text)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    # Ключ секционирования обязан входить в первичный ключ
+    created_at = Column(DateTime, primary_key=True, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Ответы клиента в порядке ввода - для карточки без сортировки
+        Index("ix_quiz_answers_user", "user_id", "id"),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
 
 class Order(Base):
     __tablename__ = "orders"
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, index=True)
+    user_id = Column(Integer)
     amount = Column(Float)
     payment_status = Column(String(50), default='new')
     payment_date = Column(DateTime, nullable=True)
-    transaction_id = Column(String(100), nullable=True)
+    transaction_id = Column(String(100), nullable=True, unique=True, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # Сверка платежей: обход ожидающих оплаты заказов по id
+        Index("ix_orders_pending", "id", postgresql_where=text("payment_status = 'pending'")),
+        # Заказы клиента от последнего: без сортировки и без чтения всей истории
+        Index("ix_orders_user_created", "user_id", "created_at"),
+    )
+
+class FunnelEvent(IntEnum):
+    """Коды шагов воронки в порядке прохождения"""
+    START = 1
+    QUIZ_STARTED = 2
+    QUIZ_Q1 = 3
+    QUIZ_Q2 = 4
+    QUIZ_Q3 = 5
+    OFFER = 6
+    ORDER_CREATED = 7
+    PAYMENT = 8
+    CONTACTS = 9
+    TIMEZONE = 10
+
+class Event(Base):
+    """Журнал событий воронки, только добавление"""
+    __tablename__ = "events"
+    id = Column(BigInteger, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    event = Column(SmallInteger, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        # Журнал растет по времени: BRIN по created_at почти ничего не весит
+        Index("ix_events_created_brin", "created_at", postgresql_using="brin"),
+        Index("ix_events_user", "user_id"),
+    )
+
+class SourceRollup(Base):
+    """Почасовые и дневные итоги по источникам трафика и рефереерам"""
+    __tablename__ = "source_rollups"
+    granularity = Column(String(5), primary_key=True)  # 'hour' или 'day'
+    bucket_start = Column(DateTime, primary_key=True)
+    source = Column(String(100), primary_key=True)
+    # tg_id пригласившего для ref_-ссылок, 0 для остальных источников
+    referrer_tg_id = Column(BigInteger, primary_key=True, default=0)
+    new_users = Column(Integer, default=0, nullable=False)
+    payments = Column(Integer, default=0, nullable=False)
+    revenue = Column(Float, default=0, nullable=False)
+
+    __table_args__ = (
+        Index("ix_source_rollups_day", "granularity", "bucket_start"),
+        Index("ix_source_rollups_referrer", "referrer_tg_id", postgresql_where=text("referrer_tg_id <> 0")),
+    )
+
+class Manager(Base):
+    __tablename__ = "managers"
+    tg_id = Column(BigInteger, primary_key=True)
+    role = Column(String(20), default='manager', nullable=False)
+    name = Column(String(100), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ReportFile(Base):
+    """Загруженные в Telegram отчеты: file_id по версии данных клиента"""
+    __tablename__ = "report_files"
+    user_id = Column(Integer, primary_key=True)
+    version = Column(String(32), primary_key=True)
+    file_id = Column(String(255), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class StatusHistory(Base):
+    __tablename__ = "status_history"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    from_status = Column(String(50), nullable=True)
+    to_status = Column(String(50), nullable=False)
+    changed_by = Column(BigInteger, nullable=True)
+    changed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    # Сколько секунд клиент провел в from_status
+    duration_seconds = Column(Float, nullable=True)
+
+    __table_args__ = (
+        Index("ix_status_history_user_changed", "user_id", "changed_at"),
+        Index("ix_status_history_to_status_changed", "to_status", "changed_at"),
+    )
+
+class StatusStats(Base):
+    """Предрассчитанная сводка по этапам воронки"""
+    __tablename__ = "status_stats"
+    status = Column(String(50), primary_key=True)
+    users_count = Column(Integer, default=0, nullable=False)
+    exits_count = Column(Integer, default=0, nullable=False)
+    total_seconds = Column(Float, default=0, nullable=False)
+
+# Версии данных клиентов: растут при любой записи в строки пользователя.
+# Версия - номер записи по всем пользователям, поэтому вытеснение из словаря безопасно:
+# вытесненный пользователь получает версию не меньше своей последней и не совпадет с кэшем
+_user_versions: "OrderedDict[int, int]" = OrderedDict()
+# Число записей по всем пользователям - для чтений, когда id пользователя еще неизвестен
+_version_bumps = 0
+# Наибольшая вытесненная версия - ее получают пользователи, которых нет в словаре
+_version_floor = 0
+
+def get_user_version(user_id: int) -> int:
+    """Возвращает текущую версию данных пользователя"""
+    return _user_versions.get(user_id, _version_floor)
+
+def bump_user_version(user_id: int) -> int:
+    """Отмечает изменение данных пользователя"""
+    global _version_bumps, _version_floor
+    _version_bumps += 1
+    _user_versions[user_id] = _version_bumps
+    _user_versions.move_to_end(user_id)
+    while len(_user_versions) > config.USER_VERSIONS_SIZE:
+        _, evicted = _user_versions.popitem(last=False)
+        _version_floor = max(_version_floor, evicted)
+    return _version_bumps
+
+# Сбои базы, после которых имеет смысл повторить операцию
+TRANSIENT_DB_ERRORS = (OSError, asyncio.TimeoutError, OperationalError, InterfaceError)
+
+# Временные сбои текущей операции: True - соединение не было установлено
+_db_failures: ContextVar[Optional[list]] = ContextVar("db_failures", default=None)
+
+def is_transient_db_error(error: Exception) -> bool:
+    return isinstance(error, TRANSIENT_DB_ERRORS) or (isinstance(error, DBAPIError) and error.connection_invalidated)
+
+class ResilientSession(AsyncSession):
+    """Сессия, которая учитывает сбои в автомате базы и не ходит в базу, пока он открыт"""
+
+    async def _guarded(self, call, *args, **kwargs):
+        db_breaker.check()
+        try:
+            result = await call(*args, **kwargs)
+        except Exception as e:
+            if is_transient_db_error(e):
+                db_breaker.record_failure()
+                failures = _db_failures.get()
+                if failures is not None:
+                    # Отказ в соединении: запрос до базы не дошел, повтор безопасен для любой операции
+                    failures.append(isinstance(e, OSError))
+            raise
+        db_breaker.record_success()
+        return result
+
+    async def execute(self, *args, **kwargs):
+        return await self._guarded(super().execute, *args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return await self._guarded(super().scalar, *args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return await self._guarded(super().scalars, *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        return await self._guarded(super().get, *args, **kwargs)
+
+    async def refresh(self, *args, **kwargs):
+        return await self._guarded(super().refresh, *args, **kwargs)
+
+    async def commit(self):
+        return await self._guarded(super().commit)
+
+def db_retry(idempotent: bool = True):
+    """Повторяет операцию с базой при временном сбое (экспонента с джиттером).
+
+    Неидемпотентные операции повторяются, только если соединение не было установлено.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            delays = backoff_delays(config.DB_RETRY_ATTEMPTS, config.RETRY_BASE_DELAY, config.RETRY_MAX_DELAY)
+            while True:
+                failures = []
+                token = _db_failures.set(failures)
+                try:
+                    result = await func(*args, **kwargs)
+                finally:
+                    _db_failures.reset(token)
+                if not failures or db_breaker.state == OPEN or not (idempotent or all(failures)):
+                    return result
+                delay = next(delays, None)
+                if delay is None:
+                    return result
+                db_breaker.retries += 1
+                logger.warning(f"🔁 {func.__name__}: сбой базы, повтор через {delay:.2f} с")
+                await asyncio.sleep(delay)
+        return wrapper
+    return decorator
+
 # Database setup
-engine = create_async_engine(config.DATABASE_URL, echo=True)
-AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+engine = create_async_engine(
+    config.DATABASE_URL,
+    echo=config.DB_ECHO,
+    pool_size=config.DB_POOL_SIZE,
+    max_overflow=config.DB_MAX_OVERFLOW,
+    pool_timeout=config.DB_POOL_TIMEOUT,
+    pool_recycle=config.DB_POOL_RECYCLE,
+    pool_pre_ping=config.DB_POOL_PRE_PING,
+    # Кэш подготовленных запросов asyncpg на каждое соединение (ключ - текст SQL)
+    connect_args={"prepared_statement_cache_size": config.DB_STATEMENT_CACHE_SIZE},
+)
+AsyncSessionLocal = sessionmaker(engine, class_=ResilientSession, expire_on_commit=False)
+
+class BufferedWriter:
+    """Буфер записей в памяти со сбросом в базу пакетами: по размеру и по таймеру"""
+
+    name = "записи"
+
+    def __init__(self, batch_size: int, flush_interval: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer: list = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._task = None
+
+    def _append(self, item):
+        self._buffer.append(item)
+        if len(self._buffer) >= self.batch_size and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def _write(self, session, batch: list):
+        raise NotImplementedError
+
+    def _after_write(self, batch: list):
+        pass
+
+    async def flush(self) -> int:
+        """Записывает накопленный буфер одной транзакцией"""
+        async with self._flush_lock:
+            batch, self._buffer = self._buffer, []
+            if not batch:
+                return 0
+            try:
+                async with AsyncSessionLocal() as session:
+                    await self._write(session, batch)
+                    await session.commit()
+                self._after_write(batch)
+                logger.info(f"💾 Записано {len(batch)}: {self.name}")
+                return len(batch)
+            except Exception as e:
+                if isinstance(e, CircuitOpenError) or is_transient_db_error(e):
+                    # База недоступна или временный сбой: возвращаем пакет в буфер, чтобы не потерять данные
+                    self._buffer = batch + self._buffer
+                    logger.error(f"❌ Ошибка пакетной записи ({self.name}), повторим позже: {e}")
+                else:
+                    # Ошибку в данных повтор не исправит, а застрявший пакет блокировал бы все следующие
+                    logger.error(f"❌ Пакет из {len(batch)} отброшен ({self.name}): {e}")
+                return 0
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        """Запускает периодический сброс буфера"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновый сброс и записывает остаток буфера"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+class StatusHistoryWriter(BufferedWriter):
+    """Пакетная запись истории статусов и сводной статистики по этапам"""
+
+    name = "изменения статусов"
+
+    def __init__(self, batch_size: int = None, flush_interval: float = None):
+        super().__init__(batch_size or config.STATUS_HISTORY_BATCH_SIZE,
+                         flush_interval or config.STATUS_HISTORY_FLUSH_INTERVAL)
+
+    def record(self, user_id: int, from_status: Optional[str], to_status: str,
+               changed_by: int = None, entered_at: datetime = None):
+        """Добавляет смену статуса в буфер"""
+        changed_at = datetime.utcnow()
+        duration = None
+        if from_status and entered_at:
+            duration = (changed_at - entered_at).total_seconds()
+        self._append({
+            "user_id": user_id,
+            "from_status": from_status,
+            "to_status": to_status,
+            "changed_by": changed_by,
+            "changed_at": changed_at,
+            "duration_seconds": duration,
+        })
+
+    async def _write(self, session, batch: list):
+        # Дельты сводки: [изменение числа клиентов, выходы из статуса, секунды в статусе]
+        deltas = defaultdict(lambda: [0, 0, 0.0])
+        for entry in batch:
+            if entry["from_status"]:
+                delta = deltas[entry["from_status"]]
+                delta[0] -= 1
+                if entry["duration_seconds"] is not None:
+                    delta[1] += 1
+                    delta[2] += entry["duration_seconds"]
+            deltas[entry["to_status"]][0] += 1
+
+        await session.execute(insert(StatusHistory), batch)
+        stats_insert = pg_insert(StatusStats).values([
+            {"status": status, "users_count": count, "exits_count": exits, "total_seconds": seconds}
+            for status, (count, exits, seconds) in deltas.items()
+        ])
+        await session.execute(stats_insert.on_conflict_do_update(
+            index_elements=[StatusStats.status],
+            set_={
+                "users_count": StatusStats.users_count + stats_insert.excluded.users_count,
+                "exits_count": StatusStats.exits_count + stats_insert.excluded.exits_count,
+                "total_seconds": StatusStats.total_seconds + stats_insert.excluded.total_seconds,
+            }
+        ))
+
+    def _after_write(self, batch: list):
+        invalidate_status_stats()
+
+status_history = StatusHistoryWriter()
+
+class EventLogWriter(BufferedWriter):
+    """Пакетная запись событий воронки"""
+
+    name = "события воронки"
+
+    def __init__(self, batch_size: int = None, flush_interval: float = None):
+        super().__init__(batch_size or config.EVENT_LOG_BATCH_SIZE,
+                         flush_interval or config.EVENT_LOG_FLUSH_INTERVAL)
+
+    def log(self, user_id: int, event: FunnelEvent):
+        """Добавляет событие в буфер без обращения к базе"""
+        self._append({"user_id": user_id, "event": int(event), "created_at": datetime.utcnow()})
+
+    async def _write(self, session, batch: list):
+        await session.execute(insert(Event), batch)
+
+event_log = EventLogWriter()
+
+REFERRER_RE = re.compile(r"ref_[0-9]{1,18}")
+
+def attribution_key(source: Optional[str]) -> Tuple[str, int]:
+    """Ключ атрибуции: (источник, tg_id реферера или 0)"""
+    source = source or 'direct'
+    if source.startswith('ref_'):
+        # То же правило, что ROLLUP_REFERRER_SQL: isdigit() пропускает не-ASCII цифры, а длинное число не влезет в BIGINT
+        return 'ref', int(source[4:]) if REFERRER_RE.fullmatch(source) else 0
+    return source[:100], 0
+
+class SourceRollupWriter(BufferedWriter):
+    """Инкрементальное обновление итогов по источникам: дельты копятся и сливаются пакетом"""
+
+    name = "итоги по источникам"
+
+    def __init__(self, batch_size: int = None, flush_interval: float = None):
+        super().__init__(batch_size or config.ROLLUP_BATCH_SIZE,
+                         flush_interval or config.ROLLUP_FLUSH_INTERVAL)
+
+    def record(self, source: Optional[str], new_users: int = 0, payments: int = 0,
+               revenue: float = 0, at: datetime = None):
+        """Добавляет приход пользователя или оплату в буфер"""
+        self._append((attribution_key(source), at or datetime.utcnow(), new_users, payments, revenue or 0))
+
+    async def _write(self, session, batch: list):
+        deltas = defaultdict(lambda: [0, 0, 0.0])
+        for (source, referrer), at, new_users, payments, revenue in batch:
+            hour = at.replace(minute=0, second=0, microsecond=0)
+            for granularity, bucket in (('hour', hour), ('day', hour.replace(hour=0))):
+                delta = deltas[(granularity, bucket, source, referrer)]
+                delta[0] += new_users
+                delta[1] += payments
+                delta[2] += revenue
+
+        rollup_insert = pg_insert(SourceRollup).values([
+            {"granularity": granularity, "bucket_start": bucket, "source": source, "referrer_tg_id": referrer,
+             "new_users": new_users, "payments": payments, "revenue": revenue}
+            for (granularity, bucket, source, referrer), (new_users, payments, revenue) in deltas.items()
+        ])
+        await session.execute(rollup_insert.on_conflict_do_update(
+            index_elements=[SourceRollup.granularity, SourceRollup.bucket_start,
+                            SourceRollup.source, SourceRollup.referrer_tg_id],
+            set_={
+                "new_users": SourceRollup.new_users + rollup_insert.excluded.new_users,
+                "payments": SourceRollup.payments + rollup_insert.excluded.payments,
+                "revenue": SourceRollup.revenue + rollup_insert.excluded.revenue,
+            }
+        ))
+
+source_rollups = SourceRollupWriter()
 
 async def create_tables():
     """Создаем таблицы в базе данных"""
@@ -52,19 +470,20 @@ async def create_tables():
             # Удаляем существующие таблицы и создаем заново (для разработки)
             await conn.run_sync(Base.metadata.drop_all)
             await conn.run_sync(Base.metadata.create_all)
+        await ensure_partitions()
         logger.info("✅ Таблицы базы данных созданы заново")
     except Exception as e:
         logger.error(f"❌ Ошибка создания таблиц: {e}")
         raise
 
+USER_BY_TG_ID_QUERY = text("SELECT * FROM users WHERE tg_id = :tg_id")
+
+@db_retry()
 async def get_user_by_tg_id(tg_id: int):
     """Получаем пользователя по Telegram ID"""
     try:
         async with AsyncSessionLocal() as session:
-            result = await session.execute(
-                text("SELECT * FROM users WHERE tg_id = :tg_id"), 
-                {"tg_id": tg_id}
-            )
+            result = await session.execute(USER_BY_TG_ID_QUERY, {"tg_id": tg_id})
             user_data = result.fetchone()
             if user_data:
                 return User(**dict(user_data._mapping))
@@ -73,7 +492,8 @@ async def get_user_by_tg_id(tg_id: int):
         logger.error(f"❌ Ошибка получения пользователя {tg_id}: {e}")
         return None
 
-async def get_or_create_user(tg_id: int, username: str, first_name: str, source: str = 'direct'):
+@db_retry(idempotent=False)
+async def get_or_create_user(tg_id: int, username: str, first_name: str, source: str = 'direct', scenario: str = 'default'):
     """Получаем или создаем пользователя"""
     try:
         async with AsyncSessionLocal() as session:
@@ -86,8 +506,11 @@ async def get_or_create_user(tg_id: int, username: str, first_name: str, source:
                 if user:
                     user.username = username
                     user.first_name = first_name
-                    user.source = source
+                    # Источник - первое касание: повторный /start (в том числе без метки) его не меняет,
+                    # иначе оплаты ушли бы в итоги другого источника, чем регистрация
+                    user.scenario = scenario
                     await session.commit()
+                    bump_user_version(user.id)
                     logger.info(f"✅ Обновлен пользователь: {first_name} (ID: {user.id})")
                     return user
             
@@ -97,11 +520,15 @@ async def get_or_create_user(tg_id: int, username: str, first_name: str, source:
                 username=username,
                 first_name=first_name,
                 source=source,
+                scenario=scenario,
                 status='active'
             )
             session.add(user)
             await session.commit()
             await session.refresh(user)
+            bump_user_version(user.id)
+            status_history.record(user.id, None, user.status)
+            source_rollups.record(source, new_users=1, at=user.created_at)
             logger.info(f"✅ Создан новый пользователь: {first_name} (ID: {user.id})")
             return user
             
@@ -109,6 +536,7 @@ async def get_or_create_user(tg_id: int, username: str, first_name: str, source:
         logger.error(f"❌ Ошибка создания/обновления пользователя: {e}")
         return None
 
+@db_retry(idempotent=False)
 async def create_order(user_id: int, amount: float):
     """Создает заказ"""
     try:
@@ -121,12 +549,14 @@ async def create_order(user_id: int, amount: float):
             session.add(order)
             await session.commit()
             await session.refresh(order)
+            bump_user_version(user_id)
             logger.info(f"💰 Создан заказ #{order.id} для пользователя {user_id}")
             return order
     except Exception as e:
         logger.error(f"❌ Ошибка создания заказа: {e}")
         return None
 
+@db_retry(idempotent=False)
 async def save_quiz_answer(user_id: int, question_id: str, answer: str):
     """Сохраняет ответ на вопрос квиза"""
     try:
@@ -138,38 +568,150 @@ async def save_quiz_answer(user_id: int, question_id: str, answer: str):
             )
             session.add(quiz_answer)
             await session.commit()
+            bump_user_version(user_id)
             logger.info(f"💾 Сохранен ответ: {question_id} = {answer}")
             return True
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения ответа: {e}")
         return False
 
+@db_retry()
 async def update_order_payment(order_id: int, status: str, transaction_id: str = None):
-    """Обновляет статус оплаты заказа"""
+    """Обновляет статус оплаты заказа; True, только если статус изменил именно этот вызов"""
+    try:
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(text("""
+                UPDATE orders
+                SET payment_status = :status, payment_date = :now,
+                    transaction_id = COALESCE(:transaction_id, transaction_id)
+                WHERE id = :order_id AND payment_status <> :status
+                RETURNING user_id
+            """), {"order_id": order_id, "status": status, "transaction_id": transaction_id,
+                   "now": datetime.utcnow()})
+            user_id = result.scalar()
+            await session.commit()
+            if user_id is None:
+                return False
+            bump_user_version(user_id)
+            logger.info(f"✅ Обновлен заказ #{order_id}: статус {status}")
+            return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка обновления заказа #{order_id}: {e}")
+        return False
+
+@db_retry()
+async def mark_orders_paid(order_ids: List[int], transaction_id: str = None):
+    """Переводит заказы в 'paid', если они еще не оплачены.
+
+    Возвращает строки, которые перевел именно этот вызов (None - ошибка базы): вебхук,
+    кнопка «Я оплатил» и сверка могут прийти за одним заказом одновременно, и
+    уведомления об оплате должен отправить только тот, кому досталась строка.
+    """
+    if not order_ids:
+        return []
+    try:
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                text("""
+                    UPDATE orders
+                    SET payment_status = 'paid', payment_date = :now,
+                        transaction_id = COALESCE(:transaction_id, transaction_id)
+                    WHERE id = ANY(:ids) AND payment_status <> 'paid'
+                    RETURNING id, user_id, amount, transaction_id
+                """).bindparams(bindparam("ids", type_=ARRAY(Integer))),
+                {"ids": list(order_ids), "transaction_id": transaction_id, "now": datetime.utcnow()}
+            )
+            updated = result.fetchall()
+            await session.commit()
+            for row in updated:
+                bump_user_version(row.user_id)
+            if updated:
+                logger.info(f"✅ Оплачено заказов: {len(updated)}")
+            return updated
+    except Exception as e:
+        logger.error(f"❌ Ошибка отметки оплаты заказов {order_ids}: {e}")
+        return None
+
+@db_retry()
+async def get_order(order_id: int):
+    """Получает заказ по ID"""
+    try:
+        async with AsyncSessionLocal() as session:
+            return await session.get(Order, order_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения заказа #{order_id}: {e}")
+        return None
+
+@db_retry()
+async def get_order_by_transaction_id(transaction_id: str):
+    """Получает заказ по ID платежа (индекс по transaction_id)"""
+    try:
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                select(Order).where(Order.transaction_id == transaction_id)
+            )
+            return result.scalar_one_or_none()
+    except Exception as e:
+        logger.error(f"❌ Ошибка поиска заказа по платежу {transaction_id}: {e}")
+        return None
+
+@db_retry()
+async def set_order_transaction(order_id: int, transaction_id: str):
+    """Привязывает платеж к заказу, не меняя статус оплаты"""
     try:
         async with AsyncSessionLocal() as session:
             order = await session.get(Order, order_id)
             if order:
-                order.payment_status = status
-                order.payment_date = datetime.utcnow()
-                if transaction_id:
-                    order.transaction_id = transaction_id
+                order.transaction_id = transaction_id
                 await session.commit()
-                logger.info(f"✅ Обновлен заказ #{order_id}: статус {status}")
+                bump_user_version(order.user_id)
                 return True
             return False
     except Exception as e:
-        logger.error(f"❌ Ошибка обновления заказа #{order_id}: {e}")
+        logger.error(f"❌ Ошибка привязки платежа к заказу #{order_id}: {e}")
         return False
 
-async def update_user_status(user_id: int, status: str):
-    """Обновляет статус пользователя"""
+@db_retry()
+async def get_user_by_id(user_id: int):
+    """Получаем пользователя по внутреннему ID"""
+    try:
+        async with AsyncSessionLocal() as session:
+            return await session.get(User, user_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения пользователя #{user_id}: {e}")
+        return None
+
+async def set_user_status_if(session, user_id: int, expected_status: Optional[str], status: str, now: datetime) -> bool:
+    """Меняет статус, только если он все еще expected_status; False - его успел изменить другой запрос"""
+    # Проверка перехода в Python и запись разделены по времени: без условия в UPDATE
+    # два одновременных перехода прошли бы оба
+    result = await session.execute(
+        update(User)
+        .where(User.id == user_id, User.status.is_not_distinct_from(expected_status))
+        .values(status=status, status_updated_at=now)
+    )
+    return result.rowcount == 1
+
+@db_retry(idempotent=False)
+async def update_user_status(user_id: int, status: str, changed_by: int = None):
+    """Обновляет статус пользователя с проверкой допустимого перехода"""
     try:
         async with AsyncSessionLocal() as session:
             user = await session.get(User, user_id)
             if user:
-                user.status = status
+                if user.status == status:
+                    # Например, повторная оплата: статус уже нужный, в историю ничего не пишем
+                    return True
+                if not can_transition(user.status, status):
+                    logger.warning(f"⛔ Недопустимый переход пользователя #{user_id}: {user.status} -> {status}")
+                    return False
+                previous_status, entered_at = user.status, user.status_updated_at
+                if not await set_user_status_if(session, user_id, previous_status, status, datetime.utcnow()):
+                    logger.warning(f"⛔ Статус пользователя #{user_id} изменился во время перехода в {status}")
+                    return False
                 await session.commit()
+                bump_user_version(user_id)
+                status_history.record(user_id, previous_status, status, changed_by, entered_at)
                 logger.info(f"✅ Обновлен статус пользователя #{user_id}: {status}")
                 return True
             return False
@@ -177,6 +719,7 @@ async def update_user_status(user_id: int, status: str):
         logger.error(f"❌ Ошибка обновления пользователя #{user_id}: {e}")
         return False
 
+@db_retry()
 async def update_user_contact(user_id: int, phone: str):
     """Обновляет контактные данные пользователя"""
     try:
@@ -185,6 +728,7 @@ async def update_user_contact(user_id: int, phone: str):
             if user:
                 user.phone = phone
                 await session.commit()
+                bump_user_version(user_id)
                 logger.info(f"✅ Обновлен телефон пользователя #{user_id}")
                 return True
             return False
@@ -192,6 +736,7 @@ async def update_user_contact(user_id: int, phone: str):
         logger.error(f"❌ Ошибка обновления телефона пользователя #{user_id}: {e}")
         return False
 
+@db_retry()
 async def update_user_timezone(user_id: int, timezone: str, city: str = None):
     """Обновляет часовой пояс пользователя"""
     try:
@@ -202,6 +747,7 @@ async def update_user_timezone(user_id: int, timezone: str, city: str = None):
                 if city:
                     user.city = city
                 await session.commit()
+                bump_user_version(user_id)
                 logger.info(f"✅ Обновлен часовой пояс пользователя #{user_id}: {timezone}")
                 return True
             return False
@@ -209,35 +755,813 @@ async def update_user_timezone(user_id: int, timezone: str, city: str = None):
         logger.error(f"❌ Ошибка обновления часового пояса пользователя #{user_id}: {e}")
         return False
 
+USER_ORDERS_QUERY = text("SELECT * FROM orders WHERE user_id = :user_id ORDER BY created_at DESC")
+
+@db_retry()
 async def get_user_orders(user_id: int):
     """Получает заказы пользователя"""
     try:
         async with AsyncSessionLocal() as session:
-            result = await session.execute(
-                text("SELECT * FROM orders WHERE user_id = :user_id ORDER BY created_at DESC"),
-                {"user_id": user_id}
-            )
+            result = await session.execute(USER_ORDERS_QUERY, {"user_id": user_id})
             orders_data = result.fetchall()
             return [Order(**dict(order._mapping)) for order in orders_data]
     except Exception as e:
         logger.error(f"❌ Ошибка получения заказов пользователя {user_id}: {e}")
         return []
 
-async def cleanup_duplicate_users():
-    """Удаляет дублирующихся пользователей"""
+# Пользователь и его последний заказ: поиск по уникальному индексу tg_id
+# и один шаг по индексу (user_id, created_at) вместо чтения всех заказов
+USER_LAST_ORDER_QUERY = text("""
+    SELECT u.*,
+        o.id AS last_order_id,
+        o.amount AS last_order_amount,
+        o.payment_status AS last_order_payment_status,
+        o.payment_date AS last_order_payment_date,
+        o.created_at AS last_order_created_at
+    FROM users u
+    LEFT JOIN LATERAL (
+        SELECT id, amount, payment_status, payment_date, created_at
+        FROM orders
+        WHERE user_id = u.id
+        ORDER BY created_at DESC
+        LIMIT 1
+    ) o ON TRUE
+    WHERE u.tg_id = :tg_id
+""")
+
+# tg_id -> (версия данных, время чтения, пользователь, последний заказ)
+_last_order_cache: "OrderedDict[int, Tuple[int, float, User, Optional[Order]]]" = OrderedDict()
+# tg_id -> id пользователя: переживает вытеснение из кэша, чтобы версию можно было взять до запроса
+_user_id_by_tg_id: "OrderedDict[int, int]" = OrderedDict()
+
+@db_retry()
+async def get_user_with_last_order(tg_id: int) -> Optional[Tuple[User, Optional[Order]]]:
+    """Пользователь и его последний заказ одним запросом; кэш сбрасывается записью в данные пользователя"""
+    cached = _last_order_cache.get(tg_id)
+    # Версию берем до запроса: запись во время запроса не должна закэшироваться как свежая
+    user_id = _user_id_by_tg_id.get(tg_id)
+    version = get_user_version(user_id) if user_id is not None else None
+    bumps_before = _version_bumps
+    if cached:
+        cached_version, cached_at, user, order = cached
+        # Срок жизни страхует от записей в других процессах, о которых версия не знает
+        if cached_version == version and time.monotonic() - cached_at < config.LAST_ORDER_CACHE_TTL:
+            _last_order_cache.move_to_end(tg_id)
+            return user, order
     try:
         async with AsyncSessionLocal() as session:
-            await session.execute(text("""
-                DELETE FROM users 
-                WHERE id NOT IN (
-                    SELECT MIN(id) 
-                    FROM users 
-                    GROUP BY tg_id
+            result = await session.execute(USER_LAST_ORDER_QUERY, {"tg_id": tg_id})
+            row = result.fetchone()
+            if not row:
+                return None
+
+            user_data = dict(row._mapping)
+            order_data = {key[len("last_order_"):]: user_data.pop(key)
+                          for key in list(user_data) if key.startswith("last_order_")}
+            user = User(**user_data)
+            order = Order(user_id=user.id, **order_data) if order_data["id"] is not None else None
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения последнего заказа пользователя {tg_id}: {e}")
+        return None
+
+    if user.id != user_id:
+        # Первое чтение пользователя (или tg_id перешел к другой записи после слияния дублей):
+        # версия до запроса неизвестна. Если во время запроса кто-то писал, запись с версией -1
+        # не совпадет ни с одной версией, и следующее чтение пойдет в базу
+        version = get_user_version(user.id) if _version_bumps == bumps_before else -1
+    _user_id_by_tg_id[tg_id] = user.id
+    _user_id_by_tg_id.move_to_end(tg_id)
+    while len(_user_id_by_tg_id) > config.USER_VERSIONS_SIZE:
+        _user_id_by_tg_id.popitem(last=False)
+    _last_order_cache[tg_id] = (version, time.monotonic(), user, order)
+    _last_order_cache.move_to_end(tg_id)
+    while len(_last_order_cache) > config.LAST_ORDER_CACHE_SIZE:
+        _last_order_cache.popitem(last=False)
+    return user, order
+
+# Таблицы, строки которых ссылаются на users.id
+USER_CHILD_TABLES = ("orders", "quiz_answers", "status_history", "events")
+
+async def cleanup_duplicate_users(batch_size: int = None, on_progress=None) -> Optional[Dict[str, int]]:
+    """Пакетно сливает дубли пользователей по tg_id в самую раннюю запись и закрепляет уникальность"""
+    batch_size = batch_size or config.DEDUP_BATCH_SIZE
+    totals = {"users": 0, **{table: 0 for table in USER_CHILD_TABLES}}
+    try:
+        # Временная таблица живет в рамках одного соединения, поэтому весь проход - на нем
+        async with engine.connect() as conn:
+            await conn.execute(text("""
+                CREATE TEMP TABLE IF NOT EXISTS user_duplicates (
+                    duplicate_id INTEGER PRIMARY KEY,
+                    keep_id INTEGER NOT NULL
                 )
             """))
+            await conn.execute(text("TRUNCATE user_duplicates"))
+            await conn.execute(text("""
+                INSERT INTO user_duplicates (duplicate_id, keep_id)
+                SELECT id, keep_id FROM (
+                    SELECT id,
+                        ROW_NUMBER() OVER w AS rn,
+                        FIRST_VALUE(id) OVER w AS keep_id
+                    FROM users
+                    WHERE tg_id IS NOT NULL
+                    WINDOW w AS (PARTITION BY tg_id ORDER BY id)
+                ) ranked
+                WHERE rn > 1
+            """))
+            total = (await conn.execute(text("SELECT COUNT(*) FROM user_duplicates"))).scalar()
+            await conn.commit()
+            logger.info(f"🧹 Найдено дублей пользователей: {total}")
+
+            after_id = 0
+            while True:
+                chunk = (await conn.execute(text("""
+                    SELECT duplicate_id, keep_id FROM user_duplicates
+                    WHERE duplicate_id > :after_id
+                    ORDER BY duplicate_id
+                    LIMIT :limit
+                """), {"after_id": after_id, "limit": batch_size})).fetchall()
+                if not chunk:
+                    break
+
+                params = {
+                    "duplicate_ids": [row.duplicate_id for row in chunk],
+                    "keep_ids": [row.keep_id for row in chunk],
+                }
+                mapping_sql = "unnest(:duplicate_ids, :keep_ids) AS m(duplicate_id, keep_id)"
+
+                def chunk_query(sql: str):
+                    return text(sql).bindparams(*(
+                        bindparam(name, type_=ARRAY(Integer)) for name in params if f":{name}" in sql
+                    ))
+
+                for table in USER_CHILD_TABLES:
+                    result = await conn.execute(chunk_query(f"""
+                        UPDATE {table} t SET user_id = m.keep_id
+                        FROM {mapping_sql}
+                        WHERE t.user_id = m.duplicate_id
+                    """), params)
+                    totals[table] += result.rowcount
+
+                # Контакты дубля не теряем: заполняем пустые поля сохраняемой записи
+                await conn.execute(chunk_query(f"""
+                    UPDATE users k SET
+                        username = COALESCE(k.username, d.username),
+                        first_name = COALESCE(k.first_name, d.first_name),
+                        phone = COALESCE(k.phone, d.phone),
+                        city = COALESCE(k.city, d.city),
+                        timezone = COALESCE(k.timezone, d.timezone),
+                        source = COALESCE(k.source, d.source)
+                    FROM (
+                        SELECT DISTINCT ON (m.keep_id) m.keep_id, u.*
+                        FROM {mapping_sql}
+                        JOIN users u ON u.id = m.duplicate_id
+                        ORDER BY m.keep_id, u.id DESC
+                    ) d
+                    WHERE k.id = d.keep_id
+                """), params)
+
+                # Отчеты дублей собраны по их неполным данным - не переносим
+                await conn.execute(chunk_query(
+                    "DELETE FROM report_files WHERE user_id = ANY(:duplicate_ids)"
+                ), params)
+
+                # Удаляем дубли и сразу снимаем их со счетчиков сводки по этапам
+                result = await conn.execute(chunk_query("""
+                    WITH deleted AS (
+                        DELETE FROM users u
+                        WHERE u.id = ANY(:duplicate_ids)
+                        RETURNING u.status
+                    ), counts AS (
+                        SELECT status, COUNT(*) AS cnt FROM deleted GROUP BY status
+                    ), adjusted AS (
+                        UPDATE status_stats s SET users_count = GREATEST(s.users_count - c.cnt, 0)
+                        FROM counts c
+                        WHERE s.status = c.status
+                    )
+                    SELECT COALESCE(SUM(cnt), 0) FROM counts
+                """), params)
+                totals["users"] += result.scalar()
+                await conn.commit()
+
+                for keep_id in set(params["keep_ids"]):
+                    bump_user_version(keep_id)
+                after_id = chunk[-1].duplicate_id
+                if on_progress:
+                    try:
+                        await on_progress(totals["users"], total)
+                    except Exception as e:
+                        logger.warning(f"⚠️ Ошибка обновления прогресса очистки дублей: {e}")
+
+            await conn.execute(text("DROP TABLE user_duplicates"))
+            await conn.commit()
+
+        invalidate_status_stats()
+        await ensure_unique_tg_id()
+        logger.info(f"✅ Дублирующиеся пользователи очищены: {totals}")
+        return totals
+    except Exception as e:
+        logger.error(f"❌ Ошибка очистки дублирующихся пользователей: {e}")
+        return None
+
+async def ensure_unique_tg_id():
+    """Создает уникальный индекс по tg_id, если его еще нет"""
+    async with engine.connect() as conn:
+        exists = (await conn.execute(text("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_index i
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                WHERE i.indrelid = 'users'::regclass
+                    AND i.indisunique AND i.indisvalid AND i.indnatts = 1 AND a.attname = 'tg_id'
+            )
+        """))).scalar()
+    if exists:
+        return
+
+    # CONCURRENTLY не блокирует запись в users, но требует работы вне транзакции
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        # Прерванная сборка CONCURRENTLY оставляет невалидный индекс: он не проверяет
+        # уникальность и мешает создать индекс с тем же именем
+        await conn.execute(text("DROP INDEX CONCURRENTLY IF EXISTS ix_users_tg_id_unique"))
+        await conn.execute(text("CREATE UNIQUE INDEX CONCURRENTLY ix_users_tg_id_unique ON users (tg_id)"))
+    logger.info("🔒 Создан уникальный индекс users.tg_id")
+
+USER_CARD_QUERY = text("""
+    SELECT u.*,
+        COALESCE((
+            SELECT json_agg(json_build_object(
+                'id', o.id,
+                'amount', o.amount,
+                'payment_status', o.payment_status,
+                'created_at', o.created_at
+            ) ORDER BY o.created_at DESC)
+            FROM orders o WHERE o.user_id = u.id
+        ), '[]') AS card_orders,
+        COALESCE((
+            SELECT json_agg(json_build_object(
+                'question_id', q.question_id,
+                'answer', q.answer
+            ) ORDER BY q.id)
+            FROM quiz_answers q WHERE q.user_id = u.id
+        ), '[]') AS card_quiz
+    FROM users u
+    WHERE u.id = :user_id
+""").columns(card_orders=JSON, card_quiz=JSON)
+
+@db_retry()
+async def get_user_card_data(user_id: int) -> Optional[Tuple[User, List[Order], List[Tuple[str, str]]]]:
+    """Получает пользователя, его заказы и ответы квиза одним запросом"""
+    try:
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(USER_CARD_QUERY, {"user_id": user_id})
+            row = result.fetchone()
+            if not row:
+                return None
+
+            user_data = dict(row._mapping)
+            orders_data = user_data.pop("card_orders") or []
+            quiz_data = user_data.pop("card_quiz") or []
+
+            orders = []
+            for order_data in orders_data:
+                if order_data.get("created_at"):
+                    order_data["created_at"] = datetime.fromisoformat(order_data["created_at"])
+                orders.append(Order(user_id=user_id, **order_data))
+
+            quiz_answers = [(answer["question_id"], answer["answer"]) for answer in quiz_data]
+            return User(**user_data), orders, quiz_answers
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения карточки пользователя {user_id}: {e}")
+        return None
+
+# Запросы горячего пути: подготавливаются на каждом соединении при старте
+WARMUP_STATEMENTS = (
+    (USER_BY_TG_ID_QUERY, {"tg_id": 0}),
+    (USER_ORDERS_QUERY, {"user_id": 0}),
+    (USER_CARD_QUERY, {"user_id": 0}),
+    (USER_LAST_ORDER_QUERY, {"tg_id": 0}),
+)
+
+async def warm_pool(connections: int = None) -> int:
+    """Открывает соединения пула параллельно и готовит на них горячие запросы; возвращает число соединений"""
+    connections = connections or config.DB_POOL_SIZE
+    opened = []
+    try:
+        # Соединения держим открытыми одновременно, иначе пул отдаст одно и то же
+        results = await asyncio.gather(*(engine.connect().start() for _ in range(connections)),
+                                       return_exceptions=True)
+        opened = [conn for conn in results if not isinstance(conn, BaseException)]
+        if len(opened) < connections:
+            errors = [conn for conn in results if isinstance(conn, BaseException)]
+            logger.warning(f"⚠️ Прогрев пула: открыто {len(opened)} из {connections} соединений: {errors[0]}")
+
+        async def prepare(conn):
+            for statement, params in WARMUP_STATEMENTS:
+                await conn.execute(statement, params)
+            await conn.rollback()
+
+        await asyncio.gather(*(prepare(conn) for conn in opened))
+        return len(opened)
+    except Exception as e:
+        logger.error(f"❌ Ошибка прогрева пула соединений: {e}")
+        return 0
+    finally:
+        await asyncio.gather(*(conn.close() for conn in opened), return_exceptions=True)
+
+@db_retry()
+async def get_bulk_targets(user_ids: List[int] = None, status: str = None):
+    """Выбирает клиентов для массового действия по списку ID или по статусу"""
+    try:
+        async with AsyncSessionLocal() as session:
+            if user_ids is not None:
+                result = await session.execute(
+                    text("SELECT id, tg_id, first_name FROM users WHERE id = ANY(:ids)")
+                    .bindparams(bindparam("ids", type_=ARRAY(Integer))),
+                    {"ids": list(user_ids)}
+                )
+            else:
+                result = await session.execute(
+                    text("SELECT id, tg_id, first_name FROM users WHERE status = :status"),
+                    {"status": status}
+                )
+            return result.fetchall()
+    except Exception as e:
+        logger.error(f"❌ Ошибка выбора клиентов для массового действия: {e}")
+        return []
+
+async def bulk_update_user_status(user_ids: List[int], status: str, changed_by: int = None):
+    """Обновляет статус группы пользователей одним запросом, пропуская недопустимые переходы"""
+    try:
+        sources = allowed_sources(status)
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                text("""
+                    WITH previous AS (
+                        SELECT id, status, status_updated_at
+                        FROM users
+                        WHERE id = ANY(:ids)
+                          AND (CAST(:any_source AS BOOLEAN) OR status = ANY(:sources))
+                          AND status IS DISTINCT FROM :status
+                        FOR UPDATE
+                    )
+                    UPDATE users u
+                    SET status = :status, status_updated_at = :now
+                    FROM previous
+                    WHERE u.id = previous.id
+                    RETURNING u.id, u.tg_id, u.first_name,
+                              previous.status AS previous_status,
+                              previous.status_updated_at AS previous_status_updated_at
+                """).bindparams(
+                    bindparam("ids", type_=ARRAY(Integer)),
+                    bindparam("sources", type_=ARRAY(String))
+                ),
+                {
+                    "status": status,
+                    "ids": list(user_ids),
+                    "any_source": sources is None,
+                    "sources": sources or [],
+                    "now": datetime.utcnow(),
+                }
+            )
+            updated = result.fetchall()
+            await session.commit()
+            for row in updated:
+                bump_user_version(row.id)
+                status_history.record(row.id, row.previous_status, status, changed_by, row.previous_status_updated_at)
+            logger.info(f"✅ Массово обновлен статус {len(updated)} из {len(user_ids)} пользователей: {status}")
+            return updated
+    except Exception as e:
+        logger.error(f"❌ Ошибка массового обновления статуса: {e}")
+        return []
+
+# Кэш сводки по статусам, сбрасывается при записи изменений статусов
+_status_stats_cache: Optional[dict] = None
+_status_stats_loaded_at = 0.0
+
+def invalidate_status_stats():
+    """Сбрасывает кэш сводки по статусам"""
+    global _status_stats_cache
+    _status_stats_cache = None
+
+async def get_status_stats():
+    """Возвращает предрассчитанную сводку по этапам воронки"""
+    global _status_stats_cache, _status_stats_loaded_at
+    # Срок жизни: сводку меняют и сбросы истории в других процессах, о которых этот не знает
+    if _status_stats_cache is not None and time.monotonic() - _status_stats_loaded_at < config.STATUS_STATS_CACHE_TTL:
+        return _status_stats_cache
+    try:
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(select(StatusStats))
+            _status_stats_cache = {stats.status: stats for stats in result.scalars().all()}
+            _status_stats_loaded_at = time.monotonic()
+            return _status_stats_cache
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения сводки по статусам: {e}")
+        return {}
+
+@db_retry()
+async def get_users_by_status(status: str, older_than: datetime = None,
+                              after: Tuple[datetime, int] = None, limit: int = 10):
+    """Страница клиентов в статусе, от дольше всех ожидающих (keyset по индексу статуса)"""
+    try:
+        async with AsyncSessionLocal() as session:
+            query = (
+                select(User.id, User.first_name, User.username, User.status_updated_at)
+                .where(User.status == status)
+                .order_by(User.status_updated_at, User.id)
+                .limit(limit)
+            )
+            if older_than:
+                query = query.where(User.status_updated_at <= older_than)
+            if after:
+                query = query.where(tuple_(User.status_updated_at, User.id) > tuple_(*after))
+            result = await session.execute(query)
+            return result.fetchall()
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения клиентов в статусе {status}: {e}")
+        return []
+
+@db_retry()
+async def get_report_file(user_id: int, version: str) -> Optional[str]:
+    """Возвращает file_id ранее загруженного отчета этой версии"""
+    try:
+        async with AsyncSessionLocal() as session:
+            report = await session.get(ReportFile, (user_id, version))
+            return report.file_id if report else None
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения отчета пользователя {user_id}: {e}")
+        return None
+
+@db_retry()
+async def save_report_file(user_id: int, version: str, file_id: str):
+    """Запоминает file_id загруженного отчета"""
+    try:
+        async with AsyncSessionLocal() as session:
+            stmt = pg_insert(ReportFile).values(user_id=user_id, version=version, file_id=file_id,
+                                                created_at=datetime.utcnow())
+            await session.execute(stmt.on_conflict_do_update(
+                index_elements=[ReportFile.user_id, ReportFile.version],
+                set_={"file_id": stmt.excluded.file_id, "created_at": stmt.excluded.created_at}
+            ))
             await session.commit()
-            logger.info("✅ Дублирующиеся пользователи очищены")
             return True
     except Exception as e:
-        logger.error(f"❌ Ошибка очистки дублирующихся пользователей: {e}")
+        logger.error(f"❌ Ошибка сохранения отчета пользователя {user_id}: {e}")
+        return False
+
+@db_retry()
+async def delete_report_file(user_id: int, version: str):
+    """Забывает file_id, который Telegram больше не принимает"""
+    try:
+        async with AsyncSessionLocal() as session:
+            report = await session.get(ReportFile, (user_id, version))
+            if report:
+                await session.delete(report)
+                await session.commit()
+            return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка удаления отчета пользователя {user_id}: {e}")
+        return False
+
+@db_retry()
+async def get_managers():
+    """Возвращает всех менеджеров"""
+    try:
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(select(Manager))
+            return result.scalars().all()
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения менеджеров: {e}")
+        return None
+
+@db_retry()
+async def save_manager(tg_id: int, role: str = 'manager', name: str = None):
+    """Добавляет менеджера или меняет его роль"""
+    try:
+        async with AsyncSessionLocal() as session:
+            manager = await session.get(Manager, tg_id)
+            if manager:
+                manager.role = role
+                if name:
+                    manager.name = name
+            else:
+                session.add(Manager(tg_id=tg_id, role=role, name=name))
+            await session.commit()
+            logger.info(f"✅ Менеджер {tg_id} сохранен с ролью {role}")
+            return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения менеджера {tg_id}: {e}")
         return False
+
+@db_retry()
+async def delete_manager(tg_id: int):
+    """Удаляет менеджера"""
+    try:
+        async with AsyncSessionLocal() as session:
+            manager = await session.get(Manager, tg_id)
+            if manager:
+                await session.delete(manager)
+                await session.commit()
+                logger.info(f"✅ Менеджер {tg_id} удален")
+                return True
+            return False
+    except Exception as e:
+        logger.error(f"❌ Ошибка удаления менеджера {tg_id}: {e}")
+        return False
+
+@db_retry()
+async def get_pending_orders_batch(after_id: int = 0, limit: int = 500, created_before: datetime = None):
+    """Пакет ожидающих оплаты заказов с привязанным платежом (keyset по id)"""
+    try:
+        async with AsyncSessionLocal() as session:
+            query = (
+                select(Order.id, Order.user_id, Order.amount, Order.transaction_id)
+                .where(Order.payment_status == 'pending', Order.transaction_id.isnot(None), Order.id > after_id)
+                .order_by(Order.id)
+                .limit(limit)
+            )
+            if created_before:
+                query = query.where(Order.created_at <= created_before)
+            result = await session.execute(query)
+            return result.fetchall()
+    except Exception as e:
+        logger.error(f"❌ Ошибка выборки ожидающих заказов: {e}")
+        return []
+
+async def bulk_update_order_payment(order_ids: List[int], status: str):
+    """Переводит ожидающие заказы в новый статус оплаты одним запросом"""
+    if not order_ids:
+        return []
+    try:
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                text("""
+                    UPDATE orders
+                    SET payment_status = :status, payment_date = :now
+                    WHERE id = ANY(:ids) AND payment_status = 'pending'
+                    RETURNING id, user_id, amount, transaction_id
+                """).bindparams(bindparam("ids", type_=ARRAY(Integer))),
+                {"status": status, "ids": list(order_ids), "now": datetime.utcnow()}
+            )
+            updated = result.fetchall()
+            await session.commit()
+            for row in updated:
+                bump_user_version(row.user_id)
+            logger.info(f"✅ Массово обновлено {len(updated)} заказов: {status}")
+            return updated
+    except Exception as e:
+        logger.error(f"❌ Ошибка массового обновления заказов: {e}")
+        return []
+
+@db_retry()
+async def get_source_totals(days: int = 30, referrers: bool = False, limit: int = 15):
+    """Итоги по источникам (или рефереерам) из дневных роллапов"""
+    try:
+        async with AsyncSessionLocal() as session:
+            key = SourceRollup.referrer_tg_id if referrers else SourceRollup.source
+            query = (
+                select(
+                    key.label("key"),
+                    func.sum(SourceRollup.new_users).label("new_users"),
+                    func.sum(SourceRollup.payments).label("payments"),
+                    func.sum(SourceRollup.revenue).label("revenue"),
+                )
+                .where(SourceRollup.granularity == 'day',
+                       SourceRollup.bucket_start >= datetime.utcnow() - timedelta(days=days))
+                .group_by(key)
+                .order_by(func.sum(SourceRollup.payments).desc(), func.sum(SourceRollup.new_users).desc())
+                .limit(limit)
+            )
+            if referrers:
+                query = query.where(SourceRollup.referrer_tg_id != 0)
+            result = await session.execute(query)
+            return result.fetchall()
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения итогов по источникам: {e}")
+        return []
+
+ROLLUP_SOURCE_SQL = """
+    CASE WHEN u.source LIKE 'ref\\_%' THEN 'ref' ELSE LEFT(COALESCE(u.source, 'direct'), 100) END
+"""
+ROLLUP_REFERRER_SQL = """
+    CASE WHEN u.source ~ '^ref_[0-9]{1,18}$' THEN CAST(SUBSTRING(u.source FROM 5) AS BIGINT) ELSE 0 END
+"""
+
+async def backfill_source_rollups(batch_size: int = 50000, on_progress=None):
+    """Пересобирает роллапы по источникам из истории пакетами по диапазонам id"""
+    try:
+        await source_rollups.flush()
+        totals = {"users": 0, "orders": 0}
+        async with AsyncSessionLocal() as session:
+            await session.execute(text("TRUNCATE source_rollups"))
+            await session.commit()
+
+        for table, metric_sql, join_sql, time_column, counter in (
+            ("users", "COUNT(*), 0, 0", "users u", "u.created_at", "users"),
+            ("orders", "0, COUNT(*), COALESCE(SUM(o.amount), 0)",
+             "orders o JOIN users u ON u.id = o.user_id", "COALESCE(o.payment_date, o.created_at)", "orders"),
+        ):
+            alias = "u" if table == "users" else "o"
+            paid_filter = "" if table == "users" else "AND o.payment_status = 'paid'"
+            async with AsyncSessionLocal() as session:
+                max_id = (await session.execute(text(f"SELECT COALESCE(MAX(id), 0) FROM {table}"))).scalar()
+
+            for start_id in range(0, max_id, batch_size):
+                async with AsyncSessionLocal() as session:
+                    for granularity in ("hour", "day"):
+                        result = await session.execute(text(f"""
+                            INSERT INTO source_rollups
+                                (granularity, bucket_start, source, referrer_tg_id, new_users, payments, revenue)
+                            SELECT '{granularity}', date_trunc('{granularity}', {time_column}),
+                                   {ROLLUP_SOURCE_SQL}, {ROLLUP_REFERRER_SQL}, {metric_sql}
+                            FROM {join_sql}
+                            WHERE {alias}.id > :start_id AND {alias}.id <= :end_id {paid_filter}
+                            GROUP BY 2, 3, 4
+                            ON CONFLICT (granularity, bucket_start, source, referrer_tg_id) DO UPDATE SET
+                                new_users = source_rollups.new_users + EXCLUDED.new_users,
+                                payments = source_rollups.payments + EXCLUDED.payments,
+                                revenue = source_rollups.revenue + EXCLUDED.revenue
+                        """), {"start_id": start_id, "end_id": start_id + batch_size})
+                    await session.commit()
+                totals[counter] = min(start_id + batch_size, max_id)
+                if on_progress:
+                    await on_progress(table, totals[counter], max_id)
+
+        logger.info(f"✅ Роллапы по источникам пересобраны: {totals}")
+        return totals
+    except Exception as e:
+        logger.error(f"❌ Ошибка пересборки роллапов по источникам: {e}")
+        return None
+
+# ========== СЕКЦИИ И АРХИВ ==========
+
+# Таблицы, секционированные по месяцам created_at
+PARTITIONED_TABLES = ("quiz_answers",)
+
+def month_start(moment: datetime) -> datetime:
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+def partition_name(table: str, month: datetime) -> str:
+    return f"{table}_y{month:%Y}m{month:%m}"
+
+# Секции, которые последний запуск ensure_partitions не смог создать: имя -> ошибка
+failed_partitions: Dict[str, str] = {}
+
+async def _create_month_partition(conn, table: str, name: str, month: datetime, next_month: datetime) -> int:
+    """Создает секцию месяца, перенося его строки из секции по умолчанию; возвращает число перенесенных"""
+    bounds = {"start": month, "end": next_month}
+    month_filter = "created_at >= :start AND created_at < :end"
+    # Пока в DEFAULT лежат строки месяца, CREATE ... PARTITION OF для него падает:
+    # убираем их во временную таблицу и возвращаем уже в новую секцию, все в одной транзакции
+    stranded = (await conn.execute(text(
+        f"SELECT EXISTS (SELECT 1 FROM {table}_default WHERE {month_filter})"
+    ), bounds)).scalar()
+    if stranded:
+        await conn.execute(text(
+            f"CREATE TEMP TABLE stranded_rows ON COMMIT DROP AS SELECT * FROM {table}_default WHERE {month_filter}"
+        ), bounds)
+        await conn.execute(text(f"DELETE FROM {table}_default WHERE {month_filter}"), bounds)
+    await conn.execute(text(
+        f"CREATE TABLE {name} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month:%Y-%m-%d}')"
+    ))
+    if not stranded:
+        return 0
+    result = await conn.execute(text(f"INSERT INTO {table} SELECT * FROM stranded_rows"))
+    return result.rowcount
+
+async def ensure_partitions(months_ahead: int = None) -> int:
+    """Создает месячные секции с текущего месяца на months_ahead вперед; возвращает число новых"""
+    months_ahead = config.PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    created = 0
+    failed_partitions.clear()
+    for table in PARTITIONED_TABLES:
+        # Секция по умолчанию - страховка, если задача не успела создать нужный месяц
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+        except Exception as e:
+            failed_partitions[f"{table}_default"] = str(e)
+            logger.error(f"❌ Ошибка создания секции {table}_default: {e}")
+            continue
+
+        month = month_start(datetime.utcnow())
+        for _ in range(months_ahead + 1):
+            name, next_month = partition_name(table, month), add_months(month, 1)
+            try:
+                async with engine.begin() as conn:
+                    exists = (await conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name})).scalar()
+                    if not exists:
+                        moved = await _create_month_partition(conn, table, name, month, next_month)
+                        created += 1
+                        if moved:
+                            logger.warning(f"⚠️ В секцию {name} перенесено строк из секции по умолчанию: {moved}")
+            except Exception as e:
+                failed_partitions[name] = str(e)
+                logger.error(f"❌ Ошибка создания секции {name}: {e}")
+            month = next_month
+    if created:
+        logger.info(f"🗂 Создано секций: {created}")
+    return created
+
+async def check_partitions():
+    """Проверка для /readyz (необязательная): последний запуск ensure_partitions создал все секции"""
+    if failed_partitions:
+        raise RuntimeError(f"секции не созданы: {', '.join(sorted(failed_partitions))}")
+
+def _write_archive_rows(path: Path, columns: List[str], rows: List[tuple]):
+    """Дописывает строки в сжатый CSV; gzip допускает дозапись новыми блоками"""
+    is_new = not path.exists()
+    with gzip.open(path, "at", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        if is_new:
+            writer.writerow(columns)
+        writer.writerows(rows)
+
+async def _archive_partition(table: str, name: str, attached: bool) -> int:
+    """Отсоединяет месячную секцию, выгружает ее в сжатый CSV и удаляет; возвращает число строк"""
+    if attached:
+        # После отсоединения в таблицу больше никто не пишет, выгрузка не мешает вставкам
+        async with engine.begin() as conn:
+            await conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+
+    path = Path(config.ARCHIVE_DIR) / f"{name}.csv.gz"
+    partial = path.with_suffix(".partial")
+    async with engine.connect() as conn:
+        raw = await conn.get_raw_connection()
+        with gzip.open(partial, "wb") as file:
+            async def write(chunk: bytes):
+                await asyncio.to_thread(file.write, chunk)
+            status = await raw.driver_connection.copy_from_table(name, output=write, format="csv", header=True)
+    rows = int(status.split()[-1])
+    # Таблица удаляется только после того, как архив целиком на диске
+    partial.replace(path)
+    async with engine.begin() as conn:
+        await conn.execute(text(f"DROP TABLE {name}"))
+    logger.info(f"📦 Секция {name} перенесена в архив {path}: {rows} строк")
+    return rows
+
+async def archive_cold_data(horizon_months: int = None, batch_size: int = None) -> Optional[Dict[str, int]]:
+    """Переносит в сжатые архивы данные старше горизонта: месячные секции квиза целиком, заказы пакетами"""
+    horizon_months = horizon_months or config.ARCHIVE_AFTER_MONTHS
+    batch_size = batch_size or config.ARCHIVE_BATCH_SIZE
+    if horizon_months <= 0:
+        logger.warning("⚠️ Архивация отключена: не задан ARCHIVE_AFTER_MONTHS")
+        return None
+    horizon = add_months(month_start(datetime.utcnow()), -horizon_months)
+    totals = {table: 0 for table in PARTITIONED_TABLES}
+    totals["orders"] = 0
+    try:
+        Path(config.ARCHIVE_DIR).mkdir(parents=True, exist_ok=True)
+
+        for table in PARTITIONED_TABLES:
+            # И подключенные секции, и отсоединенные прошлым прерванным проходом
+            async with engine.connect() as conn:
+                result = await conn.execute(text("""
+                    SELECT c.relname, i.inhparent IS NOT NULL AS attached
+                    FROM pg_class c
+                    LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+                    WHERE c.relkind = 'r' AND c.relname ~ ('^' || :table || '_y[0-9]{4}m[0-9]{2}$')
+                    ORDER BY c.relname
+                """), {"table": table})
+                partitions = result.fetchall()
+            for name, attached in partitions:
+                month = datetime(int(name[-7:-3]), int(name[-2:]), 1)
+                if add_months(month, 1) <= horizon:
+                    totals[table] += await _archive_partition(table, name, attached)
+
+        # Заказы не секционированы (глобальная уникальность transaction_id), поэтому переносятся
+        # пакетами. Оплаченные остаются: на них держатся отчеты и выручка по источникам
+        path = Path(config.ARCHIVE_DIR) / f"orders_{datetime.utcnow():%Y%m%d}.csv.gz"
+        while True:
+            async with engine.begin() as conn:
+                result = await conn.execute(text("""
+                    DELETE FROM orders WHERE id IN (
+                        SELECT id FROM orders
+                        WHERE created_at < :horizon AND payment_status <> 'paid'
+                        ORDER BY id
+                        LIMIT :batch_size
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING *
+                """), {"horizon": horizon, "batch_size": batch_size})
+                columns = list(result.keys())
+                rows = result.fetchall()
+                # Запись в архив до коммита: при ошибке удаление откатится
+                if rows:
+                    await asyncio.to_thread(_write_archive_rows, path, columns, [tuple(row) for row in rows])
+            for user_id in {row.user_id for row in rows}:
+                bump_user_version(user_id)
+            totals["orders"] += len(rows)
+            if len(rows) < batch_size:
+                break
+
+        logger.info(f"📦 Архивация старше {horizon:%Y-%m-%d}: {totals}")
+        return totals
+    except Exception as e:
+        logger.error(f"❌ Ошибка архивации старых данных: {e}")
+        return None
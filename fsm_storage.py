@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# (ключ, состояние, данные) - вызывается один раз для простаивающей сессии
+NudgeCallback = Callable[[StorageKey, Optional[str], Dict[str, Any]], Awaitable[None]]
+
+@dataclass
+class TTLRecord:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    touched_at: float = 0.0
+
+class TTLMemoryStorage(BaseStorage):
+    """Хранилище FSM в памяти процесса с вытеснением простаивающих сессий"""
+
+    def __init__(self, ttl_seconds: float = None, nudge_after_seconds: float = None,
+                 on_nudge: Optional[NudgeCallback] = None):
+        self.ttl = ttl_seconds if ttl_seconds is not None else config.FSM_TTL_MINUTES * 60
+        self.nudge_after = nudge_after_seconds if nudge_after_seconds is not None else config.FSM_NUDGE_AFTER_MINUTES * 60
+        self.on_nudge = on_nudge
+        # Обе очереди упорядочены по времени последнего обращения: самые старые - в начале
+        self._active: "OrderedDict[StorageKey, TTLRecord]" = OrderedDict()
+        self._nudged: "OrderedDict[StorageKey, TTLRecord]" = OrderedDict()
+        self._state_counts: Counter = Counter()
+        self.evicted = 0
+        self.nudges_sent = 0
+
+    def _touch(self, key: StorageKey) -> Optional[TTLRecord]:
+        """Переносит запись в конец очереди активных и обновляет время обращения"""
+        record = self._active.pop(key, None) or self._nudged.pop(key, None)
+        if record is not None:
+            record.touched_at = time.monotonic()
+            self._active[key] = record
+        return record
+
+    def _get_or_create(self, key: StorageKey) -> TTLRecord:
+        record = self._touch(key)
+        if record is None:
+            record = self._active[key] = TTLRecord(touched_at=time.monotonic())
+        return record
+
+    def _drop_if_empty(self, key: StorageKey, record: TTLRecord):
+        """Пустые сессии не храним вовсе"""
+        if record.state is None and not record.data:
+            self._active.pop(key, None)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        record = self._get_or_create(key)
+        if record.state is not None:
+            self._state_counts[record.state] -= 1
+            if not self._state_counts[record.state]:
+                del self._state_counts[record.state]
+        if state is not None:
+            self._state_counts[state] += 1
+        record.state = state
+        self._drop_if_empty(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self._touch(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        record = self._get_or_create(key)
+        record.data = dict(data)
+        self._drop_if_empty(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self._touch(key)
+        return dict(record.data) if record else {}
+
+    async def close(self) -> None:
+        pass
+
+    def _evict(self, key: StorageKey, record: TTLRecord):
+        if record.state is not None:
+            self._state_counts[record.state] -= 1
+            if not self._state_counts[record.state]:
+                del self._state_counts[record.state]
+        self.evicted += 1
+
+    async def sweep(self):
+        """Вытесняет простаивающие сессии; каждая запись просматривается O(1) раз"""
+        now = time.monotonic()
+        evict_before = now - self.ttl
+        nudge = self.on_nudge is not None and 0 < self.nudge_after < self.ttl
+        nudge_before = now - self.nudge_after if nudge else evict_before
+        to_nudge = []
+        evicted_before = self.evicted
+
+        while self._active:
+            key, record = next(iter(self._active.items()))
+            if record.touched_at >= nudge_before:
+                break
+            del self._active[key]
+            if nudge and record.touched_at >= evict_before:
+                self._nudged[key] = record
+                to_nudge.append((key, record.state, dict(record.data)))
+            else:
+                self._evict(key, record)
+
+        while self._nudged:
+            key, record = next(iter(self._nudged.items()))
+            if record.touched_at >= evict_before:
+                break
+            del self._nudged[key]
+            self._evict(key, record)
+
+        if to_nudge:
+            results = await asyncio.gather(*(self.on_nudge(*args) for args in to_nudge), return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.warning(f"⚠️ Ошибка напоминания о незавершенном шаге: {result}")
+            self.nudges_sent += len(to_nudge)
+
+        if self.evicted > evicted_before or to_nudge:
+            logger.info(f"🧹 FSM: вытеснено {self.evicted - evicted_before}, напоминаний {len(to_nudge)}, "
+                        f"активных сессий {len(self)}")
+
+    def state_counts(self) -> Dict[str, int]:
+        """Текущее число сессий в каждом состоянии"""
+        return dict(self._state_counts)
+
+    def __len__(self) -> int:
+        return len(self._active) + len(self._nudged)
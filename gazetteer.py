@@ -0,0 +1,129 @@
+import csv
+import logging
+import re
+import sys
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class City:
+    name: str
+    timezone: str
+    population: int
+
+def normalize(text: str) -> str:
+    """Ключ поиска: нижний регистр, ё -> е, только буквы и цифры"""
+    return re.sub(r"[^\w]|_", "", text.lower().replace("ё", "е"))
+
+def trigrams(key: str) -> set:
+    padded = f"^{key}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+# Справочник лежит рядом с модулем: бот могут запускать не из каталога проекта
+CITIES_PATH = Path(__file__).resolve().parent / "cities.csv"
+
+class Gazetteer:
+    """Офлайн-справочник городов: точное совпадение, префикс и нечеткий поиск по триграммам"""
+
+    def __init__(self, path: Path = CITIES_PATH):
+        self.path = path
+        self.cities: List[City] = []
+        # Нормализованные названия и синонимы (отсортированы) и город для каждого
+        self._keys: List[str] = []
+        self._key_city = array("H")
+        self._exact: Dict[str, int] = {}
+        # Триграмма -> номера ключей; array вместо list в разы компактнее
+        self._postings: Dict[str, array] = {}
+        self._key_trigrams = array("B")
+
+    def load(self):
+        """Загружает справочник и строит индексы"""
+        entries = []
+        with open(self.path, encoding="utf-8") as file:
+            for row in csv.DictReader(file):
+                city_index = len(self.cities)
+                self.cities.append(City(row["name"], row["timezone"], int(row["population"] or 0)))
+                for name in [row["name"], *filter(None, row["aliases"].split("|"))]:
+                    key = normalize(name)
+                    if key:
+                        entries.append((key, city_index))
+
+        # При совпадении синонимов побеждает более крупный город
+        entries.sort(key=lambda entry: (entry[0], -self.cities[entry[1]].population))
+        postings: Dict[str, List[int]] = {}
+        for key, city_index in entries:
+            if key in self._exact:
+                continue
+            key_index = len(self._keys)
+            self._exact[key] = city_index
+            self._keys.append(key)
+            self._key_city.append(city_index)
+            grams = trigrams(key)
+            self._key_trigrams.append(min(len(grams), 255))
+            for gram in grams:
+                postings.setdefault(gram, []).append(key_index)
+        self._postings = {gram: array("H", indexes) for gram, indexes in postings.items()}
+
+        logger.info(f"🗺 Справочник городов: {len(self.cities)} городов, {len(self._keys)} названий, "
+                    f"индекс {self.memory_bytes() / 1024:.0f} КБ")
+
+    def search(self, query: str, limit: int = 3, min_score: float = 0.35) -> List[Tuple[City, float]]:
+        """Города, похожие на запрос, с оценкой от 0 до 1 (1 - точное совпадение)"""
+        key = normalize(query)
+        if not key:
+            return []
+
+        city_index = self._exact.get(key)
+        if city_index is not None:
+            return [(self.cities[city_index], 1.0)]
+
+        scores: Dict[int, float] = {}
+
+        # Начало названия: "ростов" -> "ростовнадону"
+        position = bisect_left(self._keys, key)
+        while position < len(self._keys) and self._keys[position].startswith(key):
+            city_index = self._key_city[position]
+            score = 0.8 + 0.2 * len(key) / len(self._keys[position])
+            scores[city_index] = max(scores.get(city_index, 0.0), score)
+            position += 1
+
+        # Опечатки: коэффициент Дайса по общим триграммам
+        query_grams = trigrams(key)
+        shared = Counter()
+        for gram in query_grams:
+            for key_index in self._postings.get(gram, ()):
+                shared[key_index] += 1
+        for key_index, common in shared.items():
+            score = 2 * common / (len(query_grams) + self._key_trigrams[key_index])
+            city_index = self._key_city[key_index]
+            if score >= min_score and score > scores.get(city_index, 0.0):
+                scores[city_index] = score
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -self.cities[item[0]].population))
+        return [(self.cities[city_index], round(score, 3)) for city_index, score in ranked[:limit]]
+
+    def resolve(self, query: str, min_score: float = 0.6, min_margin: float = 0.15) -> Optional[City]:
+        """Город, если совпадение уверенное: высокая оценка и заметный отрыв от второго"""
+        matches = self.search(query, limit=2)
+        if not matches or matches[0][1] < min_score:
+            return None
+        if len(matches) > 1 and matches[0][1] - matches[1][1] < min_margin and matches[0][1] < 1.0:
+            return None
+        return matches[0][0]
+
+    def memory_bytes(self) -> int:
+        """Память, занятая индексами (без самих записей о городах)"""
+        total = sys.getsizeof(self._keys) + sum(sys.getsizeof(key) for key in self._keys)
+        total += sys.getsizeof(self._key_city) + sys.getsizeof(self._key_trigrams)
+        total += sys.getsizeof(self._exact)
+        total += sys.getsizeof(self._postings)
+        total += sum(sys.getsizeof(gram) + sys.getsizeof(indexes) for gram, indexes in self._postings.items())
+        return total
+
+gazetteer = Gazetteer()
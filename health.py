@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional
+from aiogram import Bot
+from aiohttp import web
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+from config import config
+from resilience import breaker_states
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class ProbeResult:
+    ok: bool
+    latency_ms: float
+    checked_at: float
+    error: Optional[str] = None
+
+    def to_dict(self) -> Dict:
+        return {
+            "ok": self.ok,
+            "latency_ms": round(self.latency_ms, 2),
+            "age_seconds": round(time.monotonic() - self.checked_at, 1),
+            "error": self.error,
+        }
+
+Probe = Callable[[], Awaitable[None]]
+
+class HealthMonitor:
+    """Фоновые проверки зависимостей; эндпоинты отдают только закэшированный результат"""
+
+    def __init__(self, bot: Bot, engine: AsyncEngine):
+        self.bot = bot
+        self.engine = engine
+        self.started_at = time.monotonic()
+        self.ready_flag = False
+        self.results: Dict[str, ProbeResult] = {}
+        # Проверки, без которых процесс не готов; остальные только показываются
+        self.required = {"database", "bot_api"} | ({"redis"} if config.REDIS_REQUIRED else set())
+        self.probes: Dict[str, Probe] = {
+            "database": self._probe_database,
+            "bot_api": self._probe_bot_api,
+            "redis": self._probe_redis,
+        }
+        self._me = None
+        self._me_checked_at = 0.0
+        self._redis = None
+        self._task: Optional[asyncio.Task] = None
+        self.loop_lag_ms = 0.0
+
+    def add_probe(self, name: str, probe: Probe, required: bool = True):
+        """Дополнительная проверка (например, живы ли воркеры)"""
+        self.probes[name] = probe
+        if required:
+            self.required.add(name)
+
+    # ---------- проверки ----------
+
+    async def _probe_database(self):
+        async with self.engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    async def _probe_bot_api(self):
+        # Токен не меняется: get_me достаточно подтверждать изредка
+        if self._me is None or time.monotonic() - self._me_checked_at > config.HEALTH_BOT_ME_TTL:
+            self._me = await self.bot.get_me()
+            self._me_checked_at = time.monotonic()
+
+    async def _probe_redis(self):
+        if self._redis is None:
+            from redis import asyncio as aioredis
+            self._redis = aioredis.from_url(config.REDIS_URL, socket_connect_timeout=config.HEALTH_PROBE_TIMEOUT)
+        await self._redis.ping()
+
+    async def _run_probe(self, name: str, probe: Probe):
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(probe(), timeout=config.HEALTH_PROBE_TIMEOUT)
+            result = ProbeResult(True, (time.perf_counter() - started) * 1000, time.monotonic())
+        except Exception as e:
+            result = ProbeResult(False, (time.perf_counter() - started) * 1000, time.monotonic(),
+                                 error=str(e) or type(e).__name__)
+            previous = self.results.get(name)
+            if previous is None or previous.ok:
+                logger.warning(f"⚠️ Проверка {name} не прошла: {result.error}")
+        self.results[name] = result
+
+    async def probe_all(self):
+        await asyncio.gather(*(self._run_probe(name, probe) for name, probe in self.probes.items()))
+
+    async def _run(self):
+        while True:
+            await self.probe_all()
+            # Задержка цикла событий: насколько позже запланированного мы проснулись
+            scheduled = time.perf_counter() + config.HEALTH_PROBE_INTERVAL
+            await asyncio.sleep(config.HEALTH_PROBE_INTERVAL)
+            self.loop_lag_ms = max((time.perf_counter() - scheduled) * 1000, 0.0)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self.ready_flag = False
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._redis is not None:
+            await self._redis.aclose()
+
+    # ---------- состояние ----------
+
+    def is_ready(self) -> bool:
+        stale_after = config.HEALTH_PROBE_INTERVAL * 3 + config.HEALTH_PROBE_TIMEOUT
+        now = time.monotonic()
+        return self.ready_flag and all(
+            name in self.results and self.results[name].ok and now - self.results[name].checked_at < stale_after
+            for name in self.required
+        )
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        """Живость: процесс отвечает и цикл событий не завис"""
+        return web.json_response({
+            "status": "ok",
+            "uptime_seconds": round(time.monotonic() - self.started_at, 1),
+            "loop_lag_ms": round(self.loop_lag_ms, 2),
+        })
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        """Готовность: последние результаты фоновых проверок, без обращений к зависимостям"""
+        ready = self.is_ready()
+        return web.json_response({
+            "status": "ready" if ready else "not_ready",
+            "accepting": self.ready_flag,
+            "probes": {name: result.to_dict() for name, result in self.results.items()},
+            "required": sorted(self.required),
+            "breakers": breaker_states(),
+        }, status=200 if ready else 503)
+
+    def setup(self, app: web.Application):
+        """Регистрирует /healthz и /readyz в приложении aiohttp"""
+        app.router.add_get("/healthz", self.healthz)
+        app.router.add_get("/readyz", self.readyz)
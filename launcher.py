@@ -0,0 +1,299 @@
+"""Запуск бота в нескольких процессах.
+
+Процесс-приемник забирает обновления из Bot API и раскладывает их по воркерам
+по хэшу id пользователя: все обновления одного пользователя обрабатывает один
+воркер в порядке поступления, поэтому его FSM и кэши остаются локальными.
+Каждый воркер - отдельный процесс со своим циклом событий и пулом соединений.
+
+Доставка - не более одного раза: смещение get_updates сдвигается, как только
+обновление передано в очередь воркера. Обновления, которые упавший воркер успел
+забрать, и те, что не удалось перенести в новую очередь при его перезапуске,
+теряются; Telegram их повторно не пришлет.
+
+Состояние в памяти у каждого процесса свое, и между процессами оно не
+синхронизируется. Запись о клиенте, сделанная в одном воркере (например,
+менеджером из карточки), другие воркеры видят с задержкой:
+    - карточки менеджеров и экран заказа - до CARD_CACHE_TTL и LAST_ORDER_CACHE_TTL;
+    - сводка /queue - до STATUS_STATS_CACHE_TTL;
+    - права после /manager add|remove - до ACL_RELOAD_SECONDS.
+Остается локальным без сходимости: живые карточки обновляются только в том
+процессе, который их отправил; сводку менеджерам каждый воркер копит и шлет
+сам; лимит SEND_RATE_PER_SECOND действует на процесс, поэтому общий темп
+рассылки до WORKERS * SEND_RATE_PER_SECOND.
+
+Проверки /healthz и /readyz: приемник на WEB_PORT, воркер i на WORKER_WEB_PORT_BASE + i.
+
+    python launcher.py [число воркеров]
+"""
+import asyncio
+import functools
+import logging
+import multiprocessing
+import queue
+import signal
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+from aiogram import Bot
+from aiohttp import web
+from config import config
+
+logger = logging.getLogger(__name__)
+
+def update_owner_id(update: dict) -> Optional[int]:
+    """Id пользователя (или чата), которому принадлежит обновление"""
+    for key, payload in update.items():
+        if key == "update_id" or not isinstance(payload, dict):
+            continue
+        for owner in (payload.get("from"), payload.get("user"), payload.get("chat"),
+                      (payload.get("message") or {}).get("chat")):
+            if owner and "id" in owner:
+                return owner["id"]
+    return None
+
+def shard_for(owner_id: Optional[int], workers: int) -> int:
+    """Номер воркера для пользователя; мультипликативный хэш сглаживает последовательные id"""
+    if owner_id is None:
+        return 0
+    return ((owner_id * 2654435761) & 0xFFFFFFFF) % workers
+
+WorkerTarget = Callable[[int, multiprocessing.Queue], None]
+
+class WorkerPool:
+    """Процессы-воркеры с отдельной очередью на каждый и перезапуском после падения"""
+
+    def __init__(self, workers: int, target: WorkerTarget, context: str = "spawn"):
+        self.workers = workers
+        self.target = target
+        # spawn: воркер не наследует цикл событий и соединения приемника
+        self._context = multiprocessing.get_context(context)
+        self.queues = [self._context.Queue() for _ in range(workers)]
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self.restarts = 0
+
+    def _spawn(self, index: int):
+        # Не daemon: воркер держит свой пул процессов для отчетов, а daemon-процессам
+        # запрещено заводить дочерние. Завершением управляет stop() - join, затем terminate
+        process = self._context.Process(target=self.target, args=(index, self.queues[index]),
+                                        name=f"genolife-worker-{index}")
+        process.start()
+        self.processes[index] = process
+        logger.info(f"👷 Воркер {index} запущен (pid {process.pid})")
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+
+    def route(self, owner_id: Optional[int], item):
+        """Отправляет задачу воркеру, отвечающему за пользователя"""
+        self.queues[shard_for(owner_id, self.workers)].put((owner_id, item))
+
+    def _replace_queue(self, index: int) -> int:
+        """Новая очередь для перезапускаемого воркера с переносом того, что удалось прочитать из старой"""
+        # Процесс, упавший во время чтения, мог оставить старую очередь заблокированной
+        # или с недочитанным сообщением - новому воркеру ее не отдаем
+        old_queue, self.queues[index] = self.queues[index], self._context.Queue()
+        moved = 0
+        while True:
+            try:
+                item = old_queue.get_nowait()
+            except queue.Empty:
+                break
+            except Exception as e:
+                logger.warning(f"⚠️ Очередь воркера {index} повреждена, остаток потерян: {e}")
+                break
+            self.queues[index].put(item)
+            moved += 1
+        old_queue.close()
+        return moved
+
+    async def supervise(self, interval: float = 1.0):
+        """Следит за воркерами и перезапускает упавшие; задачи, которые воркер успел забрать, теряются"""
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    logger.error(f"❌ Воркер {index} завершился с кодом {process.exitcode}, перезапуск")
+                    self.restarts += 1
+                    await asyncio.sleep(config.WORKER_RESTART_DELAY)
+                    moved = self._replace_queue(index)
+                    logger.info(f"📦 В новую очередь воркера {index} перенесено задач: {moved}")
+                    self._spawn(index)
+
+    def stop(self, timeout: float = 30):
+        """Просит воркеров дообработать очередь и завершиться"""
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        deadline = time.monotonic() + timeout
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f"⚠️ Воркер {index} не завершился вовремя, останавливаем принудительно")
+                process.terminate()
+            self.processes[index] = None
+
+async def read_queue(worker_queue: multiprocessing.Queue, max_batch: int = 100) -> list:
+    """Ждет задачу из очереди в отдельном потоке и добирает накопившиеся без ожидания"""
+    loop = asyncio.get_running_loop()
+    items = [await loop.run_in_executor(None, worker_queue.get)]
+    while items[-1] is not None and len(items) < max_batch:
+        try:
+            items.append(worker_queue.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+# ========== ВОРКЕР ==========
+
+def run_bot_worker(index: int, worker_queue: multiprocessing.Queue):
+    """Точка входа процесса-воркера"""
+    logging.basicConfig(level=logging.INFO,
+                        format=f'%(asctime)s - worker-{index} - %(name)s - %(levelname)s - %(message)s')
+    # Остановкой управляет приемник через очередь, Ctrl+C воркеру не адресован
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_bot_worker(index, worker_queue))
+
+async def _bot_worker(index: int, worker_queue: multiprocessing.Queue):
+    # Импорт здесь: обработчики, движок базы и хранилище FSM создаются в процессе воркера
+    import main as app
+
+    # У каждого воркера свой порт для /healthz и /readyz
+    web_runner = await app.start_services(with_payments=False, web_port=config.WORKER_WEB_PORT_BASE + index)
+    # Последняя задача каждого пользователя: следующая ждет ее завершения, поэтому
+    # задачи одного пользователя выполняются по очереди, а разных - параллельно
+    tails: Dict[Optional[int], asyncio.Task] = {}
+
+    async def run_after(previous: Optional[asyncio.Task], kind: str, payload):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            if kind == "update":
+                await app.dp.feed_raw_update(app.bot, payload)
+            else:
+                await app.on_routed_payment(*payload)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки задачи воркера ({kind}): {e}")
+
+    def release(owner_id: Optional[int], task: asyncio.Task):
+        if tails.get(owner_id) is task:
+            del tails[owner_id]
+
+    try:
+        running = True
+        while running:
+            for item in await read_queue(worker_queue):
+                if item is None:
+                    running = False
+                    break
+                owner_id, (kind, payload) = item
+                if kind not in ("update", "paid"):
+                    logger.warning(f"⚠️ Неизвестная задача воркера: {kind}")
+                    continue
+                task = asyncio.create_task(run_after(tails.get(owner_id), kind, payload))
+                tails[owner_id] = task
+                task.add_done_callback(functools.partial(release, owner_id))
+        if tails:
+            await asyncio.wait(list(tails.values()), timeout=config.SHUTDOWN_DRAIN_SECONDS)
+    finally:
+        await app.stop_services(web_runner)
+
+# ========== ПРИЕМНИК ==========
+
+async def poll_updates(bot: Bot, pool: WorkerPool):
+    """Long polling Bot API и раскладка обновлений по воркерам"""
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30)
+        except Exception as e:
+            logger.error(f"❌ Ошибка получения обновлений: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            payload = update.model_dump(mode="json", exclude_none=True)
+            pool.route(update_owner_id(payload), ("update", payload))
+            offset = update.update_id + 1
+
+async def run_receiver(workers: int):
+    """Процесс-приемник: база, вебхуки платежей, сверка, обслуживание таблиц и раздача обновлений"""
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from database import archive_cold_data, check_partitions, create_tables, engine, ensure_partitions, get_user_by_id
+    from health import HealthMonitor
+    from payments import PaymentWebhook, payment_client
+    from reconciliation import PaymentReconciler
+    from resilience import BotApiResilienceMiddleware
+
+    await create_tables()
+    pool = WorkerPool(workers, run_bot_worker)
+
+    async def route_paid(order, transaction_id: str):
+        # Завершение оплаты меняет FSM клиента, поэтому выполняется в его воркере
+        user = await get_user_by_id(order.user_id)
+        pool.route(user.tg_id if user else None, ("paid", (order.id, transaction_id)))
+
+    bot = Bot(token=config.BOT_TOKEN)
+    bot.session.middleware(BotApiResilienceMiddleware())
+    scheduler = AsyncIOScheduler()
+    health = HealthMonitor(bot, engine)
+
+    async def workers_alive():
+        dead = [index for index, process in enumerate(pool.processes) if not process or not process.is_alive()]
+        if dead:
+            raise RuntimeError(f"воркеры не работают: {dead}")
+
+    health.add_probe("workers", workers_alive)
+    health.add_probe("partitions", check_partitions, required=False)
+    pool.start()
+    supervisor = asyncio.create_task(pool.supervise())
+    app = web.Application()
+    health.setup(app)
+    if payment_client.enabled:
+        PaymentWebhook(payment_client, route_paid).setup(app)
+    web_runner = web.AppRunner(app)
+    await web_runner.setup()
+    try:
+        if payment_client.enabled:
+            scheduler.add_job(PaymentReconciler(payment_client, route_paid).run, "interval",
+                              minutes=config.RECONCILE_INTERVAL_MINUTES,
+                              id="payment_reconciliation", max_instances=1, coalesce=True)
+        scheduler.add_job(ensure_partitions, "cron", hour=3, id="partitions", max_instances=1, coalesce=True)
+        if config.ARCHIVE_AFTER_MONTHS:
+            scheduler.add_job(archive_cold_data, "cron", day=1, hour=4, id="archive", max_instances=1, coalesce=True)
+        scheduler.start()
+        await web.TCPSite(web_runner, config.WEB_HOST, config.WEB_PORT).start()
+        health.start()
+        health.ready_flag = True
+
+        await bot.send_message(config.ADMIN_ID, f"🤖 Бот GenoLife запущен: воркеров {workers}")
+        logger.info(f"🚀 Приемник запущен, воркеров: {workers}")
+        await poll_updates(bot, pool)
+    finally:
+        supervisor.cancel()
+        health.ready_flag = False
+        if scheduler.running:
+            scheduler.shutdown(wait=False)
+        await web_runner.cleanup()
+        await health.stop()
+        await payment_client.close()
+        await asyncio.to_thread(pool.stop, config.SHUTDOWN_TIMEOUT_SECONDS)
+        await bot.session.close()
+        await engine.dispose()
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - receiver - %(name)s - %(levelname)s - %(message)s')
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else config.WORKERS
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(run_receiver(workers))
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, task.cancel)
+    try:
+        loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        logger.info("🛑 Приемник остановлен")
+    finally:
+        loop.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Tuple
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+logger = logging.getLogger(__name__)
+
+class InFlightTracker(BaseMiddleware):
+    """Внешний middleware обновлений: знает, какие обработчики выполняются прямо сейчас"""
+
+    def __init__(self):
+        self._tasks = set()
+        self.accepting = True
+        self.rejected = 0
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        if not self.accepting:
+            # Обновление пришло после начала остановки - не начинаем работу, которую не успеем закончить
+            self.rejected += 1
+            return None
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            return await handler(event, data)
+        finally:
+            self._tasks.discard(task)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def drain(self, timeout: float) -> Tuple[int, int]:
+        """Перестает принимать обновления и ждет текущие обработчики; возвращает (завершено, брошено)"""
+        self.accepting = False
+        tasks = set(self._tasks)
+        if not tasks:
+            return 0, 0
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        return len(done), len(pending)
+
+ShutdownStep = Tuple[str, Callable[[], Awaitable[Any]]]
+
+async def run_shutdown(steps: Iterable[ShutdownStep], deadline: float):
+    """Выполняет шаги остановки по порядку, замеряя каждый; сбой шага не прерывает остальные"""
+    started = time.perf_counter()
+    timings = []
+    for name, step in steps:
+        step_started = time.perf_counter()
+        remaining = max(deadline - (step_started - started), 0.1)
+        try:
+            await asyncio.wait_for(step(), timeout=remaining)
+        except asyncio.TimeoutError:
+            logger.error(f"⏱ Шаг остановки «{name}» не уложился в срок")
+        except Exception as e:
+            logger.error(f"❌ Ошибка на шаге остановки «{name}»: {e}")
+        timings.append(f"{name} {(time.perf_counter() - step_started) * 1000:.0f} мс")
+    logger.info(f"🛑 Остановка за {time.perf_counter() - started:.2f} с: " + ", ".join(timings))
@@ -1,22 +1,43 @@
 import os
 import asyncio
 import logging
+import time
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import CommandStart, Command
 from aiogram.types import ReplyKeyboardRemove, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.exceptions import TelegramBadRequest
 from datetime import datetime
+from zoneinfo import ZoneInfo
 import uuid
+from aiohttp import web
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from config import config
 from database import (
     get_user_by_tg_id, get_or_create_user, create_tables, 
-    create_order, save_quiz_answer, update_order_payment, update_user_status,
-    update_user_contact, update_user_timezone, get_user_orders, cleanup_duplicate_users
+    create_order, save_quiz_answer, mark_orders_paid, update_user_status,
+    update_user_contact, update_user_timezone, cleanup_duplicate_users,
+    get_status_stats, status_history, engine, get_managers, get_order, get_user_by_id,
+    event_log, FunnelEvent, source_rollups, get_source_totals, backfill_source_rollups,
+    get_user_card_data, get_report_file, save_report_file, delete_report_file, warm_pool,
+    ensure_partitions, check_partitions, archive_cold_data, get_user_with_last_order
 )
-from managers import init_manager_bot, manager_bot
+from analytics import build_funnel_report, build_quiz_conversion_report
+from payments import PaymentWebhook, payment_client
+from reconciliation import PaymentReconciler
+from acl import IsManager, manager_registry
+from pipeline import STATUS_LABELS, status_label
+from managers import escape_markdown, init_manager_bot
+from fsm_storage import TTLMemoryStorage
+from profiler import profiler
+from reports import build_report_payload, report_version, report_renderer
+from gazetteer import gazetteer
+from resilience import BotApiResilienceMiddleware, breaker_states
+from lifecycle import InFlightTracker, run_shutdown
+from health import HealthMonitor
 
 # Настройка логирования
 logging.basicConfig(
@@ -25,24 +46,60 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Создаем бота
+# Создаем бота: повторы и автомат на запросы к Bot API
 bot = Bot(token=config.BOT_TOKEN)
-storage = MemoryStorage()
+bot.session.middleware(BotApiResilienceMiddleware())
+storage = TTLMemoryStorage()
 dp = Dispatcher(storage=storage)
 
 # Инициализируем менеджерский бот
 manager_bot = init_manager_bot(bot)
 
+# Планировщик фоновых задач
+scheduler = AsyncIOScheduler()
+
 # Состояния для FSM
 class OrderStates(StatesGroup):
     waiting_contacts = State()
     waiting_timezone = State()
+    waiting_city = State()
 
 class QuizStates(StatesGroup):
     question1 = State()
     question2 = State()
     question3 = State()
 
+# Напоминания тем, кто бросил шаг на середине
+STATE_NUDGES = {
+    QuizStates.question1.state: "👋 Вы начали тест GenoLife, но не закончили. Выберите ответ на клавиатуре ниже - осталось всего 3 вопроса!",
+    QuizStates.question2.state: "👋 Тест почти пройден! Выберите ответ на клавиатуре ниже - осталось 2 вопроса.",
+    QuizStates.question3.state: "👋 Остался последний вопрос теста - выберите ответ на клавиатуре ниже.",
+    OrderStates.waiting_contacts.state: "📱 Заказ оплачен! Отправьте, пожалуйста, контакт, чтобы мы могли согласовать доставку набора.",
+    OrderStates.waiting_timezone.state: "🕐 Остался один шаг: выберите часовой пояс, чтобы курьер приехал в удобное время.",
+    OrderStates.waiting_city.state: "🏙 Остался один шаг: напишите ваш город, чтобы мы определили часовой пояс.",
+}
+
+async def nudge_abandoned_session(key: StorageKey, state: str, data: dict):
+    """Напоминает пользователю продолжить с того места, где он остановился"""
+    text = STATE_NUDGES.get(state)
+    if text:
+        await manager_bot.sender.send(key.chat_id, text)
+
+storage.on_nudge = nudge_abandoned_session
+
+# Справочник городов для определения часового пояса
+gazetteer.load()
+
+# Обработчики в работе: при остановке дожидаемся их, а не обрываем
+in_flight = InFlightTracker()
+dp.update.outer_middleware(in_flight)
+
+# Хуки профилирования: пока замер не запущен, стоят одну проверку флага
+profiler.attach(dp, bot, engine)
+
+# Проверки зависимостей в фоне: /readyz отдает их результат без запросов к базе
+health = HealthMonitor(bot, engine)
+
 # ========== МЕНЕДЖЕРСКИЕ КОМАНДЫ ==========
 
 @dp.callback_query(F.data.startswith(("send_kit:", "courier:", "in_lab:", "results_ready:", "consult:", "start_program:", "fail_collect:")))
@@ -54,9 +111,16 @@ async def handle_manager_commands(callback: types.CallbackQuery):
         result = await manager_bot.handle_manager_command(callback.data, callback.from_user.id)
         await callback.answer(result)
         
-        # Обновляем карточку клиента
+        # Обновляем карточку клиента на месте
         user_id = int(callback.data.split(":")[1])
-        await manager_bot.send_user_card(user_id)
+        if isinstance(callback.message, types.Message):
+            await manager_bot.refresh_user_card(
+                user_id,
+                chat_id=callback.message.chat.id,
+                message_id=callback.message.message_id
+            )
+        else:
+            await manager_bot.refresh_user_card(user_id)
         
     except Exception as e:
         logger.error(f"❌ Ошибка обработки команды менеджера: {e}")
@@ -64,18 +128,11 @@ async def handle_manager_commands(callback: types.CallbackQuery):
 
 # ========== УВЕДОМЛЕНИЯ МЕНЕДЖЕРАМ ==========
 
-async def notify_managers(message: str, user_id: int = None, order_id: int = None):
-    """Отправляет уведомление менеджерам"""
+async def notify_managers(message: str, user_id: int = None, order_id: int = None, event_type: str = "event"):
+    """Отправляет уведомление менеджерам (через сводку, срочные - сразу)"""
     try:
-        logger.info(f"📢 Отправка уведомления менеджерам: {message[:100]}...")
-        
-        # Отправляем текстовое уведомление
-        await manager_bot.notify_managers(message)
-        
-        # Если указан user_id, отправляем карточку клиента
-        if user_id:
-            logger.info(f"📋 Отправка карточки клиента {user_id}")
-            await manager_bot.send_user_card(user_id, order_id)
+        logger.info(f"📢 Уведомление менеджерам ({event_type}): {message[:100]}...")
+        await manager_bot.push_event(event_type, message, user_id, order_id)
             
     except Exception as e:
         logger.error(f"❌ Ошибка отправки уведомления менеджерам: {e}")
@@ -97,14 +154,13 @@ async def offer_payment_after_quiz_handler(message: types.Message):
     if not order:
         await message.answer("❌ Ошибка создания заказа. Попробуйте еще раз.")
         return
+    event_log.log(user.id, FunnelEvent.ORDER_CREATED)
     
     # Инлайн клавиатура для оплаты
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="💳 Тестовая оплата", callback_data=f"test_pay:{order.id}")],
-            [InlineKeyboardButton(text="✅ Я оплатил(а)", callback_data=f"confirm_pay:{order.id}")]
-        ]
-    )
+    keyboard = await build_payment_keyboard(order)
+    if not keyboard:
+        await message.answer("❌ Ошибка создания платежа. Попробуйте еще раз.")
+        return
     
     await message.answer(
         "💰 *Специальное предложение после теста!*\n\n"
@@ -150,13 +206,16 @@ async def start_command(message: types.Message):
         tg_id=message.from_user.id,
         username=message.from_user.username,
         first_name=message.from_user.first_name,
-        source=source
+        source=source,
+        scenario=scenario
     )
     
     if not user:
         await message.answer("❌ Ошибка регистрации. Попробуйте еще раз.")
         return
     
+    event_log.log(user.id, FunnelEvent.START)
+    
     # Главное меню
     keyboard = ReplyKeyboardMarkup(
         keyboard=[
@@ -181,6 +240,8 @@ async def start_quiz_handler(message: types.Message, state: FSMContext):
         await message.answer("❌ Сначала зарегистрируйтесь через /start")
         return
     
+    event_log.log(user.id, FunnelEvent.QUIZ_STARTED)
+    
     await message.answer(
         "🧪 *60-секундный тест GenoLife*\n\n"
         "Ответьте на 3 простых вопроса, чтобы узнать больше о вашем здоровье.\n\n"
@@ -203,6 +264,7 @@ async def question1_handler(message: types.Message, state: FSMContext):
     user = await get_user_by_tg_id(message.from_user.id)
     if user:
         await save_quiz_answer(user.id, "energy_level", message.text)
+        event_log.log(user.id, FunnelEvent.QUIZ_Q1)
     
     await message.answer(
         f"✅ *Ответ сохранен*\n\n"
@@ -225,6 +287,7 @@ async def question2_handler(message: types.Message, state: FSMContext):
     user = await get_user_by_tg_id(message.from_user.id)
     if user:
         await save_quiz_answer(user.id, "sleep_quality", message.text)
+        event_log.log(user.id, FunnelEvent.QUIZ_Q2)
     
     await message.answer(
         f"✅ *Ответ сохранен*\n\n"
@@ -247,6 +310,8 @@ async def question3_handler(message: types.Message, state: FSMContext):
     user = await get_user_by_tg_id(message.from_user.id)
     if user:
         await save_quiz_answer(user.id, "activity_level", message.text)
+        event_log.log(user.id, FunnelEvent.QUIZ_Q3)
+        event_log.log(user.id, FunnelEvent.OFFER)
     
     # ПРЕДЛОЖЕНИЕ ОПЛАТЫ ПОСЛЕ КВИЗА
     keyboard = ReplyKeyboardMarkup(
@@ -313,92 +378,192 @@ async def cancel_quiz_handler(message: types.Message, state: FSMContext):
 
 # ========== СИСТЕМА ОПЛАТЫ ==========
 
+async def build_payment_keyboard(order):
+    """Клавиатура оплаты: платеж ЮKassa, если она настроена, иначе тестовая оплата"""
+    if payment_client.enabled:
+        payment = await payment_client.create_payment(order.id, order.amount)
+        if not payment:
+            return None
+        return InlineKeyboardMarkup(
+            inline_keyboard=[
+                [InlineKeyboardButton(text="💳 Оплатить", url=payment["confirmation"]["confirmation_url"])],
+                [InlineKeyboardButton(text="✅ Я оплатил(а)", callback_data=f"confirm_pay:{order.id}")]
+            ]
+        )
+    
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="💳 Тестовая оплата", callback_data=f"test_pay:{order.id}")],
+            [InlineKeyboardButton(text="✅ Я оплатил(а)", callback_data=f"confirm_pay:{order.id}")]
+        ]
+    )
+
+async def complete_paid_order(user, order_id: int, amount: float, title: str, event_type: str, changed_by: int = None):
+    """Общие действия после оплаты: статус клиента, запрос контактов, уведомление менеджеров"""
+    await update_user_status(user.id, 'paid', changed_by=changed_by)
+    event_log.log(user.id, FunnelEvent.PAYMENT)
+    source_rollups.record(user.source, payments=1, revenue=amount or 2990)
+    
+    await bot.send_message(
+        user.tg_id,
+        "🎉 *Оплата подтверждена! Спасибо за заказ!*\n\n"
+        "Теперь нам нужны ваши контактные данные для доставки набора.",
+        parse_mode="Markdown",
+        reply_markup=ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text="📞 Оставить контакты", request_contact=True)]],
+            resize_keyboard=True
+        )
+    )
+    
+    state = dp.fsm.get_context(bot=bot, chat_id=user.tg_id, user_id=user.tg_id)
+    await state.set_state(OrderStates.waiting_contacts)
+    
+    amount_text = f"{amount or 2990:,.0f}".replace(",", " ")
+    await notify_managers(
+        f"{title}\n\n"
+        f"👤 *Клиент:* {escape_markdown(user.first_name)} (@{escape_markdown(user.username)})\n"
+        f"💵 *Сумма:* {amount_text} руб\n"
+        f"🆔 *ID заказа:* {order_id}\n"
+        f"📅 *Время:* {datetime.now().strftime('%d.%m.%Y %H:%M')}",
+        user_id=user.id,
+        order_id=order_id,
+        event_type=event_type
+    )
+
+async def on_order_paid(order, transaction_id: str):
+    """Оплата подтверждена провайдером (вебхук или сверка)"""
+    user = await get_user_by_id(order.user_id)
+    if user:
+        await complete_paid_order(user, order.id, order.amount, "💰 *НОВАЯ ОПЛАТА!*", "payment")
+
+payment_webhook = PaymentWebhook(payment_client, on_order_paid)
+payment_reconciler = PaymentReconciler(payment_client, on_order_paid)
+
+# ========== ОТЧЕТ ДЛЯ КЛИЕНТА ==========
+
+REPORT_STATUSES = ("results_ready", "program_started")
+
+@dp.callback_query(F.data == "get_report")
+async def get_report_handler(callback: types.CallbackQuery):
+    """Отправляет персональный отчет: из кэша file_id или после сборки в пуле процессов"""
+    user = await get_user_by_tg_id(callback.from_user.id)
+    if not user or user.status not in REPORT_STATUSES:
+        await callback.answer("📄 Отчет будет доступен, когда результаты будут готовы", show_alert=True)
+        return
+    
+    card_data = await get_user_card_data(user.id)
+    if not card_data:
+        await callback.answer("❌ Ошибка получения данных. Попробуйте позже.")
+        return
+    
+    payload = build_report_payload(*card_data)
+    version = report_version(payload)
+    filename = f"genolife_report_{user.id}.xlsx"
+    
+    # Отчет этой версии уже загружен - отправляем по file_id без сборки и повторной загрузки
+    file_id = await get_report_file(user.id, version)
+    if file_id:
+        try:
+            await bot.send_document(callback.from_user.id, file_id, caption="📊 Ваш персональный отчет GenoLife")
+            await callback.answer()
+            return
+        except TelegramBadRequest as e:
+            logger.warning(f"⚠️ Telegram не принял сохраненный отчет пользователя {user.id}: {e}")
+            await delete_report_file(user.id, version)
+    
+    await callback.answer("⏳ Готовим ваш отчет...")
+    data = await report_renderer.render(f"{user.id}:{version}", payload)
+    if not data:
+        await bot.send_message(callback.from_user.id, "⏳ Сейчас много запросов отчетов. Попробуйте через минуту.")
+        return
+    
+    sent = await bot.send_document(
+        callback.from_user.id,
+        types.BufferedInputFile(data, filename=filename),
+        caption="📊 Ваш персональный отчет GenoLife"
+    )
+    await save_report_file(user.id, version, sent.document.file_id)
+    logger.info(f"📊 Отчет версии {version} отправлен пользователю {user.id}")
+
 @dp.callback_query(F.data.startswith("test_pay:"))
-async def test_payment_handler(callback: types.CallbackQuery, state: FSMContext):
+async def test_payment_handler(callback: types.CallbackQuery):
     """Обработчик тестовой оплаты"""
     try:
-        order_id = int(callback.data.split(":")[1])
-        
-        # Обновляем заказ
-        success = await update_order_payment(order_id, 'paid', f"TEST_{uuid.uuid4().hex[:8]}")
-        if not success:
-            await callback.answer("❌ Заказ не найден")
+        if payment_client.enabled:
+            await callback.answer("⛔ Тестовая оплата отключена")
             return
         
-        # Обновляем пользователя
-        user = await get_user_by_tg_id(callback.from_user.id)
-        if user:
-            await update_user_status(user.id, 'paid')
+        order_id = int(callback.data.split(":")[1])
         
-        await callback.message.answer(
-            "🎉 *Оплата подтверждена! Спасибо за заказ!*\n\n"
-            "Теперь нам нужны ваши контактные данные для доставки набора.",
-            parse_mode="Markdown",
-            reply_markup=ReplyKeyboardMarkup(
-                keyboard=[[KeyboardButton(text="📞 Оставить контакты", request_contact=True)]],
-                resize_keyboard=True
-            )
-        )
+        # Обновляем заказ; повторное нажатие не проводит оплату второй раз
+        paid = await mark_orders_paid([order_id], f"TEST_{uuid.uuid4().hex[:8]}")
+        if paid is None:
+            await callback.answer("❌ Ошибка оплаты")
+            return
+        if not paid:
+            await callback.answer("✅ Заказ уже оплачен")
+            return
         
-        await state.set_state(OrderStates.waiting_contacts)
         await callback.answer("✅ Тестовая оплата подтверждена!")
         
-        # Уведомление менеджерам с карточкой клиента
+        user = await get_user_by_tg_id(callback.from_user.id)
         if user:
-            await notify_managers(
-                f"💰 *НОВАЯ ОПЛАТА!*\n\n"
-                f"👤 *Клиент:* {user.first_name} (@{user.username})\n"
-                f"💵 *Сумма:* 2 990 руб\n"
-                f"🆔 *ID заказа:* {order_id}\n"
-                f"📅 *Время:* {datetime.now().strftime('%d.%m.%Y %H:%M')}",
-                user_id=user.id,
-                order_id=order_id
-            )
+            await complete_paid_order(user, order_id, paid[0].amount, "💰 *НОВАЯ ОПЛАТА!*", "payment",
+                                      changed_by=callback.from_user.id)
             
     except Exception as e:
         logger.error(f"❌ Ошибка тестовой оплаты: {e}")
         await callback.answer("❌ Ошибка оплаты")
 
 @dp.callback_query(F.data.startswith("confirm_pay:"))
-async def confirm_payment_handler(callback: types.CallbackQuery, state: FSMContext):
+async def confirm_payment_handler(callback: types.CallbackQuery):
     """Обработчик подтверждения оплаты"""
     try:
         order_id = int(callback.data.split(":")[1])
         
-        # Обновляем заказ
-        success = await update_order_payment(order_id, 'paid', f"MANUAL_{uuid.uuid4().hex[:8]}")
-        if not success:
-            await callback.answer("❌ Заказ не найден")
+        if payment_client.enabled:
+            # Слову клиента не верим: сверяем платеж с ЮKassa
+            order = await get_order(order_id)
+            if not order:
+                await callback.answer("❌ Заказ не найден")
+                return
+            if order.payment_status == 'paid':
+                await callback.answer("✅ Заказ уже оплачен")
+                return
+            
+            payment = await payment_client.get_payment(order.transaction_id) if order.transaction_id else None
+            if not payment or payment.get("status") != "succeeded":
+                await callback.answer("⏳ Оплата еще не поступила. Попробуйте через минуту.", show_alert=True)
+                return
+            
+            # Тот же условный UPDATE, что у вебхука и сверки: уведомит только успевший первым
+            paid = await mark_orders_paid([order_id], order.transaction_id)
+            if paid is None:
+                await callback.answer("❌ Ошибка")
+                return
+            if not paid:
+                await callback.answer("✅ Заказ уже оплачен")
+                return
+            
+            await callback.answer("✅ Оплата подтверждена!")
+            await on_order_paid(paid[0], order.transaction_id)
             return
         
-        # Обновляем пользователя
-        user = await get_user_by_tg_id(callback.from_user.id)
-        if user:
-            await update_user_status(user.id, 'paid')
-        
-        await callback.message.answer(
-            "🎉 *Оплата подтверждена! Спасибо за заказ!*\n\n"
-            "Теперь нам нужны ваши контактные данные для доставки набора.",
-            parse_mode="Markdown",
-            reply_markup=ReplyKeyboardMarkup(
-                keyboard=[[KeyboardButton(text="📞 Оставить контакты", request_contact=True)]],
-                resize_keyboard=True
-            )
-        )
+        # Обновляем заказ
+        paid = await mark_orders_paid([order_id], f"MANUAL_{uuid.uuid4().hex[:8]}")
+        if paid is None:
+            await callback.answer("❌ Ошибка")
+            return
+        if not paid:
+            await callback.answer("✅ Заказ уже оплачен")
+            return
         
-        await state.set_state(OrderStates.waiting_contacts)
         await callback.answer("✅ Оплата подтверждена!")
         
-        # Уведомление менеджерам
+        user = await get_user_by_tg_id(callback.from_user.id)
         if user:
-            await notify_managers(
-                f"💰 *ПОДТВЕРЖДЕНА ОПЛАТА!*\n\n"
-                f"👤 *Клиент:* {user.first_name}\n"
-                f"💵 *Сумма:* 2 990 руб\n"
-                f"🆔 *ID заказа:* {order_id}\n"
-                f"📅 *Время:* {datetime.now().strftime('%d.%m.%Y %H:%M')}",
-                user_id=user.id
-            )
+            await complete_paid_order(user, order_id, paid[0].amount, "💰 *ПОДТВЕРЖДЕНА ОПЛАТА!*", "payment_claimed",
+                                      changed_by=callback.from_user.id)
         
     except Exception as e:
         logger.error(f"❌ Ошибка подтверждения оплаты: {e}")
@@ -426,19 +591,19 @@ async def direct_payment_handler(message: types.Message):
     if not user:
         await message.answer("❌ Сначала зарегистрируйтесь через /start")
         return
+    event_log.log(user.id, FunnelEvent.OFFER)
     
     # Создаем заказ в БД
     order = await create_order(user.id, 2990.00)
     if not order:
         await message.answer("❌ Ошибка создания заказа. Попробуйте еще раз.")
         return
+    event_log.log(user.id, FunnelEvent.ORDER_CREATED)
     
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="💳 Тестовая оплата", callback_data=f"test_pay:{order.id}")],
-            [InlineKeyboardButton(text="✅ Я оплатил(а)", callback_data=f"confirm_pay:{order.id}")]
-        ]
-    )
+    keyboard = await build_payment_keyboard(order)
+    if not keyboard:
+        await message.answer("❌ Ошибка создания платежа. Попробуйте еще раз.")
+        return
     
     await message.answer(
         "💰 *Оплата анализа GenoLife*\n\n"
@@ -452,17 +617,69 @@ async def direct_payment_handler(message: types.Message):
         reply_markup=keyboard
     )
 
+# Статусы оплаты заказа для клиента
+PAYMENT_STATUS_LABELS = {
+    'new': '🆕 Новый',
+    'pending': '⏳ Ожидает оплаты',
+    'paid': '✅ Оплачен',
+    'canceled': '❌ Отменен',
+}
+
+# Что происходит с заказом на каждом этапе воронки - глазами клиента
+CLIENT_STAGE_HINTS = {
+    "lead": "Заказ еще не оформлен",
+    "active": "Заказ еще не оплачен",
+    "paid": "Оплата получена, готовим набор для сдачи анализа",
+    "kit_sent": "Набор отправлен, менеджер согласует визит курьера",
+    "courier_scheduled": "Курьер назначен и приедет в согласованное время",
+    "in_lab": "Биоматериал в лаборатории, анализ в работе",
+    "collect_retry": "Нужен повторный сбор биоматериала, менеджер свяжется с вами",
+    "results_ready": "Результаты готовы, менеджер назначит консультацию",
+    "program_started": "Персональная программа запущена",
+}
+
+def payment_status_label(status: str) -> str:
+    return PAYMENT_STATUS_LABELS.get(status, status)
+
+@dp.message(F.text == "📦 Статус заказа")
+async def order_status_handler(message: types.Message):
+    """Показывает последний заказ и этап работы с клиентом"""
+    user_data = await get_user_with_last_order(message.from_user.id)
+    
+    if not user_data:
+        await message.answer("❌ Профиль не найден. Напишите /start")
+        return
+    
+    user, order = user_data
+    if not order:
+        await message.answer(
+            "📦 У вас пока нет заказов.\n\nОформить анализ: «💳 Заказать анализ со скидкой»"
+        )
+        return
+    
+    status_text = (
+        f"📦 *Заказ #{order.id}*\n\n"
+        f"*Сумма:* {order.amount:.0f} ₽\n"
+        f"*Оплата:* {payment_status_label(order.payment_status)}\n"
+        f"*Оформлен:* {order.created_at.strftime('%d.%m.%Y') if order.created_at else '—'}\n"
+        f"*Этап:* {status_label(user.status)}\n"
+    )
+    hint = CLIENT_STAGE_HINTS.get(user.status)
+    if hint:
+        status_text += f"\n{hint}"
+    
+    await message.answer(status_text, parse_mode="Markdown")
+
 @dp.message(F.text == "👤 Профиль")
 async def profile_handler(message: types.Message):
     """Показывает профиль пользователя"""
-    user = await get_user_by_tg_id(message.from_user.id)
+    user_data = await get_user_with_last_order(message.from_user.id)
     
-    if not user:
+    if not user_data:
         await message.answer("❌ Профиль не найден. Напишите /start")
         return
     
-    # Получаем заказы пользователя
-    orders = await get_user_orders(user.id)
+    user, last_order = user_data
     
     profile_text = (
         f"👤 *Ваш профиль:*\n\n"
@@ -474,14 +691,8 @@ async def profile_handler(message: types.Message):
         f"*Статус:* {user.status}\n"
     )
     
-    if orders:
-        last_order = orders[0]
-        status_map = {
-            'new': '🆕 Новый',
-            'pending': '⏳ Ожидает оплаты', 
-            'paid': '✅ Оплачен',
-        }
-        profile_text += f"\n*Последний заказ:* #{last_order.id} ({status_map.get(last_order.payment_status, last_order.payment_status)})"
+    if last_order:
+        profile_text += f"\n*Последний заказ:* #{last_order.id} ({payment_status_label(last_order.payment_status)})"
     
     await message.answer(profile_text, parse_mode="Markdown")
 
@@ -509,120 +720,384 @@ async def contact_received_handler(message: types.Message, state: FSMContext):
     user = await get_user_by_tg_id(message.from_user.id)
     if user:
         await update_user_contact(user.id, phone)
+        event_log.log(user.id, FunnelEvent.CONTACTS)
     
     # Предлагаем выбрать часовой пояс
-    timezone_keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Москва (+3)"), KeyboardButton(text="Екатеринбург (+5)")],
-            [KeyboardButton(text="Определить по городу")]
-        ],
-        resize_keyboard=True
-    )
-    
     await message.answer(
         f"✅ *Телефон сохранен:* {phone}\n\n"
         "🕐 *Выберите ваш часовой пояс:*",
         parse_mode="Markdown",
-        reply_markup=timezone_keyboard
+        reply_markup=timezone_keyboard()
     )
     
     await state.set_state(OrderStates.waiting_timezone)
 
+TIMEZONE_BUTTONS = {
+    "Москва (+3)": ("Europe/Moscow", "Москва"),
+    "Екатеринбург (+5)": ("Asia/Yekaterinburg", "Екатеринбург"),
+}
+CITY_BUTTON = "Определить по городу"
+
+def timezone_keyboard() -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="Москва (+3)"), KeyboardButton(text="Екатеринбург (+5)")],
+            [KeyboardButton(text=CITY_BUTTON)]
+        ],
+        resize_keyboard=True
+    )
+
+def utc_offset_label(timezone: str) -> str:
+    """Смещение часового пояса для показа пользователю, например UTC+7"""
+    offset = datetime.now(ZoneInfo(timezone)).utcoffset()
+    hours = int(offset.total_seconds() // 3600)
+    return f"UTC{hours:+d}"
+
 @dp.message(OrderStates.waiting_timezone)
 async def timezone_handler(message: types.Message, state: FSMContext):
     """Обработчик выбора часового пояса"""
-    timezone_map = {
-        "Москва (+3)": "Europe/Moscow",
-        "Екатеринбург (+5)": "Asia/Yekaterinburg",
-        "Определить по городу": "auto"
-    }
-    
-    if message.text in timezone_map:
-        timezone = timezone_map[message.text]
-        
-        # Сохраняем часовой пояс
-        user = await get_user_by_tg_id(message.from_user.id)
-        if user:
-            city = None
-            if message.text == "Определить по городу":
-                city = "auto"
-            else:
-                city = message.text.split(' ')[0]  # Берем название города
-            
-            await update_user_timezone(user.id, timezone, city)
-        
-        # Завершаем процесс
-        main_keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="📦 Статус заказа"), KeyboardButton(text="👤 Профиль")],
-                [KeyboardButton(text="🔗 Моя реф ссылка"), KeyboardButton(text="ℹ️ О проекте")]
-            ],
-            resize_keyboard=True
-        )
-        
+    if message.text == CITY_BUTTON:
         await message.answer(
-            "🎊 *Поздравляем с покупкой!*\n\n"
-            "✅ *Ваш заказ оформлен!*\n\n"
-            "Менеджер свяжется с вами для уточнения деталей доставки.",
+            "🏙 *Напишите ваш город* - мы определим часовой пояс автоматически.",
             parse_mode="Markdown",
-            reply_markup=main_keyboard
+            reply_markup=ReplyKeyboardRemove()
         )
-        
-        await state.clear()
-        
-        # Уведомление менеджеру
-        if user:
-            await notify_managers(
-                f"🆕 *НОВЫЙ ЗАКАЗ! ДАННЫЕ КЛИЕНТА:*\n\n"
-                f"👤 *Клиент:* {user.first_name}\n"
-                f"📞 *Телефон:* {user.phone}\n"
-                f"📍 *Город:* {city or 'Не указан'}\n"
-                f"🕐 *Часовой пояс:* {timezone}\n"
-                f"📅 *Время оформления:* {datetime.now().strftime('%d.%m.%Y %H:%M')}",
-                user_id=user.id
-            )
+        await state.set_state(OrderStates.waiting_city)
+    elif message.text in TIMEZONE_BUTTONS:
+        timezone, city = TIMEZONE_BUTTONS[message.text]
+        await complete_order_details(message, state, timezone, city)
     else:
         await message.answer("❌ Пожалуйста, выберите вариант из списка")
 
+@dp.message(OrderStates.waiting_city, F.text)
+async def city_handler(message: types.Message, state: FSMContext):
+    """Определение часового пояса по названию города из офлайн-справочника"""
+    city = gazetteer.resolve(message.text)
+    if city:
+        await complete_order_details(message, state, city.timezone, city.name)
+        return
+    
+    matches = gazetteer.search(message.text)
+    if matches:
+        # Варианты кнопками: нажатие дает точное совпадение на следующем шаге
+        await message.answer(
+            "🤔 *Уточните, пожалуйста, ваш город:*",
+            parse_mode="Markdown",
+            reply_markup=ReplyKeyboardMarkup(
+                keyboard=[[KeyboardButton(text=match.name)] for match, _ in matches],
+                resize_keyboard=True
+            )
+        )
+    else:
+        await message.answer(
+            "😕 Не нашли такой город. Выберите часовой пояс из списка или напишите ближайший крупный город.",
+            reply_markup=timezone_keyboard()
+        )
+        await state.set_state(OrderStates.waiting_timezone)
+
+async def complete_order_details(message: types.Message, state: FSMContext, timezone: str, city: str):
+    """Сохраняет часовой пояс и завершает оформление заказа"""
+    user = await get_user_by_tg_id(message.from_user.id)
+    if user:
+        await update_user_timezone(user.id, timezone, city)
+        event_log.log(user.id, FunnelEvent.TIMEZONE)
+    
+    # Завершаем процесс
+    main_keyboard = ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="📦 Статус заказа"), KeyboardButton(text="👤 Профиль")],
+            [KeyboardButton(text="🔗 Моя реф ссылка"), KeyboardButton(text="ℹ️ О проекте")]
+        ],
+        resize_keyboard=True
+    )
+    
+    await message.answer(
+        "🎊 *Поздравляем с покупкой!*\n\n"
+        "✅ *Ваш заказ оформлен!*\n\n"
+        f"📍 {city}, {utc_offset_label(timezone)}\n\n"
+        "Менеджер свяжется с вами для уточнения деталей доставки.",
+        parse_mode="Markdown",
+        reply_markup=main_keyboard
+    )
+    
+    await state.clear()
+    
+    # Уведомление менеджеру
+    if user:
+        await notify_managers(
+            f"🆕 *НОВЫЙ ЗАКАЗ! ДАННЫЕ КЛИЕНТА:*\n\n"
+            f"👤 *Клиент:* {escape_markdown(user.first_name)}\n"
+            f"📞 *Телефон:* {escape_markdown(user.phone)}\n"
+            f"📍 *Город:* {escape_markdown(city) if city else 'Не указан'}\n"
+            f"🕐 *Часовой пояс:* {timezone} ({utc_offset_label(timezone)})\n"
+            f"📅 *Время оформления:* {datetime.now().strftime('%d.%m.%Y %H:%M')}",
+            user_id=user.id,
+            event_type="order_completed"
+        )
+
 # ========== АДМИН КОМАНДЫ ==========
 
-@dp.message(Command("cleanup"))
+@dp.message(Command("cleanup"), IsManager(role="admin"))
 async def cleanup_command(message: types.Message):
-    """Очистка дублирующихся пользователей (только для админа)"""
-    if message.from_user.id != config.ADMIN_ID:
-        await message.answer("⛔ Доступ запрещен")
+    """Очистка дублирующихся пользователей (только для админов)"""
+    progress_message = await message.answer("⏳ Ищем дубли пользователей...")
+    last_edit = 0.0
+    
+    async def report_progress(done: int, total: int):
+        # Пачки идут быстрее лимитов Telegram на правку сообщения - обновляем не чаще раза в 5 секунд
+        nonlocal last_edit
+        if time.monotonic() - last_edit < 5:
+            return
+        last_edit = time.monotonic()
+        await progress_message.edit_text(f"⏳ Удалено дублей: {done} из {total}")
+    
+    totals = await cleanup_duplicate_users(on_progress=report_progress)
+    if totals is None:
+        await progress_message.edit_text("❌ Ошибка очистки дублей")
         return
-        
-    await cleanup_duplicate_users()
-    await message.answer("✅ Дублирующиеся пользователи очищены")
+    
+    await progress_message.edit_text(
+        f"✅ Дублирующиеся пользователи очищены: {totals['users']}\n"
+        f"Перенесено заказов: {totals['orders']}, ответов квиза: {totals['quiz_answers']}\n"
+        f"Уникальность tg_id закреплена"
+    )
 
-@dp.message(Command("manager"))
+@dp.message(Command("manager"), IsManager())
 async def manager_command(message: types.Message):
     """Команды для менеджера"""
-    if message.from_user.id != config.ADMIN_ID:
-        await message.answer("⛔ Доступ запрещен")
-        return
-    
     help_text = (
         "👨‍💼 *Панель менеджера*\n\n"
         "*Доступные команды:*\n"
         "• /stats - статистика бота\n"
         "• /users - список пользователей\n"
         "• /orders - список заказов\n"
-        "• /cleanup - очистка дублей\n\n"
+        "• /queue - очереди клиентов по статусам\n"
+        "• /funnel [дней] [xlsx] - воронка и когорты\n"
+        "• /sources, /referrers [дней] - атрибуция трафика\n"
+        "• /quiz_report - ответы квиза и конверсия в оплату\n"
+        "• /pipeline - воронка и время на этапах\n"
+        "• /bulk - массовая команда по списку клиентов или статусу\n"
+        "• /cleanup - очистка дублей\n"
+        "• /reconcile - сверка платежей (админ)\n"
+        "• /profile [секунд | N upd] [folded] - профилирование (админ)\n"
+        "• /managers - список менеджеров (админ)\n\n"
         "*Управление через кнопки:*\n"
         "В карточках клиентов доступны кнопки для управления статусами."
     )
     
     await message.answer(help_text, parse_mode="Markdown")
 
-@dp.message(Command("stats"))
-async def stats_command(message: types.Message):
-    """Статистика бота (только для админа)"""
-    if message.from_user.id != config.ADMIN_ID:
-        await message.answer("⛔ Доступ запрещен")
+@dp.message(Command("bulk"), IsManager())
+async def bulk_command(message: types.Message):
+    """Массовая команда менеджера: /bulk <команда> <id,id,...|status:статус>"""
+    args = message.text.split()[1:]
+    if len(args) != 2:
+        await message.answer(
+            "ℹ️ *Использование:*\n"
+            "`/bulk in_lab 12,15,18` - по списку ID клиентов\n"
+            "`/bulk results_ready status:in_lab` - по текущему статусу",
+            parse_mode="Markdown"
+        )
         return
     
+    command, selector = args
+    user_ids = None
+    status_filter = None
+    if selector.startswith("status:"):
+        status_filter = selector[len("status:"):]
+    else:
+        try:
+            user_ids = [int(user_id) for user_id in selector.split(",") if user_id]
+        except ValueError:
+            await message.answer("❌ ID клиентов должны быть числами через запятую")
+            return
+    
+    progress_message = await message.answer(f"⏳ Выполняется массовая команда {command}...")
+    summary = await manager_bot.bulk_action(command, user_ids=user_ids, status_filter=status_filter,
+                                            progress_message=progress_message,
+                                            manager_tg_id=message.from_user.id)
+    try:
+        await progress_message.edit_text(summary, parse_mode="Markdown")
+    except TelegramBadRequest as e:
+        # Итог важнее разметки: команда уже выполнена, показываем его как есть
+        logger.warning(f"⚠️ Telegram не принял разметку итога массовой команды: {e}")
+        await progress_message.edit_text(summary)
+
+@dp.message(Command("pipeline"), IsManager())
+async def pipeline_command(message: types.Message):
+    """Сводка по этапам воронки из предрассчитанной статистики"""
+    stats = await get_status_stats()
+    
+    pipeline_text = "🧭 *Воронка клиентов:*\n\n"
+    for status in STATUS_LABELS:
+        status_stats = stats.get(status)
+        users_count = status_stats.users_count if status_stats else 0
+        pipeline_text += f"{status_label(status)}: *{users_count}*"
+        if status_stats and status_stats.exits_count:
+            avg_days = status_stats.total_seconds / status_stats.exits_count / 86400
+            pipeline_text += f" (в среднем {avg_days:.1f} дн.)"
+        pipeline_text += "\n"
+    
+    await message.answer(pipeline_text, parse_mode="Markdown")
+
+@dp.message(Command("queue"), IsManager())
+async def queue_command(message: types.Message):
+    """Очереди клиентов: /queue или /queue <статус> [дней]"""
+    args = message.text.split()[1:]
+    
+    if args:
+        status = args[0]
+        if status not in STATUS_LABELS:
+            await message.answer(f"❌ Неизвестный статус. Доступны: {', '.join(STATUS_LABELS)}")
+            return
+        try:
+            min_days = int(args[1]) if len(args) > 1 else 0
+        except ValueError:
+            await message.answer("❌ Количество дней должно быть числом")
+            return
+        queue_text, keyboard = await manager_bot.render_queue_page(status, min_days)
+    else:
+        queue_text, keyboard = await manager_bot.render_queue_overview()
+    
+    await message.answer(queue_text, reply_markup=keyboard, parse_mode="Markdown")
+
+@dp.callback_query(F.data.startswith("queue:") | (F.data == "queue_overview"), IsManager())
+async def queue_page_handler(callback: types.CallbackQuery):
+    """Переключение страниц и очередей"""
+    try:
+        if callback.data == "queue_overview":
+            queue_text, keyboard = await manager_bot.render_queue_overview()
+        else:
+            _, status, min_days, cursor_us, cursor_id = callback.data.split(":")
+            queue_text, keyboard = await manager_bot.render_queue_page(
+                status, int(min_days), int(cursor_us), int(cursor_id)
+            )
+        await callback.message.edit_text(queue_text, reply_markup=keyboard, parse_mode="Markdown")
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"❌ Ошибка отображения очереди: {e}")
+        await callback.answer("❌ Ошибка")
+
+@dp.callback_query(F.data.startswith("open_card:"), IsManager())
+async def open_card_handler(callback: types.CallbackQuery):
+    """Открывает карточку клиента из очереди"""
+    user_id = int(callback.data.split(":")[1])
+    await manager_bot.send_user_card(user_id)
+    await callback.answer()
+
+@dp.message(Command("funnel"), IsManager())
+async def funnel_command(message: types.Message):
+    """Воронка и когорты: /funnel [дней] [xlsx]"""
+    args = message.text.split()[1:]
+    as_xlsx = "xlsx" in args
+    days = next((int(arg) for arg in args if arg.isdigit()), 30)
+    
+    await event_log.flush()
+    report = await build_funnel_report(days, as_xlsx)
+    
+    if as_xlsx:
+        await message.answer_document(
+            types.BufferedInputFile(report, filename=f"funnel_{datetime.now().strftime('%Y%m%d')}_{days}d.xlsx"),
+            caption=f"📈 Воронка и когорты за {days} дн."
+        )
+    else:
+        await message.answer(report, parse_mode="Markdown")
+
+@dp.message(Command("quiz_report"), IsManager())
+async def quiz_report_command(message: types.Message):
+    """Конверсия в оплату по ответам квиза: сводка и XLSX в чат менеджеров"""
+    progress_message = await message.answer("⏳ Считаем конверсию по ответам квиза...")
+    try:
+        report, workbook = await build_quiz_conversion_report()
+    except Exception as e:
+        logger.error(f"❌ Ошибка отчета по квизу: {e}")
+        await progress_message.edit_text("❌ Ошибка построения отчета по квизу")
+        return
+    
+    chat_id = manager_bot.manager_chat_id
+    await bot.send_message(chat_id, report, parse_mode="Markdown")
+    await bot.send_document(
+        chat_id,
+        types.BufferedInputFile(workbook, filename=f"quiz_conversion_{datetime.now().strftime('%Y%m%d')}.xlsx"),
+        caption="🧪 Комбинации ответов квиза и оплаты"
+    )
+    if chat_id != message.chat.id:
+        await progress_message.edit_text("✅ Отчет по квизу отправлен в чат менеджеров")
+    else:
+        await progress_message.delete()
+
+@dp.message(Command("profile"), IsManager(role="admin"))
+async def profile_command(message: types.Message):
+    """Профилирование: /profile [секунд | N upd] [folded]"""
+    args = message.text.split()[1:]
+    with_files = "folded" in args
+    numbers = [int(arg) for arg in args if arg.isdigit()]
+    by_updates = "upd" in args
+    seconds = None if by_updates else (numbers[0] if numbers else 30)
+    updates = numbers[0] if by_updates and numbers else None
+    
+    if profiler.enabled:
+        await message.answer("⏳ Профилирование уже запущено")
+        return
+    
+    limit = f"{updates} обновлений" if updates else f"{seconds} с"
+    progress_message = await message.answer(f"🔬 Профилирование запущено ({limit})...")
+    report = await profiler.run(seconds=seconds, updates=updates)
+    await progress_message.edit_text(report.summary(), parse_mode="Markdown")
+    
+    if with_files:
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        await message.answer_document(
+            types.BufferedInputFile(report.collapsed_wall(), filename=f"profile_wall_{stamp}.folded"),
+            caption="🔥 Время по обработчикам, базе и Bot API (мкс)"
+        )
+        await message.answer_document(
+            types.BufferedInputFile(report.collapsed_samples(), filename=f"profile_samples_{stamp}.folded"),
+            caption="🔥 Сэмплы стека цикла событий"
+        )
+
+@dp.message(Command("sources", "referrers"), IsManager())
+async def sources_command(message: types.Message):
+    """Атрибуция по источникам или рефереерам: /sources [дней], /referrers [дней]"""
+    args = message.text.split()[1:]
+    days = int(args[0]) if args and args[0].isdigit() else 30
+    by_referrer = message.text.lstrip("/").startswith("referrers")
+    
+    await source_rollups.flush()
+    totals = await get_source_totals(days, referrers=by_referrer)
+    
+    title = "🤝 *Рефереры*" if by_referrer else "📣 *Источники*"
+    report = f"{title} *за {days} дн.:*\n\n"
+    if not totals:
+        report += "Нет данных"
+    for row in totals:
+        conversion = round(row.payments / row.new_users * 100, 1) if row.new_users else 0
+        report += (
+            f"• `{row.key}`: {row.new_users} польз. → {row.payments} оплат "
+            f"({conversion}%), {row.revenue:,.0f} руб\n".replace(",", " ")
+        )
+    
+    await message.answer(report, parse_mode="Markdown")
+
+@dp.message(Command("backfill_sources"), IsManager(role="admin"))
+async def backfill_sources_command(message: types.Message):
+    """Пересборка роллапов по источникам из истории"""
+    progress_message = await message.answer("⏳ Пересборка итогов по источникам...")
+    
+    async def report_progress(table: str, done: int, total: int):
+        await progress_message.edit_text(f"⏳ {table}: {done} из {total}")
+    
+    totals = await backfill_source_rollups(on_progress=report_progress)
+    if totals is None:
+        await progress_message.edit_text("❌ Ошибка пересборки итогов по источникам")
+    else:
+        await progress_message.edit_text(
+            f"✅ Итоги пересобраны: пользователи до id {totals['users']}, заказы до id {totals['orders']}"
+        )
+
+@dp.message(Command("stats"), IsManager())
+async def stats_command(message: types.Message):
+    """Статистика бота (только для менеджеров)"""
     from database import AsyncSessionLocal
     from sqlalchemy import text
     
@@ -656,11 +1131,81 @@ async def stats_command(message: types.Message):
         f"📦 *Заказы:* {orders_total}\n"
         f"✅ *Оплаченные заказы:* {paid_orders_total}\n"
         f"💵 *Общая конверсия:* {conversion}%\n"
-        f"🎯 *Конверсия из квиза:* {quiz_conversion}%"
+        f"🎯 *Конверсия из квиза:* {quiz_conversion}%\n"
+        f"📬 *Сэкономлено вызовов API сводками:* {manager_bot.digest_saved_calls}\n"
+        f"🗺 *Справочник городов:* {len(gazetteer.cities)} городов, индекс {gazetteer.memory_bytes() // 1024} КБ\n"
+        f"\n🗂 *Активные сессии:* {len(storage)} (вытеснено {storage.evicted}, напоминаний {storage.nudges_sent})\n"
     )
+    for state_name, count in sorted(storage.state_counts().items(), key=lambda item: -item[1]):
+        stats_text += f"• `{state_name}`: {count}\n"
+    
+    stats_text += "\n🛡 *Автоматы зависимостей:*\n"
+    for name, breaker in breaker_states().items():
+        stats_text += (
+            f"• `{name}`: {breaker['state']}, сбоев {breaker['failures']}, повторов {breaker['retries']}, "
+            f"отклонено {breaker['rejected']}\n"
+        )
     
     await message.answer(stats_text, parse_mode="Markdown")
 
+@dp.message(Command("reconcile"), IsManager(role="admin"))
+async def reconcile_command(message: types.Message):
+    """Ручной запуск сверки ожидающих оплаты заказов"""
+    if not payment_client.enabled:
+        await message.answer("❌ ЮKassa не настроена")
+        return
+    
+    progress_message = await message.answer("⏳ Сверка платежей...")
+    report = await payment_reconciler.run()
+    await progress_message.edit_text(
+        f"💳 *Сверка платежей завершена*\n\n"
+        f"*Проверено:* {report.get('checked', 0)}\n"
+        f"*Оплачено:* {report.get('paid', 0)}\n"
+        f"*Отменено:* {report.get('canceled', 0)}\n"
+        f"*Без ответа:* {report.get('unknown', 0)}\n"
+        f"*Время:* {report.get('elapsed', 0)} с ({report.get('orders_per_second', 0)} заказов/с)",
+        parse_mode="Markdown"
+    )
+
+@dp.message(Command("managers"), IsManager(role="admin"))
+async def managers_command(message: types.Message):
+    """Управление менеджерами: /managers [add <tg_id> [admin] | remove <tg_id>]"""
+    args = message.text.split()[1:]
+    
+    if len(args) >= 2 and args[0] in ("add", "remove"):
+        try:
+            tg_id = int(args[1])
+        except ValueError:
+            await message.answer("❌ Telegram ID должен быть числом")
+            return
+        
+        if args[0] == "add":
+            role = args[2] if len(args) > 2 else "manager"
+            success = await manager_registry.add(tg_id, role)
+        else:
+            success = await manager_registry.remove(tg_id)
+        
+        await message.answer("✅ Список менеджеров обновлен" if success else "❌ Не удалось обновить список менеджеров")
+        return
+    
+    managers = await get_managers() or []
+    managers_text = "👥 *Менеджеры:*\n\n"
+    managers_text += f"• `{config.ADMIN_ID}` - admin (из конфигурации)\n"
+    for manager in managers:
+        managers_text += f"• `{manager.tg_id}` - {manager.role}\n"
+    managers_text += (
+        "\n*Управление:*\n"
+        "`/managers add <tg_id> [admin]`\n"
+        "`/managers remove <tg_id>`"
+    )
+    
+    await message.answer(managers_text, parse_mode="Markdown")
+
+@dp.message(Command("cleanup", "manager", "managers", "bulk", "pipeline", "queue", "reconcile", "funnel", "quiz_report", "profile", "sources", "referrers", "backfill_sources", "stats"))
+async def access_denied_handler(message: types.Message):
+    """Ответ на менеджерские команды от пользователей без прав"""
+    await message.answer("⛔ Доступ запрещен")
+
 # ========== ОБРАБОТЧИК НЕИЗВЕСТНЫХ СООБЩЕНИЙ ==========
 
 @dp.message()
@@ -684,22 +1229,116 @@ async def unknown_message_handler(message: types.Message):
 
 # ========== ОСНОВНАЯ ФУНКЦИЯ ==========
 
+async def start_web_server(port: int, with_payments: bool = True):
+    """Запускает HTTP-сервер: проверки /healthz и /readyz и вебхуки платежей"""
+    app = web.Application()
+    health.setup(app)
+    if with_payments and payment_client.enabled:
+        payment_webhook.setup(app)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, config.WEB_HOST, port).start()
+    logger.info(f"🌐 HTTP-сервер запущен на {config.WEB_HOST}:{port}")
+    return runner
+
+async def start_services(with_payments: bool = True, web_port: int = None):
+    """Запускает фоновые службы процесса; возвращает HTTP-сервер для остановки"""
+    if config.DB_WARMUP:
+        started = time.perf_counter()
+        warmed = await warm_pool()
+        logger.info(f"🔥 Пул базы прогрет: {warmed} соединений за {(time.perf_counter() - started) * 1000:.0f} мс")
+    await manager_registry.load()
+    status_history.start()
+    event_log.start()
+    source_rollups.start()
+    
+    web_runner = await start_web_server(web_port or config.WEB_PORT, with_payments)
+    health.start()
+    if with_payments and payment_client.enabled:
+        scheduler.add_job(payment_reconciler.run, "interval", minutes=config.RECONCILE_INTERVAL_MINUTES,
+                          id="payment_reconciliation", max_instances=1, coalesce=True)
+    if with_payments:
+        # Обслуживание таблиц: в режиме нескольких процессов его выполняет приемник
+        scheduler.add_job(ensure_partitions, "cron", hour=3, id="partitions", max_instances=1, coalesce=True)
+        # Несозданная секция не мешает работе сейчас: проверка не обязательная, ее результат
+        # виден в списке probes ответа /readyz, но готовность процесса не снимает
+        health.add_probe("partitions", check_partitions, required=False)
+        if config.ARCHIVE_AFTER_MONTHS:
+            scheduler.add_job(archive_cold_data, "cron", day=1, hour=4, id="archive", max_instances=1, coalesce=True)
+    # Права, измененные в другом процессе, доходят сюда только через перезагрузку
+    scheduler.add_job(manager_registry.load, "interval", seconds=config.ACL_RELOAD_SECONDS,
+                      id="acl_reload", max_instances=1, coalesce=True)
+    scheduler.add_job(storage.sweep, "interval", seconds=config.FSM_SWEEP_INTERVAL_SECONDS,
+                      id="fsm_sweep", max_instances=1, coalesce=True)
+    scheduler.start()
+    # Таблицы проверены, службы запущены: дальше готовность решают проверки зависимостей
+    health.ready_flag = True
+    return web_runner
+
+async def stop_services(web_runner=None):
+    """Плавная остановка: дождаться обработчиков, отправить и записать накопленное, закрыть соединения"""
+    async def drain_handlers():
+        # Сначала снимаем готовность, чтобы оркестратор перестал слать сюда трафик
+        health.ready_flag = False
+        done, abandoned = await in_flight.drain(config.SHUTDOWN_DRAIN_SECONDS)
+        logger.info(f"⏳ Обработчиков завершено: {done}, прервано: {abandoned}")
+    
+    async def stop_web_server():
+        if web_runner:
+            await web_runner.cleanup()
+        await payment_webhook.drain()
+    
+    async def stop_scheduler():
+        if scheduler.running:
+            scheduler.shutdown(wait=False)
+    
+    async def close_reports():
+        # Ждем процессы пула: в процессе-воркере выход иначе повиснет на join дочерних процессов
+        await asyncio.to_thread(report_renderer.close, True)
+    
+    await run_shutdown([
+        ("обработчики", drain_handlers),
+        ("вебхуки", stop_web_server),
+        ("планировщик", stop_scheduler),
+        ("проверки", health.stop),
+        ("сводка менеджерам", manager_bot.flush_digest),
+        ("история статусов", status_history.stop),
+        ("события воронки", event_log.stop),
+        ("итоги по источникам", source_rollups.stop),
+        ("отчеты", close_reports),
+        ("ЮKassa", payment_client.close),
+        ("Bot API", bot.session.close),
+        ("пул базы", engine.dispose),
+    ], deadline=config.SHUTDOWN_TIMEOUT_SECONDS)
+
+async def on_routed_payment(order_id: int, transaction_id: str):
+    """Оплата, переданная воркеру процессом-приемником (режим нескольких процессов)"""
+    order = await get_order(order_id)
+    if order:
+        await on_order_paid(order, transaction_id)
+
 async def main():
     logger.info("🚀 Запуск бота GenoLife...")
+    web_runner = None
     
     try:
         await create_tables()
         logger.info("✅ База данных настроена")
         
+        web_runner = await start_services()
+        
         # Тестовое сообщение админу
         await bot.send_message(config.ADMIN_ID, "🤖 Бот GenoLife запущен и готов к работе!")
         
-        await dp.start_polling(bot)
+        # Сигналы SIGINT/SIGTERM останавливают получение обновлений, дальше - плавная остановка.
+        # Сессию Bot API закрывает stop_services после дренажа: иначе ответы незавершенных обработчиков потеряются
+        await dp.start_polling(bot, handle_signals=True, close_bot_session=False)
         
     except Exception as e:
         logger.error(f"❌ Ошибка запуска бота: {e}")
     finally:
-        await bot.session.close()
+        await stop_services(web_runner)
 
 if __name__ == "__main__":
     asyncio.run(main())
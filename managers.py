@@ -1,16 +1,149 @@
+import asyncio
 import logging
-from typing import Dict, List
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
 from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
-from database import AsyncSessionLocal, User, Order, get_user_by_tg_id, update_user_status
+from database import (
+    AsyncSessionLocal, User, Order, get_user_by_tg_id, update_user_status,
+    get_user_version, bump_user_version, get_user_card_data,
+    get_bulk_targets, bulk_update_user_status, status_history,
+    get_status_stats, get_users_by_status, set_user_status_if
+)
+from pipeline import STATUS_LABELS, can_transition, status_label
+from acl import manager_registry
+from resilience import CircuitOpenError
+from sender import RateLimitedSender
 from sqlalchemy import select, text
 from config import config
 
 logger = logging.getLogger(__name__)
 
+EPOCH = datetime(1970, 1, 1)
+
+# Лимиты одного сообщения-сводки (Telegram: 4096 символов, 100 кнопок)
+DIGEST_TEXT_LIMIT = 3500
+DIGEST_BUTTONS_LIMIT = 50
+
+def escape_markdown(value) -> str:
+    """Экранирует пользовательский текст для Markdown Telegram (имя, username, город)"""
+    text = str(value)
+    for char in ("_", "*", "`", "["):
+        text = text.replace(char, "\\" + char)
+    return text
+
+# Новый статус клиента для каждой команды менеджера (None - статус не меняется)
+COMMAND_STATUSES = {
+    "send_kit": "kit_sent",
+    "courier": "courier_scheduled",
+    "in_lab": "in_lab",
+    "results_ready": "results_ready",
+    "consult": None,
+    "start_program": "program_started",
+    "fail_collect": "collect_retry",
+}
+
+# Сообщение клиенту для каждой команды менеджера: (текст, клавиатура)
+CLIENT_NOTIFICATIONS = {
+    "send_kit": (
+        "📦 *Ваш набор для анализов отправлен!*\n\n"
+        "Скоро вы получите трек-номер для отслеживания.\n\n"
+        "Ожидайте доставку в ближайшие дни!",
+        None
+    ),
+    "courier": (
+        "🚚 *Курьер назначен!*\n\n"
+        "Скоро с вами свяжутся для уточнения времени визита курьера "
+        "для забора образцов анализов.\n\n"
+        "Пожалуйста, будьте на связи!",
+        None
+    ),
+    "in_lab": (
+        "🧪 *Ваши образцы в лаборатории!*\n\n"
+        "Анализы находятся в обработке. Результаты будут готовы через 7-10 дней.\n\n"
+        "Мы сообщим вам, когда отчет будет готов!",
+        None
+    ),
+    "results_ready": (
+        "🎉 *Ваши результаты готовы!*\n\n"
+        "Вы можете скачать отчет или записаться на консультацию с врачом-экспертом "
+        "для подробного разбора ваших анализов.\n\n"
+        "*Консультация поможет:*\n"
+        "• Понять причины вашего состояния\n"
+        "• Получить персональные рекомендации\n"
+        "• Начать эффективное восстановление",
+        InlineKeyboardMarkup(
+            inline_keyboard=[[
+                InlineKeyboardButton(text="📊 Скачать отчет", callback_data="get_report"),
+                InlineKeyboardButton(text="💬 Консультация", callback_data="book_consult")
+            ]]
+        )
+    ),
+    "consult": (
+        "💬 *Хотите глубже понять ваши результаты?*\n\n"
+        "Наш врач-эксперт проведет онлайн-разбор вашего отчета и объяснит, "
+        "что именно влияет на сон, настроение и восстановление.\n\n"
+        "*После консультации вы получите:*\n"
+        "• Персональные рекомендации\n"
+        "• Понимание вашего гормонального ритма\n"
+        "• План восстановления энергии\n"
+        "• Ответы на все ваши вопросы\n\n"
+        "🎁 *Специальное предложение:* 30% скидка на первую консультацию!",
+        InlineKeyboardMarkup(
+            inline_keyboard=[[
+                InlineKeyboardButton(text="💬 Записаться на консультацию", callback_data="book_consult")
+            ]]
+        )
+    ),
+    "start_program": (
+        "🌱 *Готовы начать 14-дневную программу восстановления?*\n\n"
+        "Каждый день бот будет давать короткие задания и напоминания, "
+        "помогающие вернуть естественный ритм энергии, сна и спокойствия.\n\n"
+        "*Что вас ждет:*\n"
+        "• Ежедневные практики для баланса\n"
+        "• Персональные рекомендации\n"
+        "• Поддержка на каждом этапе\n"
+        "• Измеримые результаты\n\n"
+        "Начните свой путь к лучшему самочувствию уже сегодня!",
+        InlineKeyboardMarkup(
+            inline_keyboard=[[
+                InlineKeyboardButton(text="🌱 Начать программу", callback_data="start_program")
+            ]]
+        )
+    ),
+    "fail_collect": (
+        "🔄 *Давайте попробуем собрать анализы еще раз!*\n\n"
+        "Вы можете запланировать сбор на другой день. "
+        "Если нужна помощь или есть вопросы - свяжитесь с менеджером.\n\n"
+        "*Советы для успешного сбора:*\n"
+        "• Следуйте инструкции\n"
+        "• Выберите удобное время\n"
+        "• Подготовьте все необходимое заранее",
+        InlineKeyboardMarkup(
+            inline_keyboard=[[
+                InlineKeyboardButton(text="🔄 Повторить сбор завтра", callback_data="retry_collect"),
+                InlineKeyboardButton(text="📞 Связаться с менеджером", callback_data="contact_manager")
+            ]]
+        )
+    ),
+}
+
 class ManagerBot:
     def __init__(self, bot: Bot):
         self.bot = bot
+        self.sender = RateLimitedSender(bot)
+        # Живые карточки клиентов: user_id -> (chat_id, message_id, версия данных)
+        self.live_cards: Dict[int, Tuple[int, int, Optional[int]]] = {}
+        # Кэш отрисованных карточек: user_id -> (версия данных, текст, клавиатура)
+        # user_id -> (версия данных, время сборки, текст, клавиатура)
+        self._card_cache: "OrderedDict[int, Tuple[int, float, str, InlineKeyboardMarkup]]" = OrderedDict()
+        # Сводка событий для менеджеров: (тип события, текст, user_id)
+        self._digest_events: List[Tuple[str, str, Optional[int]]] = []
+        self._digest_task = None
+        self.digest_saved_calls = 0
 
     async def notify_managers(self, message: str, parse_mode="Markdown"):
         """Отправляет уведомление менеджерам"""
@@ -36,57 +169,200 @@ class ManagerBot:
         except Exception as e:
             logger.error(f"❌ Ошибка отправки уведомления менеджерам: {e}")
 
+    async def push_event(self, event_type: str, message: str, user_id: int = None, order_id: int = None):
+        """Ставит событие в сводку менеджерам; срочные события отправляются сразу"""
+        if event_type in config.URGENT_EVENT_TYPES or config.DIGEST_WINDOW_SECONDS <= 0:
+            await self.notify_managers(message)
+            if user_id:
+                await self.send_user_card(user_id, order_id)
+            return
+
+        self._digest_events.append((event_type, message, user_id))
+        logger.info(f"📬 Событие {event_type} добавлено в сводку ({len(self._digest_events)} в очереди)")
+
+        if len(self._digest_events) >= config.DIGEST_MAX_EVENTS:
+            await self.flush_digest()
+        elif self._digest_task is None or self._digest_task.done():
+            self._digest_task = asyncio.get_running_loop().create_task(self._flush_digest_later())
+
+    async def _flush_digest_later(self):
+        await asyncio.sleep(config.DIGEST_WINDOW_SECONDS)
+        await self.flush_digest()
+
+    async def flush_digest(self):
+        """Отправляет накопленные события одним сообщением (или несколькими, если не влезают)"""
+        events, self._digest_events = self._digest_events, []
+        if not events:
+            return
+
+        expected_calls = sent_calls = 0
+        chunks = list(self._split_digest(events))
+
+        for index, chunk in enumerate(chunks):
+            digest_text = f"📬 *Сводка событий ({len(chunk)}):*\n\n" + "\n\n➖➖➖\n\n".join(
+                message for _, message, _ in chunk
+            )
+            user_ids = list(dict.fromkeys(user_id for _, _, user_id in chunk if user_id))
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text=f"👤 Карточка клиента #{user_id}", callback_data=f"open_card:{user_id}")]
+                for user_id in user_ids
+            ]) if user_ids else None
+
+            try:
+                try:
+                    await self.bot.send_message(chat_id=self.manager_chat_id, text=digest_text,
+                                                reply_markup=keyboard, parse_mode="Markdown")
+                except TelegramBadRequest as e:
+                    # Разметку сломал текст события - события важнее форматирования
+                    logger.warning(f"⚠️ Telegram не принял разметку сводки, отправляем без нее: {e}")
+                    await self.bot.send_message(chat_id=self.manager_chat_id, text=digest_text,
+                                                reply_markup=keyboard, parse_mode=None)
+                sent_calls += 1
+                # Без сводки каждое событие стоило бы текст + карточку клиента
+                expected_calls += sum(2 if user_id else 1 for _, _, user_id in chunk)
+            except (TelegramNetworkError, TelegramServerError, TelegramRetryAfter, CircuitOpenError) as e:
+                # Временный сбой: неотправленные события вернутся в следующую сводку
+                unsent = [event for rest in chunks[index:] for event in rest]
+                self._digest_events = unsent + self._digest_events
+                self._schedule_digest_retry()
+                logger.error(f"❌ Сводка менеджерам не отправлена, {len(unsent)} событий отложено: {e}")
+                break
+            except Exception as e:
+                logger.error(f"❌ Ошибка отправки сводки менеджерам, {len(chunk)} событий потеряно: {e}")
+
+        self.digest_saved_calls += expected_calls - sent_calls
+        logger.info(
+            f"📬 Сводка из {len(events)} событий: отправлено {sent_calls} сообщений вместо {expected_calls} "
+            f"(всего сэкономлено {self.digest_saved_calls})"
+        )
+
+    def _schedule_digest_retry(self):
+        # Сброс мог быть вызван из самой отложенной задачи - она уже не повторит
+        current = asyncio.current_task()
+        if self._digest_task is None or self._digest_task.done() or self._digest_task is current:
+            self._digest_task = asyncio.get_running_loop().create_task(self._flush_digest_later())
+
+    @staticmethod
+    def _split_digest(events: List[Tuple[str, str, Optional[int]]]):
+        """Делит события на сообщения в пределах лимитов Telegram"""
+        chunk, chunk_length, chunk_users = [], 0, set()
+        for event in events:
+            _, message, user_id = event
+            new_users = chunk_users | ({user_id} if user_id else set())
+            if chunk and (chunk_length + len(message) > DIGEST_TEXT_LIMIT or len(new_users) > DIGEST_BUTTONS_LIMIT):
+                yield chunk
+                chunk, chunk_length, new_users = [], 0, ({user_id} if user_id else set())
+            chunk.append(event)
+            chunk_length += len(message) + 20
+            chunk_users = new_users
+        if chunk:
+            yield chunk
+
+    @property
+    def manager_chat_id(self):
+        """Чат, куда публикуются карточки клиентов"""
+        return config.MANAGER_GROUP_ID or config.ADMIN_ID
+
     async def send_user_card(self, user_id: int, order_id: int = None):
         """Отправляет карточку клиента менеджерам"""
         try:
             logger.info(f"📋 Формирование карточки клиента {user_id}")
-            
-            async with AsyncSessionLocal() as session:
-                # Получаем данные пользователя
-                user = await session.get(User, user_id)
-                if not user:
-                    logger.error(f"❌ Пользователь {user_id} не найден")
-                    return
 
-                # Получаем заказы пользователя
-                orders_result = await session.execute(
-                    select(Order).where(Order.user_id == user_id).order_by(Order.created_at.desc())
-                )
-                orders_list = orders_result.scalars().all()
+            # Версию берем до чтения данных: запись во время чтения даст повторный рендер
+            version = get_user_version(user_id)
+            card = await self._build_user_card(user_id, version, order_id)
+            if not card:
+                return
+
+            card_text, keyboard = card
+            await self._post_user_card(user_id, card_text, keyboard, version)
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправки карточки клиента: {e}")
 
-                # Получаем ответы квиза
-                quiz_answers = await session.execute(
-                    text("SELECT question_id, answer FROM quiz_answers WHERE user_id = :user_id"),
-                    {"user_id": user_id}
+    async def refresh_user_card(self, user_id: int, chat_id: int = None, message_id: int = None, order_id: int = None):
+        """Обновляет живую карточку клиента на месте вместо отправки новой"""
+        try:
+            live_card = self.live_cards.get(user_id)
+
+            # Карточка, на которой нажали кнопку, становится живой
+            if chat_id and message_id and (not live_card or live_card[:2] != (chat_id, message_id)):
+                live_card = (chat_id, message_id, None)
+                self.live_cards[user_id] = live_card
+
+            if not live_card:
+                await self.send_user_card(user_id, order_id)
+                return
+
+            chat_id, message_id, rendered_version = live_card
+            version = get_user_version(user_id)
+            if version == rendered_version:
+                logger.debug(f"📋 Карточка клиента {user_id} актуальна (версия {version})")
+                return
+
+            card = await self._build_user_card(user_id, version, order_id)
+            if not card:
+                return
+
+            card_text, keyboard = card
+            try:
+                await self.bot.edit_message_text(
+                    text=card_text,
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    reply_markup=keyboard,
+                    parse_mode="Markdown"
                 )
-                quiz_data = quiz_answers.fetchall()
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    logger.warning(f"⚠️ Не удалось обновить карточку клиента {user_id}: {e}")
+                    await self._post_user_card(user_id, card_text, keyboard, version)
+                    return
 
-                # Формируем карточку клиента
-                card_text = self._format_user_card(user, orders_list, quiz_data)
-                
-                # Создаем клавиатуру с командами менеджера
-                keyboard = self._create_manager_keyboard(user_id, order_id)
-
-                # Отправляем карточку
-                if config.MANAGER_GROUP_ID:
-                    await self.bot.send_message(
-                        chat_id=config.MANAGER_GROUP_ID,
-                        text=card_text,
-                        reply_markup=keyboard,
-                        parse_mode="Markdown"
-                    )
-                    logger.info(f"✅ Карточка клиента {user_id} отправлена в группу")
-                else:
-                    await self.bot.send_message(
-                        chat_id=config.ADMIN_ID,
-                        text=card_text,
-                        reply_markup=keyboard,
-                        parse_mode="Markdown"
-                    )
-                    logger.info(f"✅ Карточка клиента {user_id} отправлена админу")
+            self.live_cards[user_id] = (chat_id, message_id, version)
+            logger.info(f"✅ Карточка клиента {user_id} обновлена (версия {version})")
 
         except Exception as e:
-            logger.error(f"❌ Ошибка отправки карточки клиента: {e}")
+            logger.error(f"❌ Ошибка обновления карточки клиента: {e}")
+
+    async def _build_user_card(self, user_id: int, version: int, order_id: int = None):
+        """Возвращает текст карточки и клавиатуру, используя кэш по версии данных"""
+        cached = self._card_cache.get(user_id)
+        # Срок жизни страхует от записей в других процессах, о которых версия не знает
+        if cached and cached[0] == version and time.monotonic() - cached[1] < config.CARD_CACHE_TTL:
+            self._card_cache.move_to_end(user_id)
+            return cached[2], cached[3]
+
+        card_data = await get_user_card_data(user_id)
+        if not card_data:
+            logger.error(f"❌ Пользователь {user_id} не найден")
+            return None
+
+        user, orders_list, quiz_data = card_data
+
+        # Формируем карточку клиента
+        card_text = self._format_user_card(user, orders_list, quiz_data)
+
+        # Клавиатура зависит только от клиента, поэтому переиспользуем ее между версиями
+        keyboard = cached[3] if cached else self._create_manager_keyboard(user_id, order_id)
+
+        self._card_cache[user_id] = (version, time.monotonic(), card_text, keyboard)
+        self._card_cache.move_to_end(user_id)
+        while len(self._card_cache) > config.CARD_CACHE_SIZE:
+            self._card_cache.popitem(last=False)
+
+        return card_text, keyboard
+
+    async def _post_user_card(self, user_id: int, card_text: str, keyboard: InlineKeyboardMarkup, version: int):
+        """Публикует новую карточку и запоминает ее как живую"""
+        sent = await self.bot.send_message(
+            chat_id=self.manager_chat_id,
+            text=card_text,
+            reply_markup=keyboard,
+            parse_mode="Markdown"
+        )
+        self.live_cards[user_id] = (sent.chat.id, sent.message_id, version)
+        logger.info(f"✅ Карточка клиента {user_id} отправлена в чат {self.manager_chat_id}")
 
     def _format_user_card(self, user: User, orders: List[Order], quiz_data: List) -> str:
         """Форматирует карточку клиента"""
@@ -182,38 +458,58 @@ class ManagerBot:
 
                 # Обрабатываем команды
                 if command == "send_kit":
-                    return await self._handle_send_kit(user, session)
+                    return await self._handle_send_kit(user, session, manager_tg_id)
                 elif command == "courier":
-                    return await self._handle_courier(user, session)
+                    return await self._handle_courier(user, session, manager_tg_id)
                 elif command == "in_lab":
-                    return await self._handle_in_lab(user, session)
+                    return await self._handle_in_lab(user, session, manager_tg_id)
                 elif command == "results_ready":
-                    return await self._handle_results_ready(user, session)
+                    return await self._handle_results_ready(user, session, manager_tg_id)
                 elif command == "consult":
-                    return await self._handle_consult(user, session)
+                    return await self._handle_consult(user, session, manager_tg_id)
                 elif command == "start_program":
-                    return await self._handle_start_program(user, session)
+                    return await self._handle_start_program(user, session, manager_tg_id)
                 elif command == "fail_collect":
-                    return await self._handle_fail_collect(user, session)
+                    return await self._handle_fail_collect(user, session, manager_tg_id)
 
         except Exception as e:
             logger.error(f"❌ Ошибка обработки команды менеджера: {e}")
             return "❌ Ошибка выполнения команды"
 
-    async def _handle_send_kit(self, user: User, session):
+    async def _apply_command(self, user: User, session, command: str, manager_tg_id: int = None) -> Optional[str]:
+        """Меняет статус клиента по таблице переходов и отправляет ему уведомление.
+
+        Возвращает текст ошибки, если переход недопустим.
+        """
+        new_status = COMMAND_STATUSES.get(command)
+        if new_status:
+            if not can_transition(user.status, new_status):
+                logger.warning(f"⛔ Недопустимый переход клиента {user.id}: {user.status} -> {new_status}")
+                return f"⛔ Нельзя перевести из «{status_label(user.status)}» в «{status_label(new_status)}»"
+
+            previous_status, entered_at = user.status, user.status_updated_at
+            if not await set_user_status_if(session, user.id, previous_status, new_status, datetime.utcnow()):
+                logger.warning(f"⛔ Статус клиента {user.id} изменился во время команды {command}")
+                return "⛔ Статус клиента уже изменился, обновите карточку"
+            await session.commit()
+            bump_user_version(user.id)
+            status_history.record(user.id, previous_status, new_status, manager_tg_id, entered_at)
+
+        message_text, keyboard = CLIENT_NOTIFICATIONS[command]
+        await self.bot.send_message(
+            user.tg_id,
+            message_text,
+            reply_markup=keyboard,
+            parse_mode="Markdown"
+        )
+        return None
+
+    async def _handle_send_kit(self, user: User, session, manager_tg_id: int = None):
         """Обработчик отправки набора"""
         try:
-            user.status = 'kit_sent'
-            await session.commit()
-            
-            # Уведомляем клиента
-            await self.bot.send_message(
-                user.tg_id,
-                "📦 *Ваш набор для анализов отправлен!*\n\n"
-                "Скоро вы получите трек-номер для отслеживания.\n\n"
-                "Ожидайте доставку в ближайшие дни!",
-                parse_mode="Markdown"
-            )
+            error = await self._apply_command(user, session, "send_kit", manager_tg_id)
+            if error:
+                return error
             
             logger.info(f"✅ Набор отправлен клиенту {user.first_name} (ID: {user.id})")
             return f"✅ Набор отправлен клиенту {user.first_name}"
@@ -222,20 +518,12 @@ class ManagerBot:
             logger.error(f"❌ Ошибка отправки набора: {e}")
             return f"❌ Ошибка отправки набора"
 
-    async def _handle_courier(self, user: User, session):
+    async def _handle_courier(self, user: User, session, manager_tg_id: int = None):
         """Обработчик назначения курьера"""
         try:
-            user.status = 'courier_scheduled'
-            await session.commit()
-            
-            await self.bot.send_message(
-                user.tg_id,
-                "🚚 *Курьер назначен!*\n\n"
-                "Скоро с вами свяжутся для уточнения времени визита курьера "
-                "для забора образцов анализов.\n\n"
-                "Пожалуйста, будьте на связи!",
-                parse_mode="Markdown"
-            )
+            error = await self._apply_command(user, session, "courier", manager_tg_id)
+            if error:
+                return error
             
             logger.info(f"✅ Курьер назначен для {user.first_name} (ID: {user.id})")
             return f"✅ Курьер назначен для {user.first_name}"
@@ -244,19 +532,12 @@ class ManagerBot:
             logger.error(f"❌ Ошибка назначения курьера: {e}")
             return f"❌ Ошибка назначения курьера"
 
-    async def _handle_in_lab(self, user: User, session):
+    async def _handle_in_lab(self, user: User, session, manager_tg_id: int = None):
         """Обработчик статуса 'В лаборатории'"""
         try:
-            user.status = 'in_lab'
-            await session.commit()
-            
-            await self.bot.send_message(
-                user.tg_id,
-                "🧪 *Ваши образцы в лаборатории!*\n\n"
-                "Анализы находятся в обработке. Результаты будут готовы через 7-10 дней.\n\n"
-                "Мы сообщим вам, когда отчет будет готов!",
-                parse_mode="Markdown"
-            )
+            error = await self._apply_command(user, session, "in_lab", manager_tg_id)
+            if error:
+                return error
             
             logger.info(f"✅ Статус обновлен: в лаборатории ({user.first_name}, ID: {user.id})")
             return f"✅ Статус обновлен: в лаборатории ({user.first_name})"
@@ -265,31 +546,12 @@ class ManagerBot:
             logger.error(f"❌ Ошибка обновления статуса лаборатории: {e}")
             return f"❌ Ошибка обновления статуса"
 
-    async def _handle_results_ready(self, user: User, session):
+    async def _handle_results_ready(self, user: User, session, manager_tg_id: int = None):
         """Обработчик готовности результатов"""
         try:
-            user.status = 'results_ready'
-            await session.commit()
-            
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[[
-                    InlineKeyboardButton(text="📊 Скачать отчет", callback_data="get_report"),
-                    InlineKeyboardButton(text="💬 Консультация", callback_data="book_consult")
-                ]]
-            )
-            
-            await self.bot.send_message(
-                user.tg_id,
-                "🎉 *Ваши результаты готовы!*\n\n"
-                "Вы можете скачать отчет или записаться на консультацию с врачом-экспертом "
-                "для подробного разбора ваших анализов.\n\n"
-                "*Консультация поможет:*\n"
-                "• Понять причины вашего состояния\n"
-                "• Получить персональные рекомендации\n"
-                "• Начать эффективное восстановление",
-                reply_markup=keyboard,
-                parse_mode="Markdown"
-            )
+            error = await self._apply_command(user, session, "results_ready", manager_tg_id)
+            if error:
+                return error
             
             logger.info(f"✅ Результаты готовы для {user.first_name} (ID: {user.id})")
             return f"✅ Результаты готовы для {user.first_name}"
@@ -298,29 +560,12 @@ class ManagerBot:
             logger.error(f"❌ Ошибка уведомления о результатах: {e}")
             return f"❌ Ошибка уведомления"
 
-    async def _handle_consult(self, user: User, session):
+    async def _handle_consult(self, user: User, session, manager_tg_id: int = None):
         """Обработчик предложения консультации"""
         try:
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[[
-                    InlineKeyboardButton(text="💬 Записаться на консультацию", callback_data="book_consult")
-                ]]
-            )
-            
-            await self.bot.send_message(
-                user.tg_id,
-                "💬 *Хотите глубже понять ваши результаты?*\n\n"
-                "Наш врач-эксперт проведет онлайн-разбор вашего отчета и объяснит, "
-                "что именно влияет на сон, настроение и восстановление.\n\n"
-                "*После консультации вы получите:*\n"
-                "• Персональные рекомендации\n"
-                "• Понимание вашего гормонального ритма\n"
-                "• План восстановления энергии\n"
-                "• Ответы на все ваши вопросы\n\n"
-                "🎁 *Специальное предложение:* 30% скидка на первую консультацию!",
-                reply_markup=keyboard,
-                parse_mode="Markdown"
-            )
+            error = await self._apply_command(user, session, "consult", manager_tg_id)
+            if error:
+                return error
             
             logger.info(f"✅ Консультация предложена {user.first_name} (ID: {user.id})")
             return f"✅ Предложение консультации отправлено {user.first_name}"
@@ -329,32 +574,12 @@ class ManagerBot:
             logger.error(f"❌ Ошибка предложения консультации: {e}")
             return f"❌ Ошибка отправки предложения"
 
-    async def _handle_start_program(self, user: User, session):
+    async def _handle_start_program(self, user: User, session, manager_tg_id: int = None):
         """Обработчик запуска 14-дневной программы"""
         try:
-            user.status = 'program_started'
-            await session.commit()
-            
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[[
-                    InlineKeyboardButton(text="🌱 Начать программу", callback_data="start_program")
-                ]]
-            )
-            
-            await self.bot.send_message(
-                user.tg_id,
-                "🌱 *Готовы начать 14-дневную программу восстановления?*\n\n"
-                "Каждый день бот будет давать короткие задания и напоминания, "
-                "помогающие вернуть естественный ритм энергии, сна и спокойствия.\n\n"
-                "*Что вас ждет:*\n"
-                "• Ежедневные практики для баланса\n"
-                "• Персональные рекомендации\n"
-                "• Поддержка на каждом этапе\n"
-                "• Измеримые результаты\n\n"
-                "Начните свой путь к лучшему самочувствию уже сегодня!",
-                reply_markup=keyboard,
-                parse_mode="Markdown"
-            )
+            error = await self._apply_command(user, session, "start_program", manager_tg_id)
+            if error:
+                return error
             
             logger.info(f"✅ Программа предложена {user.first_name} (ID: {user.id})")
             return f"✅ Программа предложена {user.first_name}"
@@ -363,31 +588,12 @@ class ManagerBot:
             logger.error(f"❌ Ошибка запуска программы: {e}")
             return f"❌ Ошибка предложения программы"
 
-    async def _handle_fail_collect(self, user: User, session):
+    async def _handle_fail_collect(self, user: User, session, manager_tg_id: int = None):
         """Обработчик повторного сбора"""
         try:
-            user.status = 'collect_retry'
-            await session.commit()
-            
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[[
-                    InlineKeyboardButton(text="🔄 Повторить сбор завтра", callback_data="retry_collect"),
-                    InlineKeyboardButton(text="📞 Связаться с менеджером", callback_data="contact_manager")
-                ]]
-            )
-            
-            await self.bot.send_message(
-                user.tg_id,
-                "🔄 *Давайте попробуем собрать анализы еще раз!*\n\n"
-                "Вы можете запланировать сбор на другой день. "
-                "Если нужна помощь или есть вопросы - свяжитесь с менеджером.\n\n"
-                "*Советы для успешного сбора:*\n"
-                "• Следуйте инструкции\n"
-                "• Выберите удобное время\n"
-                "• Подготовьте все необходимое заранее",
-                reply_markup=keyboard,
-                parse_mode="Markdown"
-            )
+            error = await self._apply_command(user, session, "fail_collect", manager_tg_id)
+            if error:
+                return error
             
             logger.info(f"✅ Повторный сбор предложен {user.first_name} (ID: {user.id})")
             return f"✅ Предложение повторного сбора отправлено {user.first_name}"
@@ -396,12 +602,118 @@ class ManagerBot:
             logger.error(f"❌ Ошибка предложения повторного сбора: {e}")
             return f"❌ Ошибка предложения повторного сбора"
 
+    async def bulk_action(self, command: str, user_ids: List[int] = None, status_filter: str = None,
+                          progress_message: Message = None, manager_tg_id: int = None) -> str:
+        """Применяет команду менеджера сразу к группе клиентов"""
+        try:
+            if command not in CLIENT_NOTIFICATIONS:
+                return f"❌ Неизвестная команда: {command}"
+
+            logger.info(f"📦 Массовая команда {command}: ids={user_ids}, статус={status_filter}")
+
+            targets = await get_bulk_targets(user_ids=user_ids, status=status_filter)
+            if not targets:
+                return "❌ Клиенты не найдены"
+
+            selected = len(targets)
+            new_status = COMMAND_STATUSES.get(command)
+            if new_status:
+                # Недопустимые переходы отсекаются в самом UPDATE
+                targets = await bulk_update_user_status([row.id for row in targets], new_status, manager_tg_id)
+                if not targets:
+                    return f"⛔ Ни один из {selected} клиентов не может перейти в «{status_label(new_status)}»"
+
+            async def report_progress(done: int, total: int, failed: int):
+                if progress_message:
+                    await progress_message.edit_text(
+                        f"⏳ `{command}`: отправлено {done} из {total} (ошибок: {failed})",
+                        parse_mode="Markdown"
+                    )
+
+            message_text, keyboard = CLIENT_NOTIFICATIONS[command]
+            sent, failed = await self.sender.send_many(
+                ((row.tg_id, message_text, {"reply_markup": keyboard, "parse_mode": "Markdown"}) for row in targets),
+                on_progress=report_progress
+            )
+
+            summary = (
+                f"✅ *Массовая команда выполнена:* `{command}`\n\n"
+                f"*Выбрано клиентов:* {selected}\n"
+                f"*Обработано:* {len(targets)}\n"
+                f"*Новый статус:* {status_label(new_status) if new_status else 'без изменений'}\n"
+                f"*Уведомлено:* {sent}\n"
+                f"*Ошибок отправки:* {failed}"
+            )
+            logger.info(f"✅ Массовая команда {command}: {len(targets)} клиентов, отправлено {sent}, ошибок {failed}")
+            return summary
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка массовой команды {command}: {e}")
+            return "❌ Ошибка выполнения массовой команды"
+
+    async def render_queue_overview(self):
+        """Сводка очередей: число клиентов в каждом статусе воронки"""
+        stats = await get_status_stats()
+
+        queue_text = "📋 *Очереди клиентов:*\n\n"
+        keyboard = []
+        for status in STATUS_LABELS:
+            status_stats = stats.get(status)
+            users_count = status_stats.users_count if status_stats else 0
+            queue_text += f"{status_label(status)}: *{users_count}*\n"
+            if users_count:
+                keyboard.append([InlineKeyboardButton(
+                    text=f"{status_label(status)} ({users_count})",
+                    callback_data=f"queue:{status}:0:0:0"
+                )])
+
+        queue_text += "\nДолго ожидающие: `/queue <статус> <дней>`"
+        return queue_text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+    async def render_queue_page(self, status: str, min_days: int = 0, cursor_us: int = 0, cursor_id: int = 0):
+        """Страница очереди: клиенты в статусе, от дольше всех ожидающих"""
+        now = datetime.utcnow()
+        older_than = now - timedelta(days=min_days) if min_days else None
+        after = (EPOCH + timedelta(microseconds=cursor_us), cursor_id) if cursor_id else None
+
+        rows = await get_users_by_status(status, older_than=older_than, after=after,
+                                         limit=config.QUEUE_PAGE_SIZE + 1)
+        has_next = len(rows) > config.QUEUE_PAGE_SIZE
+        rows = rows[:config.QUEUE_PAGE_SIZE]
+
+        queue_text = f"📋 *Очередь:* {status_label(status)}"
+        if min_days:
+            queue_text += f" (дольше {min_days} дн.)"
+        queue_text += "\n\n"
+        if not rows:
+            queue_text += "Клиентов нет"
+
+        keyboard = []
+        for row in rows:
+            waiting_days = (now - row.status_updated_at).days if row.status_updated_at else 0
+            keyboard.append([InlineKeyboardButton(
+                text=f"👤 {row.first_name or row.username or row.id} · {waiting_days} дн.",
+                callback_data=f"open_card:{row.id}"
+            )])
+
+        navigation = []
+        if cursor_id:
+            navigation.append(InlineKeyboardButton(text="⏮ В начало", callback_data=f"queue:{status}:{min_days}:0:0"))
+        if has_next:
+            last = rows[-1]
+            last_us = (last.status_updated_at - EPOCH) // timedelta(microseconds=1)
+            navigation.append(InlineKeyboardButton(
+                text="Далее ▶️", callback_data=f"queue:{status}:{min_days}:{last_us}:{last.id}"
+            ))
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.append([InlineKeyboardButton(text="🔙 Все очереди", callback_data="queue_overview")])
+
+        return queue_text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
     async def is_manager(self, tg_id: int) -> bool:
         """Проверяет, является ли пользователь менеджером"""
-        # В MVP считаем админа менеджером
-        is_manager = tg_id == config.ADMIN_ID
-        logger.info(f"🔐 Проверка прав менеджера: {tg_id} -> {is_manager}")
-        return is_manager
+        return manager_registry.is_manager(tg_id)
 
 # Создаем глобальный экземпляр
 manager_bot = None
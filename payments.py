@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import uuid
+from typing import Awaitable, Callable, Optional
+import aiohttp
+from aiohttp import web
+from config import config
+from database import Order, get_order_by_transaction_id, mark_orders_paid, set_order_transaction
+
+logger = logging.getLogger(__name__)
+
+class YooKassaClient:
+    """Клиент API ЮKassa на одной общей сессии aiohttp с пулом соединений"""
+
+    def __init__(self, shop_id: str = None, secret_key: str = None, api_url: str = None):
+        self.shop_id = shop_id if shop_id is not None else config.YOOKASSA_SHOP_ID
+        self.secret_key = secret_key if secret_key is not None else config.YOOKASSA_SECRET_KEY
+        self.api_url = (api_url or config.YOOKASSA_API_URL).rstrip("/")
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.shop_id and self.secret_key)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Создает общую сессию при первом обращении"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(self.shop_id, self.secret_key),
+                connector=aiohttp.TCPConnector(limit=config.YOOKASSA_POOL_SIZE, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=config.YOOKASSA_TIMEOUT),
+            )
+        return self._session
+
+    @staticmethod
+    def idempotence_key(order_id: int) -> str:
+        """Ключ идемпотентности: повторное создание платежа по заказу вернет тот же платеж"""
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f"genolife-order-{order_id}"))
+
+    async def create_payment(self, order_id: int, amount: float, description: str = None) -> Optional[dict]:
+        """Создает платеж в ЮKassa и привязывает его к заказу"""
+        try:
+            payload = {
+                "amount": {"value": f"{amount:.2f}", "currency": "RUB"},
+                "capture": True,
+                "confirmation": {"type": "redirect", "return_url": config.YOOKASSA_RETURN_URL},
+                "description": description or f"Заказ #{order_id} GenoLife",
+                "metadata": {"order_id": str(order_id)},
+            }
+            async with self._get_session().post(
+                f"{self.api_url}/payments",
+                json=payload,
+                headers={"Idempotence-Key": self.idempotence_key(order_id)}
+            ) as response:
+                if response.status >= 400:
+                    logger.error(f"❌ ЮKassa вернула {response.status} при создании платежа по заказу #{order_id}: "
+                                 f"{await response.text()}")
+                    return None
+                payment = await response.json()
+
+            await set_order_transaction(order_id, payment["id"])
+            logger.info(f"💳 Создан платеж {payment['id']} для заказа #{order_id}")
+            return payment
+        except Exception as e:
+            logger.error(f"❌ Ошибка создания платежа для заказа #{order_id}: {e}")
+            return None
+
+    async def get_payment(self, payment_id: str) -> Optional[dict]:
+        """Получает актуальное состояние платежа"""
+        try:
+            async with self._get_session().get(f"{self.api_url}/payments/{payment_id}") as response:
+                if response.status >= 400:
+                    logger.error(f"❌ ЮKassa вернула {response.status} для платежа {payment_id}")
+                    return None
+                return await response.json()
+        except Exception as e:
+            logger.error(f"❌ Ошибка получения платежа {payment_id}: {e}")
+            return None
+
+    async def close(self):
+        """Закрывает общую сессию"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+payment_client = YooKassaClient()
+
+PaidCallback = Callable[[Order, str], Awaitable[None]]
+
+class PaymentWebhook:
+    """Прием уведомлений ЮKassa о платежах"""
+
+    def __init__(self, client: YooKassaClient, on_paid: PaidCallback):
+        self.client = client
+        self.on_paid = on_paid
+        # Платежи, уведомления по которым обрабатываются прямо сейчас
+        self._in_flight = set()
+        self._tasks = set()
+        self.processed = 0
+        self.duplicates = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """Обработчик POST-уведомления ЮKassa"""
+        try:
+            notification = await request.json()
+        except Exception:
+            return web.Response(status=400)
+
+        event = notification.get("event")
+        payment = notification.get("object") or {}
+        payment_id = payment.get("id")
+        if event != "payment.succeeded" or not payment_id:
+            return web.Response(status=200)
+
+        # Одновременные повторы одного уведомления отсекаем без похода в базу
+        if payment_id in self._in_flight:
+            self.duplicates += 1
+            return web.Response(status=200)
+
+        self._in_flight.add(payment_id)
+        try:
+            order = await get_order_by_transaction_id(payment_id)
+            if not order:
+                # Уведомление могло обогнать запись id платежа в заказ - пусть ЮKassa повторит
+                logger.warning(f"⚠️ Уведомление о неизвестном платеже {payment_id}, ждем повтора")
+                return web.Response(status=503)
+
+            if order.payment_status == 'paid':
+                self.duplicates += 1
+                logger.info(f"🔁 Повторное уведомление о платеже {payment_id} пропущено")
+                return web.Response(status=200)
+
+            # Уведомлению не доверяем: сверяем статус платежа с API
+            if config.YOOKASSA_VERIFY_WEBHOOKS:
+                actual = await self.client.get_payment(payment_id)
+                if not actual:
+                    return web.Response(status=502)
+                if actual.get("status") != "succeeded":
+                    logger.warning(f"⚠️ Платеж {payment_id} в статусе {actual.get('status')}, уведомление отклонено")
+                    return web.Response(status=200)
+
+            paid = await mark_orders_paid([order.id], payment_id)
+            if paid is None:
+                # 5xx - ЮKassa повторит уведомление позже
+                return web.Response(status=500)
+            if not paid:
+                # Заказ уже отметили кнопка «Я оплатил» или сверка (возможно, в другом процессе)
+                self.duplicates += 1
+                logger.info(f"🔁 Платеж {payment_id} уже учтен")
+                return web.Response(status=200)
+
+            self.processed += 1
+            logger.info(f"✅ Платеж {payment_id} подтвержден для заказа #{order.id}")
+            task = asyncio.get_running_loop().create_task(self._notify_paid(paid[0], payment_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return web.Response(status=200)
+        finally:
+            self._in_flight.discard(payment_id)
+
+    async def _notify_paid(self, order: Order, payment_id: str):
+        try:
+            await self.on_paid(order, payment_id)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки оплаченного заказа #{order.id}: {e}")
+
+    async def drain(self):
+        """Дожидается обработки уже подтвержденных платежей"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def setup(self, app: web.Application):
+        """Регистрирует маршрут вебхука в приложении aiohttp"""
+        app.router.add_post(config.YOOKASSA_WEBHOOK_PATH, self.handle)
@@ -0,0 +1,49 @@
+from typing import Optional
+
+# Любой исходный статус
+ANY_STATUS = "*"
+
+# Этапы воронки клиента в порядке прохождения
+STATUS_LABELS = {
+    "lead": "🆕 Лид",
+    "active": "👋 Зарегистрирован",
+    "paid": "💰 Оплачен",
+    "kit_sent": "📦 Набор отправлен",
+    "courier_scheduled": "🚚 Курьер назначен",
+    "in_lab": "🧪 В лаборатории",
+    "collect_retry": "🔁 Повторный сбор",
+    "results_ready": "📄 Результаты готовы",
+    "program_started": "🌱 Программа запущена",
+}
+
+# Допустимые переходы: новый статус -> статусы, из которых в него можно перейти
+STATUS_TRANSITIONS = {
+    "active": {None, "lead"},
+    # Только до выполнения заказа: повторная оплата или сверка не должны откатывать клиента из лаборатории
+    "paid": {None, "lead", "active"},
+    "kit_sent": {"paid", "collect_retry"},
+    "courier_scheduled": {"kit_sent", "collect_retry"},
+    "in_lab": {"courier_scheduled"},
+    "collect_retry": {"kit_sent", "courier_scheduled", "in_lab"},
+    "results_ready": {"in_lab"},
+    "program_started": {"results_ready"},
+}
+
+def can_transition(from_status: Optional[str], to_status: str) -> bool:
+    """Проверяет, разрешен ли переход между статусами"""
+    allowed = STATUS_TRANSITIONS.get(to_status)
+    # Повтор текущего статуса - не переход: иначе он попадет в историю и исказит время на этапе
+    if allowed is None or from_status == to_status:
+        return False
+    return ANY_STATUS in allowed or from_status in allowed
+
+def allowed_sources(to_status: str) -> Optional[list]:
+    """Статусы, из которых можно перейти в to_status (None - из любого, кроме самого to_status)"""
+    allowed = STATUS_TRANSITIONS.get(to_status, set())
+    if ANY_STATUS in allowed:
+        return None
+    return [status for status in allowed if status is not None]
+
+def status_label(status: Optional[str]) -> str:
+    """Человекочитаемое название статуса"""
+    return STATUS_LABELS.get(status, status or "—")
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Optional
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.types import TelegramObject
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Накопитель времени вложенных вызовов текущего обработчика
+_current_handler: ContextVar[Optional[dict]] = ContextVar("profiled_handler", default=None)
+
+def _frame_name(name: str) -> str:
+    """Имя кадра для формата collapsed stacks: без разделителей и переводов строк"""
+    return re.sub(r"\s+", " ", name).replace(";", ",").strip()
+
+def _statement_label(statement: str) -> str:
+    """Короткая метка SQL-запроса: первые слова без параметров"""
+    return _frame_name(statement)[:60]
+
+class Profiler:
+    """Профилирование по запросу: время обработчиков, запросов к базе и Bot API, сэмплы стеков"""
+
+    def __init__(self, sample_interval: float = None):
+        self.sample_interval = sample_interval or config.PROFILE_SAMPLE_INTERVAL_MS / 1000
+        # Проверяется на каждом обновлении и запросе - единственная цена выключенного профайлера
+        self.enabled = False
+        self.wall = Counter()
+        self.calls = Counter()
+        self.samples = Counter()
+        self.started_at = 0.0
+        self.elapsed = 0.0
+        self.updates = 0
+        self._updates_limit: Optional[int] = None
+        self._done: Optional[asyncio.Event] = None
+        self._sync_engine = None
+        self._sampler: Optional[threading.Thread] = None
+        self._loop_thread_id: Optional[int] = None
+
+    def attach(self, dp: Dispatcher, bot: Bot, engine: AsyncEngine):
+        """Подключает постоянные хуки к обработчикам и Bot API; хуки базы ставятся только на время замера"""
+        middleware = HandlerProfilerMiddleware(self)
+        for observer in (dp.message, dp.callback_query):
+            observer.middleware(middleware)
+        bot.session.middleware(BotApiProfilerMiddleware(self))
+        self._sync_engine = engine.sync_engine
+
+    # ---------- сбор ----------
+
+    def _record(self, kind: str, label: str, elapsed: float):
+        frame = _current_handler.get()
+        handler = frame["name"] if frame else "background"
+        if frame:
+            frame["children"] += elapsed
+        stack = f"{handler};{kind};{label}"
+        self.wall[stack] += elapsed
+        self.calls[stack] += 1
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("profile_started")
+        if started:
+            self._record("db", _statement_label(statement), time.perf_counter() - started.pop())
+
+    def _sample_loop(self):
+        """Фоновый поток: периодически снимает стек потока цикла событий"""
+        cwd = os.getcwd()
+        while self.enabled:
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                filename = os.path.relpath(code.co_filename, cwd) if code.co_filename.startswith(cwd) else os.path.basename(code.co_filename)
+                stack.append(_frame_name(f"{code.co_name} ({filename})"))
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+            time.sleep(self.sample_interval)
+
+    # ---------- управление ----------
+
+    async def run(self, seconds: float = None, updates: int = None) -> "ProfileReport":
+        """Включает профилирование на seconds секунд или до обработки updates обновлений"""
+        if self.enabled:
+            raise RuntimeError("Профилирование уже запущено")
+
+        self.wall.clear()
+        self.calls.clear()
+        self.samples.clear()
+        self.updates = 0
+        self._updates_limit = updates
+        self._done = asyncio.Event()
+        self._loop_thread_id = threading.get_ident()
+        self.started_at = time.perf_counter()
+        self.enabled = True
+
+        if self._sync_engine is not None:
+            event.listen(self._sync_engine, "before_cursor_execute", self._before_cursor_execute)
+            event.listen(self._sync_engine, "after_cursor_execute", self._after_cursor_execute)
+        self._sampler = threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True)
+        self._sampler.start()
+        logger.info(f"🔬 Профилирование включено: {seconds or '-'} с, {updates or '-'} обновлений")
+
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout=min(seconds or config.PROFILE_MAX_SECONDS,
+                                                                 config.PROFILE_MAX_SECONDS))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await self._stop()
+        return ProfileReport(self)
+
+    def _update_handled(self):
+        self.updates += 1
+        if self._updates_limit and self.updates >= self._updates_limit and self._done:
+            self._done.set()
+
+    async def _stop(self):
+        self.enabled = False
+        self.elapsed = time.perf_counter() - self.started_at
+        if self._sync_engine is not None:
+            event.remove(self._sync_engine, "before_cursor_execute", self._before_cursor_execute)
+            event.remove(self._sync_engine, "after_cursor_execute", self._after_cursor_execute)
+        if self._sampler:
+            await asyncio.to_thread(self._sampler.join)
+            self._sampler = None
+        logger.info(f"🔬 Профилирование завершено: {self.elapsed:.1f} с, обновлений {self.updates}, "
+                    f"сэмплов {sum(self.samples.values())}")
+
+class HandlerProfilerMiddleware(BaseMiddleware):
+    """Время обработчиков сообщений и колбэков"""
+
+    def __init__(self, profiler: Profiler):
+        self.profiler = profiler
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        if not self.profiler.enabled:
+            return await handler(event, data)
+
+        handler_object = data.get("handler")
+        name = _frame_name(handler_object.callback.__name__) if handler_object else "unknown"
+        frame = {"name": name, "children": 0.0}
+        token = _current_handler.set(frame)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current_handler.reset(token)
+            if self.profiler.enabled:
+                self.profiler.wall[f"{name};self"] += max(elapsed - frame["children"], 0.0)
+                self.profiler.calls[name] += 1
+                self.profiler._update_handled()
+
+class BotApiProfilerMiddleware(BaseRequestMiddleware):
+    """Время запросов к Bot API"""
+
+    def __init__(self, profiler: Profiler):
+        self.profiler = profiler
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        if not self.profiler.enabled:
+            return await make_request(bot, method)
+
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            self.profiler._record("api", type(method).__name__, time.perf_counter() - started)
+
+class ProfileReport:
+    """Результат замера: сводка top-N и файлы collapsed stacks"""
+
+    def __init__(self, profiler: Profiler):
+        self.elapsed = profiler.elapsed
+        self.updates = profiler.updates
+        self.wall = Counter(profiler.wall)
+        self.calls = Counter(profiler.calls)
+        self.samples = Counter(profiler.samples)
+
+    def summary(self, top: int = 10) -> str:
+        """Текстовая сводка: обработчики и самые дорогие стеки по времени"""
+        handlers = Counter()
+        kinds = Counter()
+        for stack, seconds in self.wall.items():
+            parts = stack.split(";")
+            handlers[parts[0]] += seconds
+            kinds[parts[1]] += seconds
+        total = sum(kinds.values()) or 1
+
+        report = (
+            f"🔬 *Профиль за {self.elapsed:.1f} с* (обновлений: {self.updates})\n\n"
+            f"*Распределение времени:*\n"
+        )
+        for kind, title in (("self", "код обработчиков"), ("db", "база данных"), ("api", "Bot API")):
+            report += f"• {title}: {kinds[kind] * 1000:.0f} мс ({kinds[kind] / total * 100:.0f}%)\n"
+
+        report += "\n*Обработчики:*\n"
+        for name, seconds in handlers.most_common(top):
+            count = self.calls[name]
+            average = f", в среднем {seconds / count * 1000:.1f} мс" if count else ""
+            report += f"• `{name}`: {seconds * 1000:.0f} мс, вызовов {count}{average}\n"
+
+        report += "\n*Самые дорогие вызовы:*\n"
+        calls = [(stack, seconds) for stack, seconds in self.wall.most_common() if not stack.endswith(";self")]
+        for stack, seconds in calls[:top]:
+            report += f"• `{stack.replace(';', ' → ')}`: {seconds * 1000:.0f} мс / {self.calls[stack]}\n"
+        return report
+
+    def collapsed_wall(self) -> bytes:
+        """Время по стекам обработчик;вид;вызов в микросекундах - формат flamegraph.pl"""
+        lines = [f"{stack} {round(seconds * 1_000_000)}" for stack, seconds in self.wall.items() if seconds > 0]
+        return "\n".join(lines).encode()
+
+    def collapsed_samples(self) -> bytes:
+        """Сэмплы стека потока цикла событий в формате flamegraph.pl"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.items()).encode()
+
+profiler = Profiler()
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+from config import config
+from database import get_pending_orders_batch, bulk_update_order_payment, mark_orders_paid
+from payments import YooKassaClient
+
+logger = logging.getLogger(__name__)
+
+# Статусы ЮKassa, после которых платеж уже не изменится
+FINAL_STATUSES = {"succeeded": "paid", "canceled": "canceled"}
+
+PaidCallback = Callable[[object, str], Awaitable[None]]
+
+class PaymentReconciler:
+    """Периодическая сверка зависших заказов с платежным провайдером"""
+
+    def __init__(self, client: YooKassaClient, on_paid: PaidCallback):
+        self.client = client
+        self.on_paid = on_paid
+        self._lock = asyncio.Lock()
+        self.last_report = None
+
+    async def _check_batch(self, orders, semaphore: asyncio.Semaphore):
+        """Запрашивает статусы платежей пакета с ограничением параллельности"""
+        async def check(order):
+            async with semaphore:
+                payment = await self.client.get_payment(order.transaction_id)
+                return order, payment.get("status") if payment else None
+
+        return await asyncio.gather(*(check(order) for order in orders))
+
+    async def run(self) -> dict:
+        """Один проход сверки, возвращает отчет"""
+        if self._lock.locked():
+            logger.info("⏭ Сверка платежей уже выполняется")
+            return self.last_report or {}
+
+        async with self._lock:
+            started = time.perf_counter()
+            report = {"checked": 0, "paid": 0, "canceled": 0, "unknown": 0, "batches": 0}
+            semaphore = asyncio.Semaphore(config.RECONCILE_CONCURRENCY)
+            created_before = datetime.utcnow() - timedelta(minutes=config.RECONCILE_MIN_AGE_MINUTES)
+            last_id = 0
+
+            while True:
+                orders = await get_pending_orders_batch(last_id, config.RECONCILE_BATCH_SIZE, created_before)
+                if not orders:
+                    break
+                last_id = orders[-1].id
+                report["batches"] += 1
+                report["checked"] += len(orders)
+
+                results = await self._check_batch(orders, semaphore)
+                by_status = {status: [] for status in FINAL_STATUSES.values()}
+                for order, provider_status in results:
+                    if provider_status in FINAL_STATUSES:
+                        by_status[FINAL_STATUSES[provider_status]].append(order.id)
+                    elif provider_status is None:
+                        report["unknown"] += 1
+
+                # Оплату отмечает тот же условный UPDATE, что у вебхука и кнопки «Я оплатил»:
+                # on_paid вызывается только для строк, которые перевел этот проход
+                paid = await mark_orders_paid(by_status["paid"]) or []
+                canceled = await bulk_update_order_payment(by_status["canceled"], "canceled")
+                report["paid"] += len(paid)
+                report["canceled"] += len(canceled)
+
+                for order in paid:
+                    try:
+                        await self.on_paid(order, order.transaction_id)
+                    except Exception as e:
+                        logger.error(f"❌ Ошибка обработки оплаченного заказа #{order.id}: {e}")
+
+                if len(orders) < config.RECONCILE_BATCH_SIZE:
+                    break
+
+            elapsed = time.perf_counter() - started
+            report["elapsed"] = round(elapsed, 3)
+            report["orders_per_second"] = round(report["checked"] / elapsed, 1) if elapsed else 0
+            self.last_report = report
+            logger.info(
+                f"💳 Сверка платежей: проверено {report['checked']}, оплачено {report['paid']}, "
+                f"отменено {report['canceled']}, без ответа {report['unknown']} "
+                f"за {report['elapsed']}с ({report['orders_per_second']} заказов/с)"
+            )
+            return report
@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
+from config import config
+from pipeline import status_label
+
+logger = logging.getLogger(__name__)
+
+QUIZ_QUESTION_TITLES = {
+    "energy_level": "Усталость",
+    "sleep_quality": "Качество сна",
+    "activity_level": "Физическая активность",
+}
+
+# Рекомендации по ответам квиза
+QUIZ_RECOMMENDATIONS = {
+    "😫 Постоянно": "Постоянная усталость - повод проверить уровень кортизола и щитовидную железу",
+    "😐 Часто": "Частая усталость: обратите внимание на режим дня и уровень витамина D",
+    "⏰ Плохо": "Плохой сон влияет на гормональный баланс: выстройте вечерний ритуал без экранов",
+    "💤 Бессонница": "При бессоннице важно обсудить результаты с врачом на консультации",
+    "🧘 Редко": "Добавьте 2-3 тренировки в неделю для поддержки обмена веществ",
+    "🚫 Никогда": "Начните с ежедневных прогулок по 30 минут",
+}
+
+PAYMENT_STATUSES = {
+    'new': 'Новый',
+    'pending': 'Ожидает оплаты',
+    'paid': 'Оплачен',
+}
+
+def build_report_payload(user, orders: List, quiz_data: List) -> Dict:
+    """Данные отчета в виде простых типов: только они передаются в процесс сборки"""
+    return {
+        "user_id": user.id,
+        "name": user.first_name or "Клиент",
+        "phone": user.phone,
+        "city": user.city,
+        "timezone": user.timezone,
+        "status": status_label(user.status),
+        "registered": user.created_at.strftime('%d.%m.%Y') if user.created_at else None,
+        "quiz": [[QUIZ_QUESTION_TITLES.get(question_id, question_id), answer] for question_id, answer in quiz_data],
+        "orders": [
+            [order.id, float(order.amount or 0), PAYMENT_STATUSES.get(order.payment_status, order.payment_status),
+             order.created_at.strftime('%d.%m.%Y') if order.created_at else None]
+            for order in orders
+        ],
+    }
+
+def report_version(payload: Dict) -> str:
+    """Версия отчета - хэш его данных: меняются данные - меняется версия"""
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode()
+    return hashlib.sha1(raw).hexdigest()[:16]
+
+def render_report_xlsx(payload: Dict) -> bytes:
+    """Собирает персональный отчет в XLSX (выполняется в процессе пула)"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font
+
+    workbook = Workbook()
+    bold = Font(bold=True)
+
+    profile = workbook.active
+    profile.title = "Профиль"
+    profile.append(["Персональный отчет GenoLife"])
+    profile["A1"].font = Font(bold=True, size=14)
+    profile.append([])
+    for title, value in (
+        ("Имя", payload["name"]),
+        ("Телефон", payload["phone"]),
+        ("Город", payload["city"]),
+        ("Часовой пояс", payload["timezone"]),
+        ("Этап", payload["status"]),
+        ("Клиент с", payload["registered"]),
+    ):
+        profile.append([title, value or "—"])
+        profile.cell(row=profile.max_row, column=1).font = bold
+    profile.column_dimensions["A"].width = 18
+    profile.column_dimensions["B"].width = 40
+
+    quiz = workbook.create_sheet("Анкета и рекомендации")
+    quiz.append(["Вопрос", "Ответ", "Рекомендация"])
+    for question, answer in payload["quiz"]:
+        quiz.append([question, answer, QUIZ_RECOMMENDATIONS.get(answer, "Поддерживайте текущий режим")])
+    for cell in quiz[1]:
+        cell.font = bold
+    quiz.column_dimensions["A"].width = 24
+    quiz.column_dimensions["B"].width = 18
+    quiz.column_dimensions["C"].width = 80
+
+    orders = workbook.create_sheet("Заказы")
+    orders.append(["Заказ", "Сумма, руб", "Статус", "Дата"])
+    for row in payload["orders"]:
+        orders.append(row)
+    for cell in orders[1]:
+        cell.font = bold
+
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+class ReportRenderer:
+    """Сборка отчетов в пуле процессов с ограниченной очередью"""
+
+    def __init__(self, workers: int = None, queue_size: int = None):
+        self.workers = workers or config.REPORT_WORKERS
+        self.queue_size = queue_size or config.REPORT_QUEUE_SIZE
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # Одновременные запросы одного отчета ждут одну сборку
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self.rendered = 0
+        self.rejected = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: дочерние процессы не наследуют цикл событий и соединения бота
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    @property
+    def pending(self) -> int:
+        return len(self._in_flight)
+
+    async def render(self, key: str, payload: Dict) -> Optional[bytes]:
+        """Возвращает файл отчета; None, если очередь переполнена или сборка не удалась"""
+        if key in self._in_flight:
+            try:
+                return await asyncio.shield(self._in_flight[key])
+            except Exception:
+                return None
+
+        if len(self._in_flight) >= self.queue_size:
+            self.rejected += 1
+            logger.warning(f"⚠️ Очередь отчетов заполнена ({self.queue_size}), запрос {key} отклонен")
+            return None
+
+        loop = asyncio.get_running_loop()
+        try:
+            # Отправка в пул тоже может упасть (например, пул сломан) - это ошибка сборки, а не обработчика
+            future = loop.run_in_executor(self._get_executor(), render_report_xlsx, payload)
+            self._in_flight[key] = future
+            data = await asyncio.shield(future)
+            self.rendered += 1
+            return data
+        except BrokenProcessPool as e:
+            logger.error(f"❌ Пул сборки отчетов сломан, пересоздаем: {e}")
+            self.close()
+            return None
+        except Exception as e:
+            logger.error(f"❌ Ошибка сборки отчета {key}: {e}")
+            return None
+        finally:
+            self._in_flight.pop(key, None)
+
+    def close(self, wait: bool = False):
+        """Останавливает пул процессов"""
+        if self._executor:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+report_renderer = ReportRenderer()
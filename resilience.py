@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, Iterator
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramNetworkError, TelegramServerError
+from aiogram.methods import TelegramMethod
+from config import config
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitOpenError(Exception):
+    """Зависимость недоступна: вызов отклонен без обращения к ней"""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name} недоступна, повтор через {retry_in:.0f} с")
+        self.name = name
+        self.retry_in = retry_in
+
+class CircuitBreaker:
+    """Автомат по зависимости: после серии сбоев отклоняет вызовы до паузы и пробного вызова"""
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.retries = 0
+        self.opened_count = 0
+        breakers[name] = self
+
+    def check(self):
+        """Пропускает вызов или сразу отклоняет его, пока зависимость считается недоступной"""
+        if self.state == CLOSED:
+            return
+        if self.state == OPEN:
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, retry_in)
+            self.state = HALF_OPEN
+            logger.info(f"🟡 {self.name}: пробный вызов после паузы")
+        # Полуоткрытое состояние: вызовы идут, первый же результат решает судьбу автомата
+
+    def record_success(self):
+        self.successes += 1
+        self.consecutive_failures = 0
+        if self.state != CLOSED:
+            self.state = CLOSED
+            logger.info(f"🟢 {self.name}: доступна, автомат закрыт")
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.consecutive_failures >= self.failure_threshold):
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.opened_count += 1
+            logger.error(f"🔴 {self.name}: {self.consecutive_failures} сбоев подряд, вызовы отклоняются "
+                         f"на {self.reset_timeout:.0f} с")
+
+    def snapshot(self) -> Dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "successes": self.successes,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "retries": self.retries,
+            "opened": self.opened_count,
+        }
+
+# Все автоматы процесса по имени зависимости
+breakers: Dict[str, CircuitBreaker] = {}
+
+def breaker_states() -> Dict[str, Dict]:
+    """Состояние всех автоматов для статистики и проверок готовности"""
+    return {name: breaker.snapshot() for name, breaker in breakers.items()}
+
+def backoff_delays(attempts: int, base: float, cap: float) -> Iterator[float]:
+    """Паузы между попытками: экспонента с полным джиттером, чтобы повторы не шли волной"""
+    for attempt in range(attempts - 1):
+        yield random.uniform(0, min(cap, base * 2 ** attempt))
+
+db_breaker = CircuitBreaker("database", config.DB_BREAKER_FAILURES, config.DB_BREAKER_RESET_SECONDS)
+bot_breaker = CircuitBreaker("bot_api", config.BOT_BREAKER_FAILURES, config.BOT_BREAKER_RESET_SECONDS)
+
+# Методы Bot API, повтор которых может продублировать сообщение пользователю
+NON_IDEMPOTENT_PREFIXES = ("Send", "Forward", "Copy")
+
+class BotApiResilienceMiddleware(BaseRequestMiddleware):
+    """Повторы запросов к Bot API при 5xx и сетевых сбоях и автомат на всю зависимость"""
+
+    def __init__(self, breaker: CircuitBreaker = bot_breaker, attempts: int = None):
+        self.breaker = breaker
+        self.attempts = attempts or config.BOT_RETRY_ATTEMPTS
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        name = type(method).__name__
+        # Отправка, оборвавшаяся по таймауту, могла дойти: по умолчанию не повторяем, чтобы не задублировать
+        retryable = config.BOT_RETRY_SENDS or not name.startswith(NON_IDEMPOTENT_PREFIXES)
+        delays = backoff_delays(self.attempts if retryable else 1, config.RETRY_BASE_DELAY, config.RETRY_MAX_DELAY)
+
+        while True:
+            self.breaker.check()
+            try:
+                result = await make_request(bot, method)
+            except (TelegramServerError, TelegramNetworkError) as e:
+                self.breaker.record_failure()
+                delay = next(delays, None)
+                if delay is None or self.breaker.state == OPEN:
+                    raise
+                self.breaker.retries += 1
+                logger.warning(f"🔁 Bot API {name}: {e}, повтор через {delay:.2f} с")
+                await asyncio.sleep(delay)
+                continue
+            except Exception:
+                # Ошибки 4xx означают, что Bot API отвечает - зависимость жива
+                self.breaker.record_success()
+                raise
+            self.breaker.record_success()
+            return result
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Iterable, Optional, Tuple
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# (chat_id, text, дополнительные аргументы send_message)
+OutgoingMessage = Tuple[int, str, dict]
+ProgressCallback = Callable[[int, int, int], Awaitable[None]]
+
+class RateLimitedSender:
+    """Параллельная рассылка сообщений с ограничением частоты запросов к Bot API"""
+
+    def __init__(self, bot: Bot, rate: float = None, concurrency: int = None):
+        self.bot = bot
+        self.rate = rate or config.SEND_RATE_PER_SECOND
+        self.concurrency = concurrency or config.SEND_CONCURRENCY
+        self._interval = 1.0 / self.rate
+        self._next_slot = 0.0
+        self._slot_lock = asyncio.Lock()
+
+    async def _acquire_slot(self):
+        """Ждет следующего свободного окна отправки"""
+        async with self._slot_lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self._interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> bool:
+        """Отправляет одно сообщение с учетом лимита и RetryAfter"""
+        for attempt in range(2):
+            await self._acquire_slot()
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                return True
+            except TelegramRetryAfter as e:
+                logger.warning(f"⏳ Лимит Telegram, ждем {e.retry_after}с перед повтором для {chat_id}")
+                await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError:
+                logger.info(f"🚫 Пользователь {chat_id} заблокировал бота")
+                return False
+            except Exception as e:
+                logger.error(f"❌ Ошибка отправки сообщения {chat_id}: {e}")
+                return False
+        return False
+
+    async def send_many(self, messages: Iterable[OutgoingMessage], on_progress: Optional[ProgressCallback] = None,
+                        progress_every: int = 25) -> Tuple[int, int]:
+        """Рассылает сообщения параллельно, возвращает (отправлено, ошибок)"""
+        messages = list(messages)
+        total = len(messages)
+        sent = failed = 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def worker(chat_id: int, text: str, kwargs: dict):
+            nonlocal sent, failed
+            async with semaphore:
+                if await self.send(chat_id, text, **kwargs):
+                    sent += 1
+                else:
+                    failed += 1
+                done = sent + failed
+                if on_progress and done % progress_every == 0 and done < total:
+                    try:
+                        await on_progress(done, total, failed)
+                    except Exception as e:
+                        logger.warning(f"⚠️ Ошибка обновления прогресса рассылки: {e}")
+
+        await asyncio.gather(*(worker(chat_id, text, kwargs) for chat_id, text, kwargs in messages))
+        logger.info(f"📨 Рассылка завершена: отправлено {sent}, ошибок {failed} из {total}")
+        return sent, failed